@@ -0,0 +1,15 @@
+"""
+Performance benchmarks for PyDDA. These use airspeed velocity (asv).
+To run them against the current commit, do this from the root of the
+repository:
+
+    asv run --python=same --quick
+
+To compare two commits, use asv continuous, for example:
+
+    asv continuous master HEAD
+
+The time_* benchmarks measure the run time and the peakmem_* benchmarks
+measure the peak resident memory of each function on synthetic grids of
+increasing size and radar count.
+"""
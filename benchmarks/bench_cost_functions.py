@@ -0,0 +1,115 @@
+"""
+Benchmarks of the cost functions, their gradients and the fall speed.
+"""
+
+import numpy as np
+
+import pydda
+
+from .common import GRID_SHAPES, make_benchmark_grids
+from .common import make_cost_function_args, make_winds
+
+
+class CostFunctionSuite(object):
+    """ Times each cost function and gradient on a single radar pair. """
+    params = GRID_SHAPES
+    param_names = ['grid_shape']
+
+    def setup(self, grid_shape):
+        grids = make_benchmark_grids(grid_shape, 2)
+        self.args = make_cost_function_args(grids)
+        self.winds = make_winds(grid_shape)
+        self.u, self.v, self.w = np.reshape(self.winds, (3,) + grid_shape)
+        self.z = self.args[23]
+        (self.vrs, self.azs, self.els, self.wts) = self.args[:4]
+        self.weights = self.args[25]
+        self.bg_weights = self.args[26]
+        self.u_back = np.zeros(grid_shape[0])
+        self.v_back = np.zeros(grid_shape[0])
+
+    def time_J_function(self, grid_shape):
+        pydda.cost_functions.J_function(self.winds, *self.args)
+
+    def time_grad_J(self, grid_shape):
+        pydda.cost_functions.grad_J(self.winds, *self.args)
+
+    def time_J_and_grad_J(self, grid_shape):
+        pydda.cost_functions.J_and_grad_J(self.winds, *self.args)
+
+    def peakmem_J_and_grad_J(self, grid_shape):
+        pydda.cost_functions.J_and_grad_J(self.winds, *self.args)
+
+    def time_radial_vel_cost_function(self, grid_shape):
+        pydda.cost_functions.calculate_radial_vel_cost_function(
+            self.vrs, self.azs, self.els, self.u, self.v, self.w, self.wts,
+            1.0, self.weights)
+
+    def time_grad_radial_vel(self, grid_shape):
+        pydda.cost_functions.calculate_grad_radial_vel(
+            self.vrs, self.els, self.azs, self.u, self.v, self.w, self.wts,
+            self.weights, 1.0)
+
+    def time_mass_continuity(self, grid_shape):
+        pydda.cost_functions.calculate_mass_continuity(
+            self.u, self.v, self.w, self.z, 500.0, 500.0, 500.0)
+
+    def time_mass_continuity_gradient(self, grid_shape):
+        pydda.cost_functions.calculate_mass_continuity_gradient(
+            self.u, self.v, self.w, self.z, 500.0, 500.0, 500.0)
+
+    def time_smoothness_cost(self, grid_shape):
+        pydda.cost_functions.calculate_smoothness_cost(
+            self.u, self.v, self.w)
+
+    def time_smoothness_gradient(self, grid_shape):
+        pydda.cost_functions.calculate_smoothness_gradient(
+            self.u, self.v, self.w)
+
+    def time_background_cost(self, grid_shape):
+        pydda.cost_functions.calculate_background_cost(
+            self.u, self.v, self.w, self.bg_weights, self.u_back,
+            self.v_back)
+
+    def time_background_gradient(self, grid_shape):
+        pydda.cost_functions.calculate_background_gradient(
+            self.u, self.v, self.w, self.bg_weights, self.u_back,
+            self.v_back)
+
+    def time_vertical_vorticity_cost(self, grid_shape):
+        pydda.cost_functions.calculate_vertical_vorticity_cost(
+            self.u, self.v, self.w, 500.0, 500.0, 500.0, 0.0, 0.0)
+
+    def time_vertical_vorticity_gradient(self, grid_shape):
+        pydda.cost_functions.calculate_vertical_vorticity_gradient(
+            self.u, self.v, self.w, 500.0, 500.0, 500.0, 0.0, 0.0)
+
+    def time_model_cost(self, grid_shape):
+        pydda.cost_functions.calculate_model_cost(
+            self.u, self.v, self.w, [self.bg_weights], [self.u], [self.v],
+            [self.w])
+
+    def time_model_gradient(self, grid_shape):
+        pydda.cost_functions.calculate_model_gradient(
+            self.u, self.v, self.w, [self.bg_weights], [self.u], [self.v],
+            [self.w])
+
+
+class FallSpeedSuite(object):
+    """ Times the fall speed estimation. """
+    params = GRID_SHAPES
+    param_names = ['grid_shape']
+
+    def setup(self, grid_shape):
+        self.grid = make_benchmark_grids(grid_shape, 1)[0]
+
+    def time_calculate_fall_speed(self, grid_shape):
+        pydda.cost_functions.calculate_fall_speed(
+            self.grid, refl_field='reflectivity', use_cache=False)
+
+    def time_calculate_fall_speed_cached(self, grid_shape):
+        pydda.cost_functions.calculate_fall_speed(
+            self.grid, refl_field='reflectivity')
+
+    def peakmem_calculate_fall_speed(self, grid_shape):
+        pydda.cost_functions.calculate_fall_speed(
+            self.grid, refl_field='reflectivity', use_cache=False)
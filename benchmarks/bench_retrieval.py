@@ -0,0 +1,104 @@
+"""
+Benchmarks of the geometry setup and the end to end retrievals.
+"""
+
+import numpy as np
+
+import pydda
+
+from .common import GRID_SHAPES, NUM_RADARS, make_benchmark_grids
+
+RETRIEVAL_KWARGS = dict(vel_name='velocity', refl_field='reflectivity',
+                        Co=1.0, Cm=1500.0, Cz=0.0, filt_iterations=0,
+                        max_iterations=10, output_cost_functions=False)
+
+
+class GeometrySuite(object):
+    """ Times the azimuth, elevation and beam crossing angle setup. """
+    params = GRID_SHAPES
+    param_names = ['grid_shape']
+
+    def setup(self, grid_shape):
+        self.grids = make_benchmark_grids(grid_shape, 2)
+
+    def time_add_azimuth_as_field(self, grid_shape):
+        pydda.retrieval.angles.add_azimuth_as_field(
+            self.grids[0], dz_name='reflectivity')
+
+    def time_add_elevation_as_field(self, grid_shape):
+        pydda.retrieval.angles.add_elevation_as_field(
+            self.grids[0], dz_name='reflectivity')
+
+    def peakmem_add_elevation_as_field(self, grid_shape):
+        pydda.retrieval.angles.add_elevation_as_field(
+            self.grids[0], dz_name='reflectivity')
+
+    def time_get_bca(self, grid_shape):
+        grid1, grid2 = self.grids
+        pydda.retrieval.get_bca(
+            grid1.radar_longitude['data'], grid1.radar_latitude['data'],
+            grid2.radar_longitude['data'], grid2.radar_latitude['data'],
+            grid1.point_x['data'][0], grid1.point_y['data'][0],
+            grid1.get_projparams())
+
+
+class RetrievalSuite(object):
+    """ Times 10 iterations of the retrieval. """
+    params = (GRID_SHAPES[:2], NUM_RADARS)
+    param_names = ['grid_shape', 'num_radars']
+    timeout = 600
+
+    def setup(self, grid_shape, num_radars):
+        self.grids = make_benchmark_grids(grid_shape, num_radars)
+        self.u_init = np.zeros(grid_shape)
+        self.v_init = np.zeros(grid_shape)
+        self.w_init = np.zeros(grid_shape)
+
+    def time_get_dd_wind_field(self, grid_shape, num_radars):
+        pydda.retrieval.get_dd_wind_field(
+            self.grids, self.u_init, self.v_init, self.w_init,
+            **RETRIEVAL_KWARGS)
+
+    def peakmem_get_dd_wind_field(self, grid_shape, num_radars):
+        pydda.retrieval.get_dd_wind_field(
+            self.grids, self.u_init, self.v_init, self.w_init,
+            **RETRIEVAL_KWARGS)
+
+
+class NestedRetrievalSuite(object):
+    """
+    Times 10 iterations of the nested retrieval on a local dask cluster
+    and on a local process pool, and of a cascade of three resolutions.
+    """
+    params = (GRID_SHAPES[:2], NUM_RADARS[:2])
+    param_names = ['grid_shape', 'num_radars']
+    timeout = 600
+
+    def setup(self, grid_shape, num_radars):
+        from distributed import Client, LocalCluster
+
+        self.cluster = LocalCluster(n_workers=2, processes=False)
+        self.client = Client(self.cluster)
+        self.grids = make_benchmark_grids(grid_shape, num_radars)
+        self.u_init = np.zeros(grid_shape)
+        self.v_init = np.zeros(grid_shape)
+        self.w_init = np.zeros(grid_shape)
+
+    def teardown(self, grid_shape, num_radars):
+        self.client.close()
+        self.cluster.close()
+
+    def time_get_dd_wind_field_nested(self, grid_shape, num_radars):
+        pydda.retrieval.get_dd_wind_field_nested(
+            self.grids, self.u_init, self.v_init, self.w_init, self.client,
+            **RETRIEVAL_KWARGS)
+
+    def time_get_dd_wind_field_nested_process(self, grid_shape, num_radars):
+        pydda.retrieval.get_dd_wind_field_nested(
+            self.grids, self.u_init, self.v_init, self.w_init,
+            executor='process', num_workers=2, **RETRIEVAL_KWARGS)
+
+    def time_get_dd_wind_field_nested_cascade(self, grid_shape, num_radars):
+        pydda.retrieval.get_dd_wind_field_nested(
+            self.grids, self.u_init, self.v_init, self.w_init, self.client,
+            reduction_factors=[4, 2, 1], **RETRIEVAL_KWARGS)
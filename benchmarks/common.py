@@ -0,0 +1,53 @@
+"""
+Synthetic scenes for the benchmarks.
+"""
+
+import numpy as np
+
+from pydda.tests import (make_synthetic_radar_grids,
+                         get_radial_velocity_inputs)
+
+# Grid shapes (nz, ny, nx) used for the benchmarks
+GRID_SHAPES = [(10, 50, 50), (20, 100, 100), (40, 200, 200)]
+
+# Number of radars used for the benchmarks of the retrieval
+NUM_RADARS = [2, 3, 5]
+
+
+def make_benchmark_grids(grid_shape, num_radars, seed=0):
+    """
+    Makes a list of Py-ART Grids with a convective cell observed by
+    num_radars radars placed on a circle around the domain center.
+    """
+    grid_limits = ((0, 500.0*grid_shape[0]),
+                   (-250.0*grid_shape[1], 250.0*grid_shape[1]),
+                   (-250.0*grid_shape[2], 250.0*grid_shape[2]))
+    grids, truth = make_synthetic_radar_grids(
+        grid_shape, grid_limits, num_radars=num_radars, noise_std=1.0,
+        seed=seed)
+    return grids
+
+
+def make_cost_function_args(grids):
+    """
+    Makes the positional arguments of J_function and grad_J after winds.
+    """
+    vrs, azs, els, wts = get_radial_velocity_inputs(grids)
+    grid_shape = vrs[0].shape
+    weights = np.stack([np.ma.getmaskarray(vr) == 0 for vr in vrs]).astype(
+        float)
+    bg_weights = np.zeros(grid_shape)
+    model_weights = np.zeros((1,) + grid_shape)
+    u_back = np.zeros(grid_shape[0])
+    v_back = np.zeros(grid_shape[0])
+    z = grids[0].point_z['data']
+    return (vrs, azs, els, wts, u_back, v_back, [], [], [],
+            1.0, 1500.0, 1e-3, 1e-3, 1e-3, 0.0, 1e-5, 0.0, 0.0, 0.0,
+            grid_shape, 500.0, 500.0, 500.0, z, 1.0, weights, bg_weights,
+            model_weights, True)
+
+
+def make_winds(grid_shape, seed=1):
+    """ Makes a random flattened (u, v, w) state vector. """
+    rng = np.random.RandomState(seed)
+    return rng.standard_normal(3*int(np.prod(grid_shape)))
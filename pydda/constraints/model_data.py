@@ -22,6 +22,7 @@ except:
 from netCDF4 import Dataset
 from datetime import datetime, timedelta
 from scipy.interpolate import griddata, NearestNDInterpolator
+from scipy.ndimage import distance_transform_edt
 from copy import deepcopy
 
 
@@ -91,14 +92,124 @@ def download_needed_era_data(Grid, start_date, end_date, file_name):
     server.retrieve(retrieve_dict)
 
 
+def _get_linear_weights(coords, points):
+    # The indices of the coordinates on either side of each point and the
+    # weight of the second one. The coordinates do not need to be sorted,
+    # and points outside of them are given the value at the nearest edge.
+    coords = np.asarray(coords, dtype=float)
+    order = np.argsort(coords)
+    sorted_coords = coords[order]
+    index = np.clip(np.searchsorted(sorted_coords, points) - 1, 0,
+                    max(len(coords) - 2, 0))
+    next_index = np.minimum(index + 1, len(coords) - 1)
+    spacing = sorted_coords[next_index] - sorted_coords[index]
+    weight = np.where(spacing > 0, points - sorted_coords[index], 0.0)
+    weight = np.clip(weight/np.where(spacing > 0, spacing, 1.0), 0.0, 1.0)
+    return order[index], order[next_index], weight
+
+
+def _interpolate_era_to_grid(Grid, height, fields, lat, lon):
+    """
+    Interpolates fields on the regular latitude and longitude grid of a
+    reanalysis to the points of a Py-ART Grid. Each column of the reanalysis
+    is interpolated linearly to the heights of the Grid, and then the
+    columns are interpolated bilinearly to the latitude and longitude of
+    the Grid. The indices and weights are calculated once and shared by
+    all of the fields. Points outside of the reanalysis are given the
+    value at its nearest edge.
+
+    Parameters
+    ----------
+    Grid: Py-ART Grid
+        The Py-ART Grid to interpolate to.
+    height: 3D array
+        The height above the radar of each point of the reanalysis, with
+        dimensions of (level, latitude, longitude).
+    fields: list of 3D arrays
+        The fields to interpolate, with the same dimensions as height.
+    lat: 1D array
+        The latitudes of the reanalysis.
+    lon: 1D array
+        The longitudes of the reanalysis.
+
+    Returns
+    -------
+    new_fields: list of 3D arrays
+        The fields on the Py-ART Grid. Columns of the reanalysis without
+        any valid data are filled from the nearest column with valid data.
+    """
+    z = np.asarray(Grid.z['data'], dtype=float)
+    mask = np.ma.getmaskarray(height)
+    for field in fields:
+        mask = np.logical_or(mask, np.ma.getmaskarray(field))
+    if mask.all():
+        raise ValueError('The reanalysis does not have any valid data')
+
+    num_levels = height.shape[0]
+    horizontal_shape = height.shape[1:]
+    mask = np.reshape(mask, (num_levels, -1))
+    height = np.reshape(np.ma.getdata(height), (num_levels, -1))
+    fields = [np.reshape(np.ma.getdata(field), (num_levels, -1))
+              for field in fields]
+
+    # Vertical interpolation of each column to the heights of the Grid.
+    # The invalid levels are moved above the top of the Grid, and each
+    # sorted column is offset above the one before it, so all of the
+    # columns are searched at once.
+    num_valid = np.sum(~mask, axis=0)
+    bottom = min(np.where(mask, np.inf, height).min(), z.min())
+    top = max(np.where(mask, -np.inf, height).max(), z.max()) + 1
+    column_index = np.arange(height.shape[1])
+    offset = (top - bottom + 1)*column_index
+    height = np.where(mask, top, height)
+    order = np.argsort(height, axis=0)
+    sorted_height = height[order, column_index]
+    below = np.searchsorted(
+        (sorted_height - bottom + offset).T.ravel(),
+        z[:, np.newaxis] - bottom + offset) - num_levels*column_index
+    last = np.maximum(num_valid - 1, 0)
+    index = np.clip(below - 1, 0, np.maximum(last - 1, 0))
+    next_index = np.minimum(index + 1, last)
+    height0 = sorted_height[index, column_index]
+    spacing = sorted_height[next_index, column_index] - height0
+    weight = np.where(spacing > 0, z[:, np.newaxis] - height0, 0.0)
+    weight = np.clip(weight/np.where(spacing > 0, spacing, 1.0), 0.0, 1.0)
+    columns = []
+    for field in fields:
+        sorted_field = field[order, column_index]
+        columns.append(np.reshape(
+            (1 - weight)*sorted_field[index, column_index] +
+            weight*sorted_field[next_index, column_index],
+            (len(z),) + horizontal_shape))
+
+    # Columns without valid data take the values of the nearest valid one
+    empty = np.reshape(num_valid == 0, horizontal_shape)
+    if empty.any():
+        nearest = distance_transform_edt(
+            empty, return_distances=False, return_indices=True)
+        columns = [column[:, nearest[0], nearest[1]] for column in columns]
+
+    # Bilinear interpolation of the columns to each point of the Grid
+    lat0, lat1, lat_weight = _get_linear_weights(
+        lat, Grid.point_latitude['data'][0])
+    lon0, lon1, lon_weight = _get_linear_weights(
+        lon, Grid.point_longitude['data'][0])
+    return [(1 - lat_weight)*(1 - lon_weight)*column[:, lat0, lon0] +
+            (1 - lat_weight)*lon_weight*column[:, lat0, lon1] +
+            lat_weight*(1 - lon_weight)*column[:, lat1, lon0] +
+            lat_weight*lon_weight*column[:, lat1, lon1]
+            for column in columns]
+
+
 def make_constraint_from_era_interim(Grid, file_name=None, vel_field=None):
     """
     This function will read ERA Interim in NetCDF format and add it 
     to the Py-ART grid specified by Grid. PyDDA will automatically download
     the ERA Interim data that you need for the scan. It will chose the domain
     that is enclosed by the analysis grid and the time period that is closest
-    to the scan. It will then do a Nearest Neighbor interpolation of the 
-    ERA-Interim u and v winds to the analysis grid. 
+    to the scan. It will then interpolate the ERA-Interim u and v winds
+    linearly in height in each column and then bilinearly in latitude and
+    longitude to the analysis grid.
 
     You need to have the ECMWF API and an ECMWF account set up in order to
     use this feature. Go to this website for instructions on installing the
@@ -211,35 +322,10 @@ def make_constraint_from_era_interim(Grid, file_name=None, vel_field=None):
     w_ERA = ERA_grid.variables["w"][:]
     lon_ERA = ERA_grid.variables["longitude"][:]
     lat_ERA = ERA_grid.variables["latitude"][:]
-    radar_grid_lat = Grid.point_latitude['data']
-    radar_grid_lon = Grid.point_longitude['data']
-    radar_grid_alt = Grid.point_z['data']
-    u_flattened = u_ERA[time_step].flatten()
-    v_flattened = v_ERA[time_step].flatten()
-    w_flattened = w_ERA[time_step].flatten()
-
-    the_shape = u_ERA.shape
-    lon_mgrid, lat_mgrid = np.meshgrid(lon_ERA, lat_ERA)
-
-    lon_mgrid = np.tile(lon_mgrid, (the_shape[1], 1, 1))
-    lat_mgrid = np.tile(lat_mgrid, (the_shape[1], 1, 1))
-    lon_flattened = lon_mgrid.flatten()
-    lat_flattened = lat_mgrid.flatten()
-    height_flattened = height_ERA[time_step].flatten()
-    height_flattened -= Grid.radar_altitude["data"]
-
-    u_interp = NearestNDInterpolator(
-        (height_flattened, lat_flattened, lon_flattened),
-        u_flattened, rescale=True)
-    v_interp = NearestNDInterpolator(
-        (height_flattened, lat_flattened, lon_flattened),
-        v_flattened, rescale=True)
-    w_interp = NearestNDInterpolator(
-        (height_flattened, lat_flattened, lon_flattened),
-        w_flattened, rescale=True)
-    u_new = u_interp(radar_grid_alt, radar_grid_lat, radar_grid_lon)
-    v_new = v_interp(radar_grid_alt, radar_grid_lat, radar_grid_lon)
-    w_new = w_interp(radar_grid_alt, radar_grid_lat, radar_grid_lon)
+    height_ERA = height_ERA[time_step] - Grid.radar_altitude["data"]
+    u_new, v_new, w_new = _interpolate_era_to_grid(
+        Grid, height_ERA, [u_ERA[time_step], v_ERA[time_step],
+                           w_ERA[time_step]], lat_ERA, lon_ERA)
 
     new_grid = deepcopy(Grid)
 
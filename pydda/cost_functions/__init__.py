@@ -59,24 +59,39 @@ procedures in Python, they then need to be added to
 
     J_function
     grad_J
+    J_and_grad_J
+    hessp
+    calculate_cost_terms
     calculate_radial_vel_cost_function
     calculate_grad_radial_vel
+    calculate_radial_vel_hessp
     calculate_mass_continuity
     calculate_mass_continuity_gradient
+    calculate_mass_continuity_hessp
     calculate_smoothness_cost
     calculate_smoothness_gradient
+    calculate_smoothness_hessp
     calculate_background_cost
     calculate_background_gradient 
+    calculate_background_hessp
     calculate_vertical_vorticity_cost
     calculate_vertical_vorticity_gradient
+    calculate_vertical_vorticity_hessp
     calculate_model_cost
     calculate_model_gradient
+    calculate_model_hessp
     calculate_fall_speed
+    FallSpeedRelation
+    PackedObservations
+    ChunkedCostFunction
 """
 
 
 from .cost_functions import calculate_radial_vel_cost_function
-from .cost_functions import calculate_fall_speed
+from .fall_speed import calculate_fall_speed, FallSpeedRelation
+from . import fall_speed
+from .packed import PackedObservations
+from .chunked import ChunkedCostFunction
 from .cost_functions import calculate_grad_radial_vel
 from .cost_functions import calculate_mass_continuity
 from .cost_functions import calculate_mass_continuity_gradient
@@ -89,3 +104,11 @@ from .cost_functions import calculate_vertical_vorticity_gradient
 from .cost_functions import calculate_model_cost
 from .cost_functions import calculate_model_gradient
 from .cost_functions import J_function, grad_J
+from .cost_functions import J_and_grad_J, calculate_cost_terms
+from .cost_functions import hessp
+from .cost_functions import calculate_radial_vel_hessp
+from .cost_functions import calculate_mass_continuity_hessp
+from .cost_functions import calculate_smoothness_hessp
+from .cost_functions import calculate_background_hessp
+from .cost_functions import calculate_vertical_vorticity_hessp
+from .cost_functions import calculate_model_hessp
@@ -0,0 +1,243 @@
+"""
+The cost function and its gradient evaluated chunk by chunk with dask. The
+domain is split into chunks along y and x, and each chunk gets a halo of
+its neighbors that is deep enough for the derivative stencils of the
+constraints. The cost function is then the sum of the cost of each chunk,
+and the gradient is assembled from the gradient of each chunk, so the
+result is the same as on a single node without seams between the chunks.
+dask is only imported when this is used.
+"""
+
+import numpy as np
+
+from . import cost_functions
+
+# The gradients of the mass continuity and smoothness constraints are
+# derivatives of derivatives of the wind field, so they need the winds 2
+# points away.
+HALO = 2
+
+
+def _core_slices(shape, depth):
+    # The slices of a block with a halo of depth in y and x that are the
+    # chunk itself
+    return (slice(None), slice(depth, shape[1] - depth),
+            slice(depth, shape[2] - depth))
+
+
+def _get_masked(data, mask, index):
+    return np.ma.array(data[index], mask=mask[index])
+
+
+def _chunk_J_and_grad(winds, static, edges, depth, params):
+    # Evaluates each term of the cost function on the points of one chunk
+    # and the gradient at those points. winds and the fields in static have
+    # a periodic halo of depth points. The smoothness constraint uses
+    # periodic boundaries, and the others see the edge of the domain, so
+    # their halo is cut off at the edges of the domain.
+    (u_back, v_back, Co, Cm, Cx, Cy, Cz, Cb, Cmod, dx, dy, dz, rmsVr,
+     upper_bc) = params
+    shape = winds.shape[1:]
+    core = _core_slices(shape, depth)
+    core_shape = (3, shape[0], core[1].stop - core[1].start,
+                  core[2].stop - core[2].start)
+    y0 = depth if edges[0] else 0
+    y1 = shape[1] - depth if edges[1] else shape[1]
+    x0 = depth if edges[2] else 0
+    x1 = shape[2] - depth if edges[3] else shape[2]
+    bounded = (slice(None), slice(y0, y1), slice(x0, x1))
+    bounded_core = (slice(None), slice(depth - y0, depth - y0 +
+                                       core_shape[2]),
+                    slice(depth - x0, depth - x0 + core_shape[3]))
+    u, v, w = winds
+    core_u, core_v, core_w = winds[(slice(None),) + core]
+
+    vrs = [_get_masked(data, mask, core) for data, mask in static['vrs']]
+    azs = [_get_masked(data, mask, core) for data, mask in static['azs']]
+    els = [_get_masked(data, mask, core) for data, mask in static['els']]
+    wts = [_get_masked(data, mask, core) for data, mask in static['wts']]
+    weights = np.stack([np.array(weight[core])
+                        for weight in static['weights']])
+    terms = {}
+    terms['Jvel'], grad = cost_functions._radial_vel_cost_and_gradient(
+        vrs, azs, els, core_u, core_v, core_w, wts, rmsVr, weights,
+        coeff=Co, upper_bc=upper_bc)
+
+    terms['Jmass'] = 0
+    if(Cm > 0):
+        z = static['z'][bounded]
+        b_u, b_v, b_w = [wind[bounded] for wind in winds]
+        div2 = cost_functions._divergence(b_u, b_v, b_w, z, dx, dy, dz)
+        terms['Jmass'] = Cm*np.sum(np.square(div2[bounded_core]))/2.0
+        grad += cost_functions._mass_continuity_gradient(
+            div2, dx, dy, dz, Cm, upper_bc)[(slice(None),) + bounded_core]
+
+    terms['Jsmooth'] = 0
+    if(Cx > 0 or Cy > 0 or Cz > 0):
+        du, dv, dw = cost_functions._laplacians(u, v, w)
+        terms['Jsmooth'] = np.sum((Cx*du**2 + Cy*dv**2 + Cz*dw**2)[core])
+        grad += cost_functions._smoothness_gradient(
+            du, dv, dw, Cx, Cy, Cz, upper_bc)[(slice(None),) + core]
+
+    terms['Jbackground'] = 0
+    if(Cb > 0):
+        bg_weights = static['bg_weights'][core]
+        terms['Jbackground'] = cost_functions.calculate_background_cost(
+            core_u, core_v, core_w, bg_weights, u_back, v_back, Cb)
+        grad += np.reshape(cost_functions.calculate_background_gradient(
+            core_u, core_v, core_w, bg_weights, u_back, v_back, Cb,
+            upper_bc=upper_bc), core_shape)
+
+    terms['Jvorticity'] = 0
+    terms['Jmod'] = 0
+    if(Cmod > 0):
+        mod_weights = [weight[core] for weight in static['mod_weights']]
+        u_model = [_get_masked(data, mask, core)
+                   for data, mask in static['u_model']]
+        v_model = [_get_masked(data, mask, core)
+                   for data, mask in static['v_model']]
+        w_model = [_get_masked(data, mask, core)
+                   for data, mask in static['w_model']]
+        terms['Jmod'] = cost_functions.calculate_model_cost(
+            core_u, core_v, core_w, mod_weights, u_model, v_model, w_model,
+            coeff=Cmod)
+        grad += np.reshape(cost_functions.calculate_model_gradient(
+            core_u, core_v, core_w, mod_weights, u_model, v_model, w_model,
+            coeff=Cmod), core_shape)
+
+    # The cost is masked in a chunk without any valid observations
+    return dict([(name, float(np.ma.filled(value, 0.0)))
+                 for name, value in terms.items()]), grad
+
+
+class ChunkedCostFunction(object):
+    """
+    Evaluates the cost function and its gradient chunk by chunk on dask.
+    The observations and constraints are split into chunks along y and x
+    with a halo of :py:data:`HALO` points and persisted on the workers
+    once. On each evaluation, only the wind field is split and sent to the
+    workers. The cost of each term is summed over the chunks and the
+    gradient is assembled here, so a single optimizer runs on the full
+    state vector. The chunks run on the dask scheduler that is active,
+    such as a distributed Client.
+
+    :py:func:`pydda.cost_functions.J_and_grad_J` uses this in place of the
+    list of radial velocities when it is given as vrs.
+
+    Parameters
+    ----------
+    args: tuple
+        The arguments of :py:func:`pydda.cost_functions.J_and_grad_J` after
+        winds.
+    chunks: int or 2-tuple of ints
+        The number of points along y and x in each chunk. Each chunk must
+        have at least :py:data:`HALO` points along y and x.
+    """
+
+    def __init__(self, args, chunks):
+        import dask
+        import dask.array as da
+
+        (vrs, azs, els, wts, u_back, v_back, u_model, v_model, w_model,
+         Co, Cm, Cx, Cy, Cz, Cb, Cv, Cmod, Ut, Vt, grid_shape,
+         dx, dy, dz, z, rmsVr, weights, bg_weights, mod_weights,
+         upper_bc) = args
+        if(Cv > 0):
+            raise ValueError('The vertical vorticity constraint cannot be ' +
+                             'evaluated in chunks!')
+        if isinstance(chunks, int):
+            chunks = (chunks, chunks)
+        self.grid_shape = tuple(grid_shape)
+        self.chunks = da.core.normalize_chunks(
+            (self.grid_shape[0],) + tuple(chunks), self.grid_shape)
+        if(min(self.chunks[1] + self.chunks[2]) < HALO):
+            raise ValueError('Each chunk must have at least ' + str(HALO) +
+                             ' points along y and x!')
+        self.depth = {0: 0, 1: HALO, 2: HALO}
+        self.boundary = {0: 'none', 1: 'periodic', 2: 'periodic'}
+        self.params = (u_back, v_back, Co, Cm, Cx, Cy, Cz, Cb, Cmod,
+                       dx, dy, dz, rmsVr, upper_bc)
+
+        def ghost(field):
+            return da.overlap.overlap(
+                da.from_array(np.asarray(field), chunks=self.chunks,
+                              name=False), depth=self.depth,
+                boundary=self.boundary)
+
+        def ghost_masked(field):
+            return (ghost(np.ma.getdata(field)),
+                    ghost(np.ma.getmaskarray(field)))
+
+        static = {'vrs': [ghost_masked(vr) for vr in vrs],
+                  'azs': [ghost_masked(az) for az in azs],
+                  'els': [ghost_masked(el) for el in els],
+                  'wts': [ghost_masked(wt) for wt in wts],
+                  'weights': [ghost(weight) for weight in weights],
+                  'z': ghost(z)}
+        if(Cb > 0):
+            static['bg_weights'] = ghost(bg_weights)
+        if(Cmod > 0):
+            static['mod_weights'] = [ghost(weight) for weight in mod_weights]
+            static['u_model'] = [ghost_masked(u) for u in u_model]
+            static['v_model'] = [ghost_masked(v) for v in v_model]
+            static['w_model'] = [ghost_masked(w) for w in w_model]
+
+        # The blocks of the fields of each chunk, from y to x, are kept
+        # together in one persisted task, so the graph of each evaluation
+        # only has one input per chunk besides the winds.
+        self.num_chunks = (len(self.chunks[1]), len(self.chunks[2]))
+        static = _map_structure(lambda array: array.to_delayed(), static)
+        self.static_blocks = dask.persist(*[
+            dask.delayed(_map_structure(lambda blocks: blocks[0, j, k],
+                                        static))
+            for j in range(self.num_chunks[0])
+            for k in range(self.num_chunks[1])])
+        self.edges = [(j == 0, j == self.num_chunks[0] - 1, k == 0,
+                       k == self.num_chunks[1] - 1)
+                      for j in range(self.num_chunks[0])
+                      for k in range(self.num_chunks[1])]
+
+    def J_and_grad(self, winds, terms=None):
+        """
+        Calculates the cost function and its gradient. See
+        :py:func:`pydda.cost_functions.J_and_grad_J`.
+        """
+        import dask
+        import dask.array as da
+
+        winds = np.reshape(winds, (3,) + self.grid_shape)
+        blocks = da.overlap.overlap(
+            da.from_array(winds, chunks=((3,),) + self.chunks, name=False),
+            depth={0: 0, 1: 0, 2: HALO, 3: HALO},
+            boundary={0: 'none', 1: 'none', 2: 'periodic',
+                      3: 'periodic'}).to_delayed()[0, 0].flatten()
+        chunk_function = dask.delayed(_chunk_J_and_grad, pure=True)
+        results = dask.compute(*[
+            chunk_function(block, static, edges, HALO, self.params)
+            for block, static, edges in zip(blocks, self.static_blocks,
+                                            self.edges)])
+
+        the_terms = dict([(name, sum([result[0][name]
+                                      for result in results]))
+                          for name in results[0][0].keys()])
+        if terms is not None:
+            terms.update(the_terms)
+        grad = np.empty((3,) + self.grid_shape)
+        y_stops = np.cumsum(self.chunks[1])
+        x_stops = np.cumsum(self.chunks[2])
+        for i, (terms_chunk, grad_chunk) in enumerate(results):
+            j, k = divmod(i, self.num_chunks[1])
+            grad[:, :, y_stops[j] - self.chunks[1][j]:y_stops[j],
+                 x_stops[k] - self.chunks[2][k]:x_stops[k]] = grad_chunk
+        return sum(the_terms.values()), grad.flatten()
+
+
+def _map_structure(func, structure):
+    # Applies func to each array in nested dicts, lists and tuples
+    if isinstance(structure, dict):
+        return dict([(key, _map_structure(func, value))
+                     for key, value in structure.items()])
+    if isinstance(structure, (list, tuple)):
+        return type(structure)([_map_structure(func, value)
+                                for value in structure])
+    return func(structure)
@@ -1,7 +1,26 @@
 import numpy as np
-import pyart
 import scipy.ndimage.filters
 
+from .fall_speed import calculate_fall_speed
+from .packed import PackedObservations
+from .chunked import ChunkedCostFunction
+
+# calculate_fall_speed moved to fall_speed, and is still exported from
+# here so that code that imported it from this module keeps working
+__all__ = ['J_function', 'calculate_cost_terms', 'grad_J', 'J_and_grad_J',
+           'hessp', 'calculate_radial_vel_cost_function',
+           'calculate_grad_radial_vel', 'calculate_radial_vel_hessp',
+           'calculate_smoothness_cost', 'calculate_smoothness_gradient',
+           'calculate_smoothness_hessp', 'calculate_mass_continuity',
+           'calculate_mass_continuity_gradient',
+           'calculate_mass_continuity_hessp', 'calculate_background_cost',
+           'calculate_background_gradient', 'calculate_background_hessp',
+           'calculate_vertical_vorticity_cost',
+           'calculate_vertical_vorticity_gradient',
+           'calculate_vertical_vorticity_hessp', 'calculate_model_cost',
+           'calculate_model_gradient', 'calculate_model_hessp',
+           'calculate_fall_speed']
+
 
 def J_function(winds, vrs, azs, els, wts, u_back, v_back, u_model,
                v_model, w_model, Co, Cm, Cx, Cy, Cz, Cb, Cv, Cmod,
@@ -102,6 +121,42 @@ def J_function(winds, vrs, azs, els, wts, u_back, v_back, u_model,
     J: float
         The value of the cost function
     """
+    terms = calculate_cost_terms(
+        winds, vrs, azs, els, wts, u_back, v_back, u_model, v_model, w_model,
+        Co, Cm, Cx, Cy, Cz, Cb, Cv, Cmod, Ut, Vt, grid_shape, dx, dy, dz, z,
+        rmsVr, weights, bg_weights, model_weights, upper_bc)
+
+    if(print_out is True):
+        winds = np.reshape(winds,
+                           (3, grid_shape[0], grid_shape[1], grid_shape[2]))
+        print(('| Jvel    | Jmass   | Jsmooth |   Jbg   | Jvort   | Jmodel ' +
+               '| Max w  '))
+        print(('|' + "{:9.4f}".format(terms['Jvel']) + '|' +
+               "{:9.4f}".format(terms['Jmass']) + '|' +
+               "{:9.4f}".format(terms['Jsmooth']) + '|' +
+               "{:9.4f}".format(terms['Jbackground']) + '|' +
+               "{:9.4f}".format(terms['Jvorticity']) + '|' +
+               "{:9.4f}".format(terms['Jmod']) + '|' +
+               "{:9.4f}".format(np.abs(winds[2]).max())))
+
+    return sum(terms.values())
+
+
+def calculate_cost_terms(winds, vrs, azs, els, wts, u_back, v_back, u_model,
+                         v_model, w_model, Co, Cm, Cx, Cy, Cz, Cb, Cv, Cmod,
+                         Ut, Vt, grid_shape, dx, dy, dz, z, rmsVr, weights,
+                         bg_weights, model_weights, upper_bc):
+    """
+    Calculates the value of each term of the cost function. The parameters
+    are the same as for :py:func:`J_function`.
+
+    Returns
+    -------
+    terms: dict
+        The value of each term of the cost function. The keys are Jvel,
+        Jmass, Jsmooth, Jbackground, Jvorticity and Jmod. The total cost
+        function is the sum of these.
+    """
     winds = np.reshape(winds,
                        (3, grid_shape[0], grid_shape[1], grid_shape[2]))
 
@@ -140,18 +195,9 @@ def J_function(winds, vrs, azs, els, wts, u_back, v_back, u_model,
     else:
         Jmod = 0
 
-    if(print_out is True):
-        print(('| Jvel    | Jmass   | Jsmooth |   Jbg   | Jvort   | Jmodel ' +
-               '| Max w  '))
-        print(('|' + "{:9.4f}".format(Jvel) + '|' +
-               "{:9.4f}".format(Jmass) + '|' +
-               "{:9.4f}".format(Jsmooth) + '|' +
-               "{:9.4f}".format(Jbackground) + '|' +
-               "{:9.4f}".format(Jvorticity) + '|' +
-               "{:9.4f}".format(Jmod) + '|' +
-               "{:9.4f}".format(np.abs(winds[2]).max())))
-
-    return Jvel + Jmass + Jsmooth + Jbackground + Jvorticity + Jmod
+    return {'Jvel': Jvel, 'Jmass': Jmass, 'Jsmooth': Jsmooth,
+            'Jbackground': Jbackground, 'Jvorticity': Jvorticity,
+            'Jmod': Jmod}
 
 
 def grad_J(winds, vrs, azs, els, wts, u_back, v_back, u_model,
@@ -271,6 +317,144 @@ def grad_J(winds, vrs, azs, els, wts, u_back, v_back, u_model,
     return grad
 
 
+def J_and_grad_J(winds, vrs, azs, els, wts, u_back, v_back, u_model,
+                 v_model, w_model, Co, Cm, Cx, Cy, Cz, Cb, Cv, Cmod,
+                 Ut, Vt, grid_shape, dx, dy, dz, z, rmsVr, weights,
+                 bg_weights, model_weights, upper_bc, terms=None):
+    """
+    Calculates the cost function and its gradient in a single call. This is
+    what the optimizer in get_dd_wind_field uses. The intermediates that
+    the cost function and its gradient share, such as the residuals of the
+    radial velocities, the divergence and the Laplacians of the wind field,
+    are calculated once. The parameters are the same as for
+    :py:func:`J_function`, except that vrs may be a
+    :py:class:`ChunkedCostFunction`, which then evaluates both with dask.
+
+    Parameters
+    ----------
+    terms: dict or None
+        If this is a dict, it is updated with the value of each term of the
+        cost function, as returned by :py:func:`calculate_cost_terms`.
+
+    Returns
+    -------
+    J: float
+        The value of the cost function
+    grad: 1D float array
+        Gradient vector of cost function
+    """
+    if isinstance(vrs, ChunkedCostFunction):
+        return vrs.J_and_grad(winds, terms)
+
+    winds = np.reshape(winds,
+                       (3, grid_shape[0], grid_shape[1], grid_shape[2]))
+    u, v, w = winds
+    the_terms = {'Jvel': 0, 'Jmass': 0, 'Jsmooth': 0, 'Jbackground': 0,
+                 'Jvorticity': 0, 'Jmod': 0}
+
+    # The residuals of the radial velocities, the divergence, the
+    # Laplacians and the vorticity tendency are each calculated once for
+    # both the cost function and its gradient
+    the_terms['Jvel'], grad = _radial_vel_cost_and_gradient(
+        vrs, azs, els, u, v, w, wts, rmsVr, weights, coeff=Co,
+        upper_bc=upper_bc)
+
+    if(Cm > 0):
+        div2 = _divergence(u, v, w, z, dx, dy, dz)
+        the_terms['Jmass'] = Cm*np.sum(np.square(div2))/2.0
+        grad += _mass_continuity_gradient(div2, dx, dy, dz, Cm, upper_bc)
+
+    if(Cx > 0 or Cy > 0 or Cz > 0):
+        du, dv, dw = _laplacians(u, v, w)
+        the_terms['Jsmooth'] = np.sum(Cx*du**2 + Cy*dv**2 + Cz*dw**2)
+        grad += _smoothness_gradient(du, dv, dw, Cx, Cy, Cz, upper_bc)
+
+    if(Cb > 0):
+        the_terms['Jbackground'] = calculate_background_cost(
+            u, v, w, bg_weights, u_back, v_back, Cb)
+        grad += np.reshape(calculate_background_gradient(
+            u, v, w, bg_weights, u_back, v_back, Cb, upper_bc=upper_bc),
+            grad.shape)
+
+    if(Cv > 0):
+        the_terms['Jvorticity'], vorticity_grad = \
+            _vertical_vorticity_cost_and_gradient(
+                u, v, w, dx, dy, dz, Ut, Vt, coeff=Cv)
+        grad += vorticity_grad
+
+    if(Cmod > 0):
+        the_terms['Jmod'] = calculate_model_cost(
+            u, v, w, model_weights, u_model, v_model, w_model, coeff=Cmod)
+        grad += np.reshape(calculate_model_gradient(
+            u, v, w, model_weights, u_model, v_model, w_model, coeff=Cmod),
+            grad.shape)
+
+    if terms is not None:
+        terms.update(the_terms)
+    return sum(the_terms.values()), grad.flatten()
+
+
+def hessp(winds, p, vrs, azs, els, wts, u_back, v_back, u_model,
+          v_model, w_model, Co, Cm, Cx, Cy, Cz, Cb, Cv, Cmod,
+          Ut, Vt, grid_shape, dx, dy, dz, z, rmsVr, weights,
+          bg_weights, model_weights, upper_bc):
+    """
+    Calculates the product of the Hessian of the cost function with a
+    vector. This is the directional derivative of grad_J along p, so it is
+    what the Newton-Krylov solvers in get_dd_wind_field use. The other
+    parameters are the same as for :py:func:`J_function`.
+
+    All terms except for the vertical vorticity constraint are quadratic in
+    the wind field, so their Hessians are constant. The Hessian of the
+    vertical vorticity constraint is calculated from the tangent linear and
+    adjoint of the vorticity tendency. When upper_bc is True, the Hessian
+    is projected onto the vertical velocities that the impermeability
+    condition lets vary.
+
+    Parameters
+    ----------
+    winds: 1-D float array
+        The wind field, flattened to 1-D for f_min.
+    p: 1-D float array
+        The vector to multiply the Hessian with. This has the same shape
+        as winds.
+
+    Returns
+    -------
+    hess_p: 1D float array
+        The product of the Hessian of the cost function with p.
+    """
+    winds = np.reshape(winds,
+                       (3, grid_shape[0], grid_shape[1], grid_shape[2]))
+    p = np.reshape(p, (3, grid_shape[0], grid_shape[1], grid_shape[2]))
+    hess_p = calculate_radial_vel_hessp(
+        vrs, els, azs, p[0], p[1], p[2], wts, weights, rmsVr, coeff=Co,
+        upper_bc=upper_bc)
+
+    if(Cm > 0):
+        hess_p += calculate_mass_continuity_hessp(
+            p[0], p[1], p[2], z, dx, dy, dz, coeff=Cm, upper_bc=upper_bc)
+
+    if(Cx > 0 or Cy > 0 or Cz > 0):
+        hess_p += calculate_smoothness_hessp(
+            p[0], p[1], p[2], Cx=Cx, Cy=Cy, Cz=Cz, upper_bc=upper_bc)
+
+    if(Cb > 0):
+        hess_p += calculate_background_hessp(
+            p[0], p[1], p[2], bg_weights, Cb)
+
+    if(Cv > 0):
+        hess_p += calculate_vertical_vorticity_hessp(
+            winds[0], winds[1], winds[2], p[0], p[1], p[2], dx, dy, dz,
+            Ut, Vt, coeff=Cv)
+
+    if(Cmod > 0):
+        hess_p += calculate_model_hessp(
+            p[0], p[1], p[2], model_weights[:len(u_model)], coeff=Cmod)
+
+    return hess_p
+
+
 def calculate_radial_vel_cost_function(vrs, azs, els, u, v,
                                        w, wts, rmsVr, weights, coeff=1.0):
     """
@@ -283,8 +467,10 @@ def calculate_radial_vel_cost_function(vrs, azs, els, u, v,
 
     Parameters
     ----------
-    vrs: List of float arrays
-        List of radial velocities from each radar
+    vrs: List of float arrays or PackedObservations
+        List of radial velocities from each radar. If this is a
+        :py:class:`PackedObservations`, els, azs, wts and weights are
+        ignored.
     els: List of float arrays
         List of elevations from each radar
     azs: List of float arrays
@@ -323,6 +509,9 @@ def calculate_radial_vel_cost_function(vrs, azs, els, u, v,
     Technol., 26, 2089–2106, https://doi.org/10.1175/2009JTECHA1256.1
     """
 
+    if isinstance(vrs, PackedObservations):
+        return vrs.radial_vel_cost(u, v, w, rmsVr, coeff)
+
     J_o = 0
     lambda_o = coeff / (rmsVr * rmsVr)
     for i in range(len(vrs)):
@@ -350,8 +539,10 @@ def calculate_grad_radial_vel(vrs, els, azs, u, v, w,
 
     Parameters
     ----------
-    vrs: List of float arrays
-        List of radial velocities from each radar
+    vrs: List of float arrays or PackedObservations
+        List of radial velocities from each radar. If this is a
+        :py:class:`PackedObservations`, els, azs, wts and weights are
+        ignored.
     els: List of float arrays
         List of elevations from each radar
     azs: List of azimuths
@@ -384,57 +575,146 @@ def calculate_grad_radial_vel(vrs, els, azs, u, v, w,
 
     """
 
-    # Use zero for all masked values since we don't want to add them into
-    # the cost function
+    return _radial_vel_cost_and_gradient(
+        vrs, azs, els, u, v, w, wts, rmsVr, weights, coeff=coeff,
+        upper_bc=upper_bc)[1].flatten()
 
-    p_x1 = np.zeros(vrs[0].shape)
-    p_y1 = np.zeros(vrs[0].shape)
-    p_z1 = np.zeros(vrs[0].shape)
-    lambda_o = coeff / (rmsVr * rmsVr)
 
-    for i in range(len(vrs)):
-        v_ar = (np.cos(els[i])*np.sin(azs[i])*u +
-                np.cos(els[i])*np.cos(azs[i])*v +
-                np.sin(els[i])*(w - np.abs(wts[i])))
+def _radial_vel_cost_and_gradient(vrs, azs, els, u, v, w, wts, rmsVr,
+                                  weights, coeff=1.0, upper_bc=True):
+    # The radial velocity cost function and its gradient, with dimensions
+    # of (3, z, y, x), from the same residuals
+    if isinstance(vrs, PackedObservations):
+        return vrs.radial_vel_cost_and_gradient(u, v, w, rmsVr, coeff,
+                                                upper_bc)
 
-        x_grad = (2*(v_ar - vrs[i]) * np.cos(els[i]) *
-                  np.sin(azs[i]) * weights[i]) * lambda_o
-        y_grad = (2*(v_ar - vrs[i]) * np.cos(els[i]) *
-                  np.cos(azs[i]) * weights[i]) * lambda_o
-        z_grad = (2*(v_ar - vrs[i]) * np.sin(els[i]) * weights[i]) * lambda_o
-
-        x_grad[els[i].mask] = 0
-        y_grad[els[i].mask] = 0
-        z_grad[els[i].mask] = 0
-        x_grad[azs[i].mask] = 0
-        y_grad[azs[i].mask] = 0
-        z_grad[azs[i].mask] = 0
-
-        x_grad[els[i].mask] = 0
-        x_grad[azs[i].mask] = 0
-        x_grad[vrs[i].mask] = 0
-        x_grad[wts[i].mask] = 0
-        y_grad[els[i].mask] = 0
-        y_grad[azs[i].mask] = 0
-        y_grad[vrs[i].mask] = 0
-        y_grad[wts[i].mask] = 0
-        z_grad[els[i].mask] = 0
-        z_grad[azs[i].mask] = 0
-        z_grad[vrs[i].mask] = 0
-        z_grad[wts[i].mask] = 0
-
-        p_x1 += x_grad
-        p_y1 += y_grad
-        p_z1 += z_grad
+    J_o = 0
+    lambda_o = coeff / (rmsVr * rmsVr)
+    grad = np.zeros((3,) + np.shape(u))
+    for i in range(len(vrs)):
+        # Masked values are left out of the cost function and its gradient
+        mask = np.logical_or(np.ma.getmaskarray(vrs[i]),
+                             np.ma.getmaskarray(wts[i]))
+        mask = np.logical_or(mask, np.ma.getmaskarray(azs[i]))
+        mask = np.logical_or(mask, np.ma.getmaskarray(els[i]))
+        el = np.ma.filled(els[i], 0)
+        az = np.ma.filled(azs[i], 0)
+        cos_el = np.cos(el)
+        sin_el = np.sin(el)
+        sin_az = np.sin(az)
+        cos_az = np.cos(az)
+        v_ar = (cos_el*sin_az*u + cos_el*cos_az*v +
+                sin_el*(w - np.abs(np.ma.filled(wts[i], 0))))
+        residual = np.where(mask, 0, v_ar - np.ma.filled(vrs[i], 0))
+        weighted = residual*weights[i]
+        J_o += lambda_o*np.sum(residual*weighted)
+
+        weighted *= 2*lambda_o
+        horizontal = weighted*cos_el
+        grad[0] += horizontal*sin_az
+        grad[1] += horizontal*cos_az
+        grad[2] += weighted*sin_el
 
     # Impermeability condition
-    p_z1[0, :, :] = 0
+    grad[2, 0] = 0
     if(upper_bc is True):
-        p_z1[-1, :, :] = 0
-    y = np.stack((p_x1, p_y1, p_z1), axis=0)
+        grad[2, -1] = 0
+    return J_o, grad
+
+
+def calculate_radial_vel_hessp(vrs, els, azs, p_u, p_v, p_w, wts, weights,
+                               rmsVr, coeff=1.0, upper_bc=True):
+    """
+    Calculates the product of the Hessian of the radial velocity cost
+    function with a vector. The cost function is quadratic in the wind
+    field, so this does not depend on the wind field or on the radial
+    velocities. The masks of vrs and wts are still used to exclude points
+    from the cost function.
+
+    Parameters
+    ----------
+    vrs: List of float arrays or PackedObservations
+        List of radial velocities from each radar. If this is a
+        :py:class:`PackedObservations`, els, azs, wts and weights are
+        ignored.
+    els: List of float arrays
+        List of elevations from each radar
+    azs: List of float arrays
+        List of azimuths from each radar
+    p_u: Float array
+        Float array with u component of the vector
+    p_v: Float array
+        Float array with v component of the vector
+    p_w: Float array
+        Float array with w component of the vector
+    wts: List of float arrays
+        Float array containing fall speed from radar.
+    weights: n_radars x_bins x y_bins float array
+        Data weights for each pair of radars
+    rmsVr: float
+        The sum of squares of velocity/num_points. Use for normalization
+        of data weighting coefficient
+    coeff: float
+        Constant for cost function
+    upper_bc: bool
+        True to enforce w=0 at top of domain (impermeability condition)
+
+    Returns
+    -------
+    y: 1-D float array
+         Product of the Hessian of the observational cost function with the
+         vector.
+    """
+    if isinstance(vrs, PackedObservations):
+        return vrs.radial_vel_hessp(p_u, p_v, p_w, rmsVr, coeff, upper_bc)
+
+    p_w = _apply_impermeability(p_w, upper_bc)
+    hess_u = np.zeros(p_u.shape)
+    hess_v = np.zeros(p_u.shape)
+    hess_w = np.zeros(p_u.shape)
+    lambda_o = coeff / (rmsVr * rmsVr)
+
+    for i in range(len(vrs)):
+        mask = np.logical_or.reduce(
+            [np.ma.getmaskarray(els[i]), np.ma.getmaskarray(azs[i]),
+             np.ma.getmaskarray(vrs[i]), np.ma.getmaskarray(wts[i])])
+        cos_el = np.cos(np.ma.filled(els[i], 0))
+        sin_el = np.sin(np.ma.filled(els[i], 0))
+        sin_az = np.sin(np.ma.filled(azs[i], 0))
+        cos_az = np.cos(np.ma.filled(azs[i], 0))
+        p_ar = cos_el*sin_az*p_u + cos_el*cos_az*p_v + sin_el*p_w
+        p_ar = np.where(mask, 0, 2*lambda_o*p_ar*weights[i])
+        hess_u += p_ar*cos_el*sin_az
+        hess_v += p_ar*cos_el*cos_az
+        hess_w += p_ar*sin_el
+
+    hess_w = _apply_impermeability(hess_w, upper_bc)
+    y = np.stack((hess_u, hess_v, hess_w), axis=0)
     return y.flatten()
 
 
+def _apply_impermeability(w, upper_bc):
+    # Zero the vertical velocities that the impermeability condition holds
+    # fixed at the bottom and, if upper_bc is True, the top of the domain
+    w = np.array(w, copy=True)
+    w[0, :, :] = 0
+    if(upper_bc is True):
+        w[-1, :, :] = 0
+    return w
+
+
+def _laplacians(u, v, w):
+    # The Laplacian of each component of the wind field, with periodic
+    # boundaries
+    du = np.zeros(w.shape)
+    dv = np.zeros(w.shape)
+    dw = np.zeros(w.shape)
+    scipy.ndimage.filters.laplace(u, du, mode='wrap')
+    scipy.ndimage.filters.laplace(v, dv, mode='wrap')
+    scipy.ndimage.filters.laplace(w, dw, mode='wrap')
+    return du, dv, dw
+
+
 def calculate_smoothness_cost(u, v, w, Cx=1e-5, Cy=1e-5, Cz=1e-5):
     """
     Calculates the smoothness cost function by taking the Laplacian of the
@@ -463,12 +743,7 @@ def calculate_smoothness_cost(u, v, w, Cx=1e-5, Cy=1e-5, Cz=1e-5):
     Js: float
         value of smoothness cost function
     """
-    du = np.zeros(w.shape)
-    dv = np.zeros(w.shape)
-    dw = np.zeros(w.shape)
-    scipy.ndimage.filters.laplace(u, du, mode='wrap')
-    scipy.ndimage.filters.laplace(v, dv, mode='wrap')
-    scipy.ndimage.filters.laplace(w, dw, mode='wrap')
+    du, dv, dw = _laplacians(u, v, w)
     return np.sum(Cx*du**2 + Cy*dv**2 + Cz*dw**2)
 
 
@@ -501,15 +776,16 @@ def calculate_smoothness_gradient(u, v, w, Cx=1e-5, Cy=1e-5, Cz=1e-5,
     y: float array
         value of gradient of smoothness cost function
     """
-    du = np.zeros(w.shape)
-    dv = np.zeros(w.shape)
-    dw = np.zeros(w.shape)
-    grad_u = np.zeros(w.shape)
-    grad_v = np.zeros(w.shape)
-    grad_w = np.zeros(w.shape)
-    scipy.ndimage.filters.laplace(u, du, mode='wrap')
-    scipy.ndimage.filters.laplace(v, dv, mode='wrap')
-    scipy.ndimage.filters.laplace(w, dw, mode='wrap')
+    du, dv, dw = _laplacians(u, v, w)
+    return _smoothness_gradient(du, dv, dw, Cx, Cy, Cz, upper_bc).flatten()
+
+
+def _smoothness_gradient(du, dv, dw, Cx, Cy, Cz, upper_bc):
+    # The gradient of the smoothness cost function from the Laplacians of
+    # the wind field, with dimensions of (3, z, y, x)
+    grad_u = np.zeros(dw.shape)
+    grad_v = np.zeros(dw.shape)
+    grad_w = np.zeros(dw.shape)
     scipy.ndimage.filters.laplace(du, grad_u, mode='wrap')
     scipy.ndimage.filters.laplace(dv, grad_v, mode='wrap')
     scipy.ndimage.filters.laplace(dw, grad_w, mode='wrap')
@@ -518,8 +794,56 @@ def calculate_smoothness_gradient(u, v, w, Cx=1e-5, Cy=1e-5, Cz=1e-5,
     grad_w[0, :, :] = 0
     if(upper_bc is True):
         grad_w[-1, :, :] = 0
-    y = np.stack([grad_u*Cx*2, grad_v*Cy*2, grad_w*Cz*2], axis=0)
-    return y.flatten()
+    return np.stack([grad_u*Cx*2, grad_v*Cy*2, grad_w*Cz*2], axis=0)
+
+
+def calculate_smoothness_hessp(p_u, p_v, p_w, Cx=1e-5, Cy=1e-5, Cz=1e-5,
+                               upper_bc=True):
+    """
+    Calculates the product of the Hessian of the smoothness cost function
+    with a vector. The gradient of the smoothness cost function is linear in
+    the wind field, so this is the gradient evaluated at the vector.
+
+    Parameters
+    ----------
+    p_u: Float array
+        Float array with u component of the vector
+    p_v: Float array
+        Float array with v component of the vector
+    p_w: Float array
+        Float array with w component of the vector
+    Cx: float
+        Constant controlling smoothness in x-direction
+    Cy: float
+        Constant controlling smoothness in y-direction
+    Cz: float
+        Constant controlling smoothness in z-direction
+    upper_bc: bool
+        True to enforce w=0 at top of domain (impermeability condition)
+
+    Returns
+    -------
+    y: float array
+        Product of the Hessian of the smoothness cost function with the
+        vector.
+    """
+    p_w = _apply_impermeability(p_w, upper_bc)
+    return calculate_smoothness_gradient(p_u, p_v, p_w, Cx=Cx, Cy=Cy, Cz=Cz,
+                                         upper_bc=upper_bc)
+
+
+def _divergence(u, v, w, z, dx, dy, dz, anel=1):
+    # The anelastic divergence of the wind field
+    dudx = np.gradient(u, dx, axis=2)
+    dvdy = np.gradient(v, dy, axis=1)
+    dwdz = np.gradient(w, dz, axis=0)
+    if(anel == 1):
+        rho = np.exp(-z/10000.0)
+        drho_dz = np.gradient(rho, dz, axis=0)
+        anel_term = w/rho*drho_dz
+    else:
+        anel_term = 0
+    return dudx + dvdy + dwdz + anel_term
 
 
 def calculate_mass_continuity(u, v, w, z, dx, dy, dz, coeff=1500.0, anel=1):
@@ -556,17 +880,8 @@ def calculate_mass_continuity(u, v, w, z, dx, dy, dz, coeff=1500.0, anel=1):
     J: float
         value of mass continuity cost function
     """
-    dudx = np.gradient(u, dx, axis=2)
-    dvdy = np.gradient(v, dy, axis=1)
-    dwdz = np.gradient(w, dz, axis=0)
-
-    if(anel == 1):
-        rho = np.exp(-z/10000.0)
-        drho_dz = np.gradient(rho, dz, axis=0)
-        anel_term = w/rho*drho_dz
-    else:
-        anel_term = np.zeros(w.shape)
-    return coeff*np.sum(np.square(dudx + dvdy + dwdz + anel_term))/2.0
+    div2 = _divergence(u, v, w, z, dx, dy, dz, anel)
+    return coeff*np.sum(np.square(div2))/2.0
 
 
 def calculate_mass_continuity_gradient(u, v, w, z, dx,
@@ -604,18 +919,14 @@ def calculate_mass_continuity_gradient(u, v, w, z, dx,
     y: float array
         value of gradient of mass continuity cost function
     """
-    dudx = np.gradient(u, dx, axis=2)
-    dvdy = np.gradient(v, dy, axis=1)
-    dwdz = np.gradient(w, dz, axis=0)
-    if(anel == 1):
-        rho = np.exp(-z/10000.0)
-        drho_dz = np.gradient(rho, dz, axis=0)
-        anel_term = w/rho*drho_dz
-    else:
-        anel_term = 0
+    div2 = _divergence(u, v, w, z, dx, dy, dz, anel)
+    return _mass_continuity_gradient(div2, dx, dy, dz, coeff,
+                                     upper_bc).flatten()
 
-    div2 = dudx + dvdy + dwdz + anel_term
 
+def _mass_continuity_gradient(div2, dx, dy, dz, coeff, upper_bc):
+    # The gradient of the mass continuity cost function from the divergence
+    # of the wind field, with dimensions of (3, z, y, x)
     grad_u = -np.gradient(div2, dx, axis=2)*coeff
     grad_v = -np.gradient(div2, dy, axis=1)*coeff
     grad_w = -np.gradient(div2, dz, axis=0)*coeff
@@ -624,62 +935,50 @@ def calculate_mass_continuity_gradient(u, v, w, z, dx,
     grad_w[0, :, :] = 0
     if(upper_bc is True):
         grad_w[-1, :, :] = 0
-    y = np.stack([grad_u, grad_v, grad_w], axis=0)
-    return y.flatten()
+    return np.stack([grad_u, grad_v, grad_w], axis=0)
 
 
-def calculate_fall_speed(grid, refl_field=None, frz=4500.0):
+def calculate_mass_continuity_hessp(p_u, p_v, p_w, z, dx, dy, dz,
+                                    coeff=1500.0, anel=1, upper_bc=True):
     """
-    Estimates fall speed based on reflectivity.
-
-    Uses methodology of Mike Biggerstaff and Dan Betten
+    Calculates the product of the Hessian of the mass continuity cost
+    function with a vector. The gradient of the mass continuity cost
+    function is linear in the wind field, so this is the gradient evaluated
+    at the vector.
 
     Parameters
     ----------
-    Grid: Py-ART Grid
-        Py-ART Grid containing reflectivity to calculate fall speed from
-    refl_field: str
-        String containing name of reflectivity field. None will automatically
-        determine the name.
-    frz: float
-        Height of freezing level in m
+    p_u: Float array
+        Float array with u component of the vector
+    p_v: Float array
+        Float array with v component of the vector
+    p_w: Float array
+        Float array with w component of the vector
+    z: Float array (1D)
+        1D Float array with heights of grid
+    dx: float
+        Grid spacing in x direction.
+    dy: float
+        Grid spacing in y direction.
+    dz: float
+        Grid spacing in z direction.
+    coeff: float
+        Constant controlling contribution of mass continuity to cost function
+    anel: int
+        = 1 use anelastic approximation, 0=don't
+    upper_bc: bool
+        True to enforce w=0 at top of domain (impermeability condition)
 
     Returns
     -------
-    3D float array:
-        Float array of terminal velocities
-
-    """
-    # Parse names of velocity field
-    if refl_field is None:
-        refl_field = pyart.config.get_field_name('reflectivity')
-
-    refl = grid.fields[refl_field]['data']
-    grid_z = grid.point_z['data']
-    term_vel = np.zeros(refl.shape)
-    A = np.zeros(refl.shape)
-    B = np.zeros(refl.shape)
-    rho = np.exp(-grid_z/10000.0)
-    A[np.logical_and(grid_z < frz, refl < 55)] = -2.6
-    B[np.logical_and(grid_z < frz, refl < 55)] = 0.0107
-    A[np.logical_and(grid_z < frz,
-                     np.logical_and(refl >= 55, refl < 60))] = -2.5
-    B[np.logical_and(grid_z < frz,
-                     np.logical_and(refl >= 55, refl < 60))] = 0.013
-    A[np.logical_and(grid_z < frz, refl > 60)] = -3.95
-    B[np.logical_and(grid_z < frz, refl > 60)] = 0.0148
-    A[np.logical_and(grid_z >= frz, refl < 33)] = -0.817
-    B[np.logical_and(grid_z >= frz, refl < 33)] = 0.0063
-    A[np.logical_and(grid_z >= frz,
-                     np.logical_and(refl >= 33, refl < 49))] = -2.5
-    B[np.logical_and(grid_z >= frz,
-                     np.logical_and(refl >= 33, refl < 49))] = 0.013
-    A[np.logical_and(grid_z >= frz, refl > 49)] = -3.95
-    B[np.logical_and(grid_z >= frz, refl > 49)] = 0.0148
-
-    fallspeed = A*np.power(10, refl*B)*np.power(1.2/rho, 0.4)
-    del A, B, rho
-    return fallspeed
+    y: float array
+        Product of the Hessian of the mass continuity cost function with the
+        vector.
+    """
+    p_w = _apply_impermeability(p_w, upper_bc)
+    return calculate_mass_continuity_gradient(
+        p_u, p_v, p_w, z, dx, dy, dz, coeff=coeff, anel=anel,
+        upper_bc=upper_bc)
 
 
 def calculate_background_cost(u, v, w, weights, u_back, v_back, Cb=0.01):
@@ -718,7 +1017,8 @@ def calculate_background_cost(u, v, w, weights, u_back, v_back, Cb=0.01):
     return cost
 
 
-def calculate_background_gradient(u, v, w, weights, u_back, v_back, Cb=0.01):
+def calculate_background_gradient(u, v, w, weights, u_back, v_back, Cb=0.01,
+                                  upper_bc=True):
     """
     Calculates the gradient of the background cost function. For each u, v
     this is given as 2*coefficent*(analysis wind - background wind).
@@ -739,6 +1039,9 @@ def calculate_background_gradient(u, v, w, weights, u_back, v_back, Cb=0.01):
         Meridional winds vs height from sounding
     Cb: float
         Weight of background constraint to total cost function
+    upper_bc: bool
+        Not used, since the background constraint does not depend on w.
+        This is accepted for consistency with the other gradients.
 
     Returns
     -------
@@ -758,6 +1061,35 @@ def calculate_background_gradient(u, v, w, weights, u_back, v_back, Cb=0.01):
     return y.flatten()
 
 
+def calculate_background_hessp(p_u, p_v, p_w, weights, Cb=0.01):
+    """
+    Calculates the product of the Hessian of the background cost function
+    with a vector. For each u, v this is given as 2*coefficient*vector.
+
+    Parameters
+    ----------
+    p_u: Float array
+        Float array with u component of the vector
+    p_v: Float array
+        Float array with v component of the vector
+    p_w: Float array
+        Float array with w component of the vector
+    weights: Float array
+        Weights for each point to consider into cost function
+    Cb: float
+        Weight of background constraint to total cost function
+
+    Returns
+    -------
+    y: float array
+        Product of the Hessian of the background cost function with the
+        vector.
+    """
+    y = np.stack([Cb*2*p_u*weights, Cb*2*p_v*weights, np.zeros(p_w.shape)],
+                 axis=0)
+    return y.flatten()
+
+
 def calculate_vertical_vorticity_cost(u, v, w, dx, dy, dz, Ut, Vt,
                                       coeff=1e-5):
     """
@@ -803,22 +1135,8 @@ def calculate_vertical_vorticity_cost(u, v, w, dx, dy, dz, Ut, Vt,
     Equation in Variational Dual-Doppler Wind Analysis. J. Atmos. Oceanic
     Technol., 26, 2089–2106, https://doi.org/10.1175/2009JTECHA1256.1
     """
-    dvdz = np.gradient(v, dz, axis=0)
-    dudz = np.gradient(u, dz, axis=0)
-    dwdz = np.gradient(w, dx, axis=2)
-    dvdx = np.gradient(v, dx, axis=2)
-    dwdy = np.gradient(w, dy, axis=1)
-    dwdx = np.gradient(w, dx, axis=2)
-    dudx = np.gradient(u, dx, axis=2)
-    dvdy = np.gradient(v, dy, axis=2)
-    dudy = np.gradient(u, dy, axis=1)
-    zeta = dvdx - dudy
-    dzeta_dx = np.gradient(zeta, dx, axis=2)
-    dzeta_dy = np.gradient(zeta, dy, axis=1)
-    dzeta_dz = np.gradient(zeta, dz, axis=0)
-    jv_array = ((u - Ut) * dzeta_dx + (v - Vt) * dzeta_dy +
-                w * dzeta_dz + (dvdz * dwdx - dudz * dwdy) +
-                zeta * (dudx + dvdy))
+    derivs = _vorticity_derivatives(u, v, w, dx, dy, dz)
+    jv_array = _vorticity_tendency(u, v, w, derivs, Ut, Vt)
     return np.sum(coeff*jv_array**2)
 
 
@@ -826,8 +1144,8 @@ def calculate_vertical_vorticity_gradient(u, v, w, dx, dy, dz, Ut, Vt,
                                           coeff=1e-5):
     """
     Calculates the gradient of the cost function due to deviance from vertical
-    vorticity equation. This is done by taking the functional deriviative of
-    the vertical vorticity cost function.
+    vorticity equation. This is done by applying the adjoint of the
+    linearized vorticity tendency to the tendency.
 
     Parameters
     ----------
@@ -868,62 +1186,142 @@ def calculate_vertical_vorticity_gradient(u, v, w, dx, dy, dz, Ut, Vt,
     Technol., 26, 2089–2106, https://doi.org/10.1175/2009JTECHA1256.1
     """
 
-    # First derivatives
-    dvdz = np.gradient(v, dz, axis=0)
-    dudz = np.gradient(u, dz, axis=0)
-    dwdy = np.gradient(w, dy, axis=1)
-    dudx = np.gradient(u, dx, axis=2)
-    dvdy = np.gradient(v, dy, axis=2)
-    dwdx = np.gradient(w, dx, axis=2)
-    dvdx = np.gradient(v, dx, axis=2)
-    dwdx = np.gradient(w, dx, axis=2)
-    dudz = np.gradient(u, dz, axis=0)
-    dudy = np.gradient(u, dy, axis=1)
-
-    zeta = dvdx - dudy
-    dzeta_dx = np.gradient(zeta, dx, axis=2)
-    dzeta_dy = np.gradient(zeta, dy, axis=1)
-    dzeta_dz = np.gradient(zeta, dz, axis=0)
-
-    # Second deriviatives
-    dwdydz = np.gradient(dwdy, dz, axis=0)
-    dwdxdz = np.gradient(dwdx, dz, axis=0)
-    dudzdy = np.gradient(dudz, dy, axis=1)
-    dvdxdy = np.gradient(dvdx, dy, axis=1)
-    dudx2 = np.gradient(dudx, dx, axis=2)
-    dudxdy = np.gradient(dudx, dy, axis=1)
-    dudxdz = np.gradient(dudx, dz, axis=0)
-    dudy2 = np.gradient(dudx, dy, axis=1)
-
-    dzeta_dt = ((u - Ut)*dzeta_dx + (v - Vt)*dzeta_dy + w*dzeta_dz +
-                (dvdz*dwdx - dudz*dwdy) + zeta*(dudx + dvdy))
-
-    # Now we intialize our gradient value
-    u_grad = np.zeros(u.shape)
-    v_grad = np.zeros(v.shape)
-    w_grad = np.zeros(w.shape)
-
-    # Vorticity Advection
-    u_grad += dzeta_dx + (Ut - u)*dudxdy + (Vt - v)*dudxdy
-    v_grad += dzeta_dy + (Vt - v)*dvdxdy + (Ut - u)*dvdxdy
-    w_grad += dzeta_dz
-
-    # Tilting term
-    u_grad += dwdydz
-    v_grad += dwdxdz
-    w_grad += dudzdy - dudxdz
-
-    # Stretching term
-    u_grad += -dudxdy + dudy2 - dzeta_dx
-    u_grad += -dudx2 + dudxdy - dzeta_dy
-
-    # Multiply by 2*dzeta_dt according to chain rule
-    u_grad = u_grad*2*dzeta_dt*coeff
-    v_grad = v_grad*2*dzeta_dt*coeff
-    w_grad = w_grad*2*dzeta_dt*coeff
+    return _vertical_vorticity_cost_and_gradient(
+        u, v, w, dx, dy, dz, Ut, Vt, coeff)[1].flatten()
 
-    y = np.stack([u_grad, v_grad, w_grad], axis=0)
-    return y.flatten()
+
+def _vertical_vorticity_cost_and_gradient(u, v, w, dx, dy, dz, Ut, Vt,
+                                          coeff=1e-5):
+    # The vertical vorticity cost function and its gradient, with
+    # dimensions of (3, z, y, x), from the same vorticity tendency
+    derivs = _vorticity_derivatives(u, v, w, dx, dy, dz)
+    dzeta_dt = _vorticity_tendency(u, v, w, derivs, Ut, Vt)
+    grad = _vorticity_adjoint(u, v, w, derivs, Ut, Vt, 2*coeff*dzeta_dt,
+                              dx, dy, dz)
+    return np.sum(coeff*dzeta_dt**2), grad
+
+
+def _vorticity_derivatives(u, v, w, dx, dy, dz):
+    # The derivatives that the vorticity tendency is made of
+    zeta = np.gradient(v, dx, axis=2) - np.gradient(u, dy, axis=1)
+    return {'dudx': np.gradient(u, dx, axis=2),
+            'dvdy': np.gradient(v, dy, axis=2),
+            'dudz': np.gradient(u, dz, axis=0),
+            'dvdz': np.gradient(v, dz, axis=0),
+            'dwdx': np.gradient(w, dx, axis=2),
+            'dwdy': np.gradient(w, dy, axis=1),
+            'zeta': zeta,
+            'dzeta_dx': np.gradient(zeta, dx, axis=2),
+            'dzeta_dy': np.gradient(zeta, dy, axis=1),
+            'dzeta_dz': np.gradient(zeta, dz, axis=0)}
+
+
+def _vorticity_tendency(u, v, w, d, Ut, Vt):
+    # Advection, tilting and stretching of the vertical vorticity
+    return ((u - Ut)*d['dzeta_dx'] + (v - Vt)*d['dzeta_dy'] +
+            w*d['dzeta_dz'] + (d['dvdz']*d['dwdx'] - d['dudz']*d['dwdy']) +
+            d['zeta']*(d['dudx'] + d['dvdy']))
+
+
+def _vorticity_tangent(u, v, w, d, p_u, p_v, p_w, d_p, Ut, Vt):
+    # The change in the vorticity tendency along p. The tendency is
+    # quadratic in the winds, so this is symmetric in the winds and p.
+    return (p_u*d['dzeta_dx'] + (u - Ut)*d_p['dzeta_dx'] +
+            p_v*d['dzeta_dy'] + (v - Vt)*d_p['dzeta_dy'] +
+            p_w*d['dzeta_dz'] + w*d_p['dzeta_dz'] +
+            d_p['dvdz']*d['dwdx'] + d['dvdz']*d_p['dwdx'] -
+            d_p['dudz']*d['dwdy'] - d['dudz']*d_p['dwdy'] +
+            d_p['zeta']*(d['dudx'] + d['dvdy']) +
+            d['zeta']*(d_p['dudx'] + d_p['dvdy']))
+
+
+def _vorticity_adjoint(u, v, w, d, Ut, Vt, a, dx, dy, dz):
+    # The adjoint of _vorticity_tangent applied to a, with dimensions of
+    # (3, z, y, x)
+    zeta_adj = (_gradient_adjoint(a*(u - Ut), dx, 2) +
+                _gradient_adjoint(a*(v - Vt), dy, 1) +
+                _gradient_adjoint(a*w, dz, 0) +
+                a*(d['dudx'] + d['dvdy']))
+    u_adj = (a*d['dzeta_dx'] - _gradient_adjoint(a*d['dwdy'], dz, 0) +
+             _gradient_adjoint(a*d['zeta'], dx, 2) -
+             _gradient_adjoint(zeta_adj, dy, 1))
+    v_adj = (a*d['dzeta_dy'] + _gradient_adjoint(a*d['dwdx'], dz, 0) +
+             _gradient_adjoint(a*d['zeta'], dy, 2) +
+             _gradient_adjoint(zeta_adj, dx, 2))
+    w_adj = (a*d['dzeta_dz'] + _gradient_adjoint(a*d['dvdz'], dx, 2) -
+             _gradient_adjoint(a*d['dudz'], dy, 1))
+    return np.stack([u_adj, v_adj, w_adj], axis=0)
+
+
+def _gradient_adjoint(f, h, axis):
+    # The adjoint of np.gradient(f, h, axis=axis), which takes central
+    # differences inside the grid and one sided differences at the edges
+    f = np.moveaxis(f, axis, 0)
+    adj = np.zeros(f.shape)
+    adj[0] -= f[0]/h
+    adj[1] += f[0]/h
+    adj[:-2] -= f[1:-1]/(2*h)
+    adj[2:] += f[1:-1]/(2*h)
+    adj[-2] -= f[-1]/h
+    adj[-1] += f[-1]/h
+    return np.moveaxis(adj, 0, axis)
+
+
+def calculate_vertical_vorticity_hessp(u, v, w, p_u, p_v, p_w, dx, dy, dz,
+                                       Ut, Vt, coeff=1e-5):
+    """
+    Calculates the product of the Hessian of the vertical vorticity cost
+    function with a vector. This is the directional derivative of
+    :py:func:`calculate_vertical_vorticity_gradient` along the vector. It
+    is the adjoint of the linearized vorticity tendency applied to the
+    change in the tendency along the vector, plus the change in the
+    adjoint along the vector applied to the tendency.
+
+    Parameters
+    ----------
+    u: 3D array
+        Float array with u component of wind field
+    v: 3D array
+        Float array with v component of wind field
+    w: 3D array
+        Float array with w component of wind field
+    p_u: 3D array
+        Float array with u component of the vector
+    p_v: 3D array
+        Float array with v component of the vector
+    p_w: 3D array
+        Float array with w component of the vector
+    dx: float array
+        Spacing in x grid
+    dy: float array
+        Spacing in y grid
+    dz: float array
+        Spacing in z grid
+    Ut: float
+        U component of storm motion
+    Vt: float
+        V component of storm motion
+    coeff: float
+        Weighting coefficient
+
+    Returns
+    -------
+    y: 1D float array
+        Product of the Hessian of the vertical vorticity cost function with
+        the vector.
+    """
+    derivs = _vorticity_derivatives(u, v, w, dx, dy, dz)
+    p_derivs = _vorticity_derivatives(p_u, p_v, p_w, dx, dy, dz)
+    dzeta_dt = _vorticity_tendency(u, v, w, derivs, Ut, Vt)
+    dzeta_dt_p = _vorticity_tangent(u, v, w, derivs, p_u, p_v, p_w,
+                                    p_derivs, Ut, Vt)
+    # The adjoint is linear in the winds, so its change along p does not
+    # depend on the storm motion
+    hess_p = (_vorticity_adjoint(u, v, w, derivs, Ut, Vt,
+                                 2*coeff*dzeta_dt_p, dx, dy, dz) +
+              _vorticity_adjoint(p_u, p_v, p_w, p_derivs, 0, 0,
+                                 2*coeff*dzeta_dt, dx, dy, dz))
+    return hess_p.flatten()
 
 
 def calculate_model_cost(u, v, w, weights, u_model, v_model, w_model,
@@ -1012,3 +1410,39 @@ def calculate_model_gradient(u, v, w, weights, u_model,
 
     y = np.stack([u_grad, v_grad, w_grad], axis=0)
     return y.flatten()
+
+
+def calculate_model_hessp(p_u, p_v, p_w, weights, coeff=1.0):
+    """
+    Calculates the product of the Hessian of the model cost function with
+    a vector. For each u, v this is given as twice the vector times the sum
+    of the weights of each model.
+
+    Parameters
+    ----------
+    p_u: Float array
+        Float array with u component of the vector
+    p_v: Float array
+        Float array with v component of the vector
+    p_w: Float array
+        Float array with w component of the vector
+    weights: list of 3D float arrays
+        Weights for each point and each model to consider into cost function
+    coeff: float
+        Weight of model constraint to total cost function
+
+    Returns
+    -------
+    y: float array
+        Product of the Hessian of the model cost function with the vector.
+    """
+    the_shape = p_u.shape
+    u_hess = np.zeros(the_shape)
+    v_hess = np.zeros(the_shape)
+    w_hess = np.zeros(the_shape)
+    for i in range(len(weights)):
+        u_hess += coeff*2*p_u*weights[i]
+        v_hess += coeff*2*p_v*weights[i]
+
+    y = np.stack([u_hess, v_hess, w_hess], axis=0)
+    return y.flatten()
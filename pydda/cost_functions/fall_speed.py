@@ -0,0 +1,235 @@
+"""
+Fall speed parameterizations. Each parameterization relates the
+reflectivity to the fall speed of the hydrometeors at sea level with one
+or more power laws. The relations are evaluated with lookup tables that
+are calculated once, so estimating the fall speed for many microphysical
+assumptions is cheap.
+"""
+
+import weakref
+
+import numpy as np
+import pyart
+
+
+class FallSpeedRelation(object):
+    """
+    A relation between reflectivity and the fall speed at sea level that is
+    made of power laws of the form V = A * 10**(B * dBZ) over ranges of
+    reflectivity. The relation is evaluated by linear interpolation in a
+    lookup table with a uniform spacing, so each evaluation only needs a
+    few array operations and no powers.
+
+    Parameters
+    ----------
+    A: list of floats
+        The coefficient of each power law in m/s. Negative values are
+        downward.
+    B: list of floats
+        The exponent of each power law in 1/dBZ.
+    bins: list of floats
+        The reflectivities in dBZ where each power law after the first
+        starts. This has one less element than A and B. The jump between
+        two power laws is resolved to within the resolution of the table.
+    min_refl: float
+        The smallest reflectivity in the lookup table in dBZ. Smaller
+        reflectivities use the fall speed at min_refl.
+    max_refl: float
+        The largest reflectivity in the lookup table in dBZ. Larger
+        reflectivities use the fall speed at max_refl.
+    resolution: float
+        The spacing of the lookup table in dBZ.
+    """
+
+    def __init__(self, A, B, bins=(), min_refl=-40.0, max_refl=90.0,
+                 resolution=0.01):
+        if(len(A) != len(bins) + 1 or len(B) != len(bins) + 1):
+            raise ValueError('A and B must have one more element than bins!')
+
+        self.A = list(A)
+        self.B = list(B)
+        self.bins = list(bins)
+        self.min_refl = min_refl
+        self.resolution = resolution
+        num_points = int(round((max_refl - min_refl)/resolution)) + 1
+        self.table_refl = min_refl + resolution*np.arange(num_points)
+        regime = np.digitize(self.table_refl, self.bins)
+        A = np.asarray(A)[regime]
+        B = np.asarray(B)[regime]
+        self.table_speed = A*np.power(10, self.table_refl*B)
+        self._slope = np.diff(self.table_speed)
+
+    def __call__(self, refl):
+        """
+        Returns the fall speed at sea level in m/s for reflectivities in dBZ.
+        """
+        refl = np.asarray(refl, dtype=np.float64)
+        position = (refl - self.min_refl)*(1.0/self.resolution)
+        np.clip(position, 0, len(self.table_refl) - 1, out=position)
+        with np.errstate(invalid='ignore'):
+            index = position.astype(np.intp)
+        np.clip(index, 0, len(self._slope) - 1, out=index)
+        position -= index
+        speed = self.table_speed[index] + position*self._slope[index]
+        speed[np.isnan(refl)] = np.nan
+        return speed
+
+
+# The relations of Mike Biggerstaff and Dan Betten below and above the
+# freezing level. The single power law relations use the regimes of these
+# that correspond to each hydrometeor.
+FALL_SPEED_RELATIONS = {
+    'biggerstaff_liquid': FallSpeedRelation(
+        [-2.6, -2.5, -3.95], [0.0107, 0.013, 0.0148], [55.0, 60.0]),
+    'biggerstaff_ice': FallSpeedRelation(
+        [-0.817, -2.5, -3.95], [0.0063, 0.013, 0.0148], [33.0, 49.0]),
+    'rain': FallSpeedRelation([-2.6], [0.0107]),
+    'snow': FallSpeedRelation([-0.817], [0.0063]),
+    'graupel': FallSpeedRelation([-2.5], [0.013]),
+    'hail': FallSpeedRelation([-3.95], [0.0148])}
+
+# The relations to use below and above the freezing level for each
+# parameterization
+FALL_SPEED_PARAMETERIZATIONS = {
+    'biggerstaff': ('biggerstaff_liquid', 'biggerstaff_ice'),
+    'rain': ('rain', 'rain'),
+    'snow': ('snow', 'snow'),
+    'graupel': ('graupel', 'graupel'),
+    'hail': ('hail', 'hail')}
+
+# The relation for each class of the Py-ART semi-supervised hydrometeor
+# classification. Unclassified points use the relation of the
+# parameterization.
+HYDROMETEOR_RELATIONS = {
+    1: 'snow',      # Aggregates
+    2: 'snow',      # Ice crystals
+    3: 'rain',      # Light rain
+    4: 'graupel',   # Rimed particles
+    5: 'rain',      # Rain
+    6: 'snow',      # Vertically oriented ice
+    7: 'snow',      # Wet snow
+    8: 'hail',      # Melting hail
+    9: 'hail'}      # Ice hail and high density graupel
+
+_FALL_SPEED_CACHE = weakref.WeakKeyDictionary()
+
+
+def _get_relation(relation):
+    if isinstance(relation, FallSpeedRelation):
+        return relation
+    if relation not in FALL_SPEED_RELATIONS:
+        raise ValueError(('Unknown fall speed relation ' + str(relation) +
+                          '! Use one of ' +
+                          ', '.join(sorted(FALL_SPEED_RELATIONS.keys()))))
+    return FALL_SPEED_RELATIONS[relation]
+
+
+def calculate_fall_speed(grid, refl_field=None, frz=4500.0, use_cache=True,
+                         parameterization='biggerstaff', hydro_field=None,
+                         hydro_relations=None):
+    """
+    Estimates fall speed based on reflectivity.
+
+    By default, this uses the methodology of Mike Biggerstaff and Dan Betten.
+
+    Parameters
+    ----------
+    Grid: Py-ART Grid
+        Py-ART Grid containing reflectivity to calculate fall speed from
+    refl_field: str
+        String containing name of reflectivity field. None will automatically
+        determine the name.
+    frz: float
+        Height of freezing level in m
+    use_cache: bool
+        If True, the fall speed is cached for each Grid, reflectivity field,
+        freezing level and parameterization, so repeated retrievals on the
+        same Grid do not calculate it again. The cache is keyed on the
+        reflectivity array, so replace the data of the field rather than
+        editing it in place, or set this to False. The cached fall speed is
+        read only.
+    parameterization: str or 2-tuple
+        The fall speed relations to use below and above the freezing level.
+        This is either a key of FALL_SPEED_PARAMETERIZATIONS ('biggerstaff',
+        'rain', 'snow', 'graupel' or 'hail') or a tuple of two relations,
+        each of which is a key of FALL_SPEED_RELATIONS or a
+        :py:class:`FallSpeedRelation`.
+    hydro_field: str or None
+        The name of a hydrometeor classification field. If this is given,
+        the relation at each point is chosen by its hydrometeor class using
+        hydro_relations. Points with other classes use parameterization.
+    hydro_relations: dict or None
+        The relation (a key of FALL_SPEED_RELATIONS or a
+        :py:class:`FallSpeedRelation`) to use for each hydrometeor class.
+        None will use HYDROMETEOR_RELATIONS, which is for the classes of
+        pyart.retrieve.hydroclass_semisupervised.
+
+    Returns
+    -------
+    3D float array:
+        Float array of terminal velocities
+
+    """
+    # Parse names of velocity field
+    if refl_field is None:
+        refl_field = pyart.config.get_field_name('reflectivity')
+
+    if isinstance(parameterization, str):
+        if parameterization not in FALL_SPEED_PARAMETERIZATIONS:
+            raise ValueError((
+                'Unknown fall speed parameterization ' + parameterization +
+                '! Use one of ' +
+                ', '.join(sorted(FALL_SPEED_PARAMETERIZATIONS.keys()))))
+        relations = FALL_SPEED_PARAMETERIZATIONS[parameterization]
+    else:
+        relations = tuple(parameterization)
+    liquid = _get_relation(relations[0])
+    ice = _get_relation(relations[1])
+
+    refl = grid.fields[refl_field]['data']
+    hydro = None
+    hydro_key = None
+    if hydro_field is not None:
+        hydro = grid.fields[hydro_field]['data']
+        if hydro_relations is None:
+            hydro_relations = HYDROMETEOR_RELATIONS
+        hydro_key = tuple(sorted(hydro_relations.items(),
+                                 key=lambda item: item[0]))
+
+    key = (refl_field, float(frz), liquid, ice, hydro_field, hydro_key)
+    if(use_cache is True):
+        grid_cache = _FALL_SPEED_CACHE.setdefault(grid, {})
+        if(key in grid_cache and grid_cache[key][0] is refl and
+           grid_cache[key][1] is hydro):
+            return grid_cache[key][2]
+
+    fallspeed = np.empty(refl.shape)
+    refl_data = np.ma.getdata(refl)
+    z = grid.z['data']
+    rho_factor = np.power(1.2/np.exp(-z/10000.0), 0.4)
+    if hydro is not None:
+        classes = {}
+        for hydro_class, relation in hydro_relations.items():
+            classes.setdefault(_get_relation(relation), []).append(
+                hydro_class)
+        hydro_data = np.ma.filled(hydro, 0)
+
+    for k in range(refl.shape[0]):
+        if(z[k] < frz):
+            fallspeed[k] = liquid(refl_data[k])
+        else:
+            fallspeed[k] = ice(refl_data[k])
+        if hydro is not None:
+            for relation, hydro_classes in classes.items():
+                in_class = np.isin(hydro_data[k], hydro_classes)
+                fallspeed[k][in_class] = relation(refl_data[k][in_class])
+        fallspeed[k] *= rho_factor[k]
+
+    if isinstance(refl, np.ma.MaskedArray):
+        fallspeed = np.ma.MaskedArray(
+            fallspeed, mask=np.ma.getmaskarray(refl).copy(), copy=False)
+
+    if(use_cache is True):
+        fallspeed.flags.writeable = False
+        grid_cache[key] = (refl, hydro, fallspeed)
+    return fallspeed
@@ -0,0 +1,179 @@
+"""
+A compact representation of the radial velocity observations for the
+cost function. The geometry of each radar is stored in float32 and the
+validity of each observation is packed into uint8 weights or bit masks, so
+the masks of the input masked arrays do not have to be read again on every
+evaluation of the cost function.
+"""
+
+import numpy as np
+
+
+def _base_2d(field):
+    # The 2D level of a field that is broadcast over the vertical levels
+    if field.ndim == 3 and field.strides[0] == 0:
+        return field[0]
+    return field
+
+
+class PackedObservations(object):
+    """
+    The radial velocity observations of every radar with the validity of
+    each observation packed into uint8 weights or bit masks and the
+    coefficients of the observation operator stored in float32. The
+    radial velocity cost function, its gradient and its Hessian-vector
+    product use this in place of the lists of masked arrays when it is
+    given as vrs.
+
+    Parameters
+    ----------
+    vrs: List of float arrays
+        List of radial velocities from each radar
+    azs: List of float arrays
+        List of azimuths from each radar in radians
+    els: List of float arrays
+        List of elevations from each radar in radians
+    wts: List of float arrays
+        List of fall speeds from each radar
+    weights: n_radars by z_bins by y_bins by x_bins float array
+        Data weights for each radar. Points with a weight greater than 0
+        are used if none of the inputs are masked there.
+    bit_masks: bool
+        True to pack the validity of each observation into 1 bit instead
+        of 1 byte. This is unpacked on each evaluation.
+    """
+
+    def __init__(self, vrs, azs, els, wts, weights, bit_masks=False):
+        self.shape = vrs[0].shape
+        self.num_radars = len(vrs)
+        self.bit_masks = bit_masks
+        self.sin_az = []
+        self.cos_az = []
+        self.sin_el = []
+        self.cos_el = []
+        self.rhs = []
+        self.valid = []
+        for i in range(self.num_radars):
+            az = _base_2d(azs[i])
+            el = _base_2d(els[i])
+            valid = np.logical_not(np.logical_or.reduce(
+                [np.ma.getmaskarray(vrs[i]), np.ma.getmaskarray(wts[i]),
+                 np.broadcast_to(np.ma.getmaskarray(az), self.shape),
+                 np.broadcast_to(np.ma.getmaskarray(el), self.shape)]))
+            valid = np.logical_and(valid, np.asarray(weights[i]) > 0)
+
+            az = np.ma.filled(az, 0)
+            el = np.ma.filled(el, 0)
+            self.sin_az.append(np.sin(az).astype(np.float32))
+            self.cos_az.append(np.cos(az).astype(np.float32))
+            self.sin_el.append(np.sin(el).astype(np.float32))
+            self.cos_el.append(np.cos(el).astype(np.float32))
+
+            # The fall speed is moved to the observation side, so that
+            # the observation operator is linear in the winds.
+            rhs = (np.ma.filled(vrs[i], 0) +
+                   np.sin(el)*np.abs(np.ma.filled(wts[i], 0)))
+            self.rhs.append(np.where(valid, rhs, 0).astype(np.float32))
+            if(bit_masks is True):
+                self.valid.append(np.packbits(valid, axis=None))
+            else:
+                self.valid.append(valid.astype(np.uint8))
+
+    @property
+    def nbytes(self):
+        """ The number of bytes used by the packed observations. """
+        return sum([array.nbytes for arrays in
+                    [self.sin_az, self.cos_az, self.sin_el, self.cos_el,
+                     self.rhs, self.valid] for array in arrays])
+
+    def get_valid(self, i):
+        """ Returns the uint8 validity of the observations of radar i. """
+        if(self.bit_masks is True):
+            return np.unpackbits(
+                self.valid[i], count=int(np.prod(self.shape))).reshape(
+                    self.shape)
+        return self.valid[i]
+
+    def get_coverage(self):
+        """ Returns the number of radars with a valid observation. """
+        coverage = np.zeros(self.shape)
+        for i in range(self.num_radars):
+            coverage += self.get_valid(i)
+        return coverage
+
+    def _project(self, i, u, v, w):
+        # The component of the wind along the beam of radar i
+        return (self.cos_el[i]*(self.sin_az[i]*u + self.cos_az[i]*v) +
+                self.sin_el[i]*w)
+
+    def _add_back_projection(self, i, residual, grad_u, grad_v, grad_w):
+        horizontal = residual*self.cos_el[i]
+        grad_u += horizontal*self.sin_az[i]
+        grad_v += horizontal*self.cos_az[i]
+        grad_w += residual*self.sin_el[i]
+
+    def radial_vel_cost(self, u, v, w, rmsVr, coeff=1.0):
+        """
+        Calculates the radial velocity cost function. See
+        :py:func:`pydda.cost_functions.calculate_radial_vel_cost_function`.
+        """
+        J_o = 0
+        lambda_o = coeff / (rmsVr * rmsVr)
+        for i in range(self.num_radars):
+            residual = self._project(i, u, v, w) - self.rhs[i]
+            J_o += lambda_o*np.sum(np.square(residual)*self.get_valid(i))
+        return J_o
+
+    def radial_vel_gradient(self, u, v, w, rmsVr, coeff=1.0, upper_bc=True):
+        """
+        Calculates the gradient of the radial velocity cost function. See
+        :py:func:`pydda.cost_functions.calculate_grad_radial_vel`.
+        """
+        return self.radial_vel_cost_and_gradient(
+            u, v, w, rmsVr, coeff, upper_bc)[1].flatten()
+
+    def radial_vel_cost_and_gradient(self, u, v, w, rmsVr, coeff=1.0,
+                                     upper_bc=True):
+        """
+        Calculates the radial velocity cost function and its gradient from
+        the same residuals. The gradient has dimensions of (3, z, y, x).
+        """
+        J_o = 0
+        lambda_o = coeff / (rmsVr * rmsVr)
+        grad = np.zeros((3,) + self.shape)
+        for i in range(self.num_radars):
+            residual = self._project(i, u, v, w) - self.rhs[i]
+            residual *= self.get_valid(i)
+            J_o += lambda_o*np.sum(np.square(residual))
+            residual *= 2*lambda_o
+            self._add_back_projection(i, residual, grad[0], grad[1],
+                                      grad[2])
+
+        # Impermeability condition
+        grad[2, 0] = 0
+        if(upper_bc is True):
+            grad[2, -1] = 0
+        return J_o, grad
+
+    def radial_vel_hessp(self, p_u, p_v, p_w, rmsVr, coeff=1.0,
+                         upper_bc=True):
+        """
+        Calculates the product of the Hessian of the radial velocity cost
+        function with a vector. See
+        :py:func:`pydda.cost_functions.calculate_radial_vel_hessp`.
+        """
+        lambda_o = coeff / (rmsVr * rmsVr)
+        p_w = np.array(p_w, copy=True)
+        p_w[0] = 0
+        if(upper_bc is True):
+            p_w[-1] = 0
+        hess = np.zeros((3,) + self.shape)
+        for i in range(self.num_radars):
+            p_ar = self._project(i, p_u, p_v, p_w)
+            p_ar *= 2*lambda_o*self.get_valid(i)
+            self._add_back_projection(i, p_ar, hess[0], hess[1], hess[2])
+
+        hess[2, 0] = 0
+        if(upper_bc is True):
+            hess[2, -1] = 0
+        return hess.flatten()
@@ -24,6 +24,8 @@ from scipy.interpolate import RegularGridInterpolator, interp1d, griddata
 from scipy.interpolate import NearestNDInterpolator
 from copy import deepcopy
 
+from ..constraints.model_data import _interpolate_era_to_grid
+
 
 def make_initialization_from_era_interim(Grid, file_name=None, vel_field=None):
     """
@@ -31,8 +33,9 @@ def make_initialization_from_era_interim(Grid, file_name=None, vel_field=None):
     to the Py-ART grid specified by Grid. PyDDA will automatically download
     the ERA Interim data that you need for the scan. It will chose the domain
     that is enclosed by the analysis grid and the time period that is closest
-    to the scan. It will then do a Nearest Neighbor interpolation of the
-    ERA-Interim u and v winds to the analysis grid.
+    to the scan. It will then interpolate the ERA-Interim u and v winds
+    linearly in height in each column and then bilinearly in latitude and
+    longitude to the analysis grid.
 
     You need to have the ECMWF API and an ECMWF account set up in order to
     use this feature. Go to this website for instructions on installing the
@@ -139,35 +142,10 @@ def make_initialization_from_era_interim(Grid, file_name=None, vel_field=None):
     w_ERA = ERA_grid.variables["w"][:]
     lon_ERA = ERA_grid.variables["longitude"][:]
     lat_ERA = ERA_grid.variables["latitude"][:]
-    radar_grid_lat = Grid.point_latitude['data']
-    radar_grid_lon = Grid.point_longitude['data']
-    radar_grid_alt = Grid.point_z['data']
-    u_flattened = u_ERA[time_step].flatten()
-    v_flattened = v_ERA[time_step].flatten()
-    w_flattened = w_ERA[time_step].flatten()
-
-    the_shape = u_ERA.shape
-    lon_mgrid, lat_mgrid = np.meshgrid(lon_ERA, lat_ERA)
-
-    lon_mgrid = np.tile(lon_mgrid, (the_shape[1], 1, 1))
-    lat_mgrid = np.tile(lat_mgrid, (the_shape[1], 1, 1))
-    lon_flattened = lon_mgrid.flatten()
-    lat_flattened = lat_mgrid.flatten()
-    height_flattened = height_ERA[time_step].flatten()
-    height_flattened -= Grid.radar_altitude["data"]
-
-    u_interp = NearestNDInterpolator(
-        (height_flattened, lat_flattened, lon_flattened),
-        u_flattened, rescale=True)
-    v_interp = NearestNDInterpolator(
-        (height_flattened, lat_flattened, lon_flattened),
-        v_flattened, rescale=True)
-    w_interp = NearestNDInterpolator(
-        (height_flattened, lat_flattened, lon_flattened),
-        w_flattened, rescale=True)
-    u_new = u_interp(radar_grid_alt, radar_grid_lat, radar_grid_lon)
-    v_new = v_interp(radar_grid_alt, radar_grid_lat, radar_grid_lon)
-    w_new = w_interp(radar_grid_alt, radar_grid_lat, radar_grid_lon)
+    height_ERA = height_ERA[time_step] - Grid.radar_altitude["data"]
+    u_new, v_new, w_new = _interpolate_era_to_grid(
+        Grid, height_ERA, [u_ERA[time_step], v_ERA[time_step],
+                           w_ERA[time_step]], lat_ERA, lon_ERA)
 
     # Free up memory
     ERA_grid.close()
@@ -18,9 +18,28 @@ how to call these functions.
     get_dd_wind_field
     get_dd_wind_field_nested
     get_bca
+    get_active_set
+    add_cached_geometry_as_fields
+    get_cached_bca
+    WindRetrievalResult
+    low_pass_filter
+    regrid_separable
+    MemorySink
+    LoggingSink
+    JSONLinesSink
+    RetrievalProfile
 
 """
 
 from .wind_retrieve import get_dd_wind_field
 from .wind_retrieve import get_bca
+from .wind_retrieve import get_active_set
+from .geometry_cache import add_cached_geometry_as_fields
+from .geometry_cache import get_cached_bca
+from .result import WindRetrievalResult
+from .filters import low_pass_filter
+from .interpolation import regrid_separable
+from . import telemetry
+from .telemetry import MemorySink, LoggingSink, JSONLinesSink
+from .profiling import RetrievalProfile
 from .nesting import get_dd_wind_field_nested
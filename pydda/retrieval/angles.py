@@ -73,10 +73,35 @@ def _add_field_to_object(
     return radar
 
 
+def _broadcast_masked_invalid(field, shape):
+    # Broadcast a 2D field over the vertical levels without copying it
+    mask = ~np.isfinite(field)
+    return np.ma.MaskedArray(np.broadcast_to(field, shape),
+                             mask=np.broadcast_to(mask, shape), copy=False)
+
+
+def _unbroadcast(field):
+    # Returns the 2D field that a field from _broadcast_masked_invalid views
+    if field.ndim == 3 and field.strides[0] == 0:
+        return field[0]
+    return field
+
+
+def _deg2rad(field):
+    # Convert a field to radians, keeping broadcast fields as views
+    base = _unbroadcast(field)
+    if base is field:
+        return field*np.pi/180
+    return _broadcast_masked_invalid(
+        np.ma.filled(base, np.nan)*np.pi/180, field.shape)
+
+
 def add_azimuth_as_field(grid, dz_name='DT', az_name='AZ', bad=-32768):
     """
     Add azimuth field to a Py-ART Grid object. The bearing to each gridpoint
     is computed using the Haversine method and Great Circle approximation.
+    The azimuth does not depend on height, so the field is a read-only
+    view of a single level that is broadcast over all vertical levels.
 
     Parameters
     ----------
@@ -94,11 +119,11 @@ def add_azimuth_as_field(grid, dz_name='DT', az_name='AZ', bad=-32768):
     grid : Py-ART Grid object
         Output Grid object with azimuth field added.
     """
+    lon, lat = grid.get_point_longitude_latitude(level=0)
     az = gc_bear_array(
         grid.radar_latitude['data'][0], grid.radar_longitude['data'][0],
-        grid.point_latitude['data'], grid.point_longitude['data'])
-    cond = np.isfinite(az)
-    az = np.ma.masked_invalid(az)
+        lat, lon)
+    az = _broadcast_masked_invalid(az, (grid.nz, grid.ny, grid.nx))
     grid = _add_field_to_object(grid, az, dz_name=dz_name, field_name=az_name)
     return grid
 
@@ -109,6 +134,8 @@ def add_elevation_as_field(grid, dz_name='DT', el_name='EL', bad=-32768):
     gridpoint is computed using the standard radar beam propagation
     equation. Grid is assumed to reference against 0 m MSL,
     *not* AGL. Ground range computed using the Haversine method.
+    The ground range is only calculated on one level and is broadcast
+    against the heights of the vertical levels.
 
     Parameters
     ----------
@@ -126,14 +153,13 @@ def add_elevation_as_field(grid, dz_name='DT', el_name='EL', bad=-32768):
     grid : Py-ART Grid object
         Output Grid object with elevation field added.
     """
+    lon, lat = grid.get_point_longitude_latitude(level=0)
     gr = gc_dist(
         grid.radar_latitude['data'][0], grid.radar_longitude['data'][0],
-        grid.point_latitude['data'], grid.point_longitude['data'])
-    h3 = 0.0 * gr
-    for i in range(len(grid.z['data'])):
-        h3[i, :, :] = grid.z['data'][i] - grid.radar_altitude['data'][0]
-    sr, el = rsl_get_slantr_and_elev(gr, h3/1000.0)
-    cond = np.isfinite(el)
+        lat, lon)
+    h = grid.z['data'] - grid.radar_altitude['data'][0]
+    sr, el = rsl_get_slantr_and_elev(
+        gr[np.newaxis, :, :], h[:, np.newaxis, np.newaxis]/1000.0)
     el = np.ma.masked_invalid(el)
     grid = _add_field_to_object(grid, el, dz_name=dz_name, field_name=el_name)
     return grid
@@ -0,0 +1,221 @@
+"""
+Executors that run the tiles of a nested retrieval. Each executor sends
+the inputs of the tiles to its workers with scatter, submits the
+retrieval of each tile with submit and collects the results with gather,
+so :py:func:`pydda.retrieval.get_dd_wind_field_nested` does not depend
+on where the tiles run. is_lost tells the tasks that were lost with their
+workers from the tasks that failed. The arguments of submit may be
+futures, or lists of futures, of earlier tasks. dask distributed is only
+imported when it is used.
+"""
+
+import concurrent.futures
+
+from concurrent.futures.process import BrokenProcessPool
+
+# BrokenExecutor was added in Python 3.7. On older versions only a
+# process pool can break.
+_BrokenExecutor = getattr(concurrent.futures, 'BrokenExecutor',
+                          BrokenProcessPool)
+
+
+def _resolve_futures(args):
+    # Replaces the futures in args, and in lists in args, by their results
+    resolved = []
+    for arg in args:
+        if isinstance(arg, concurrent.futures.Future):
+            arg = arg.result()
+        elif isinstance(arg, list):
+            arg = _resolve_futures(arg)
+        resolved.append(arg)
+    return resolved
+
+
+class DaskExecutor(object):
+    """
+    Runs tiles on a dask distributed cluster. The inputs are scattered to
+    the workers once, so they are not sent again with every task.
+
+    Parameters
+    ----------
+    client: dask distributed Client
+        The Client that is linked to the cluster.
+    retries: int
+        The number of times to rerun a task that fails, such as when its
+        worker is lost.
+    """
+
+    def __init__(self, client, retries=0):
+        self.client = client
+        self.retries = retries
+
+    def scatter(self, data):
+        """ Sends each element of the list data to the workers. """
+        return self.client.scatter(data, hash=False)
+
+    def submit(self, func, *args):
+        """
+        Runs func(*args) on a worker and returns a future. The task waits on
+        the workers for the futures in args, so the driver does not block.
+        """
+        return self.client.submit(func, *args, pure=False,
+                                  retries=self.retries)
+
+    def gather(self, futures, errors='raise'):
+        """
+        Waits for the futures and returns their results. With
+        errors='return', the exception of a failed future is returned in
+        place of its result.
+        """
+        from distributed import wait
+
+        wait(futures)
+        if(errors == 'return'):
+            return [future.exception() if future.status == 'error'
+                    else future.result() for future in futures]
+        return self.client.gather(futures)
+
+    def is_lost(self, error):
+        """
+        Whether error means that the task was lost along with its retries,
+        such as when its worker died, rather than that the task failed.
+        """
+        from distributed import KilledWorker
+
+        return isinstance(error, (KilledWorker,
+                                  concurrent.futures.CancelledError))
+
+    def shutdown(self):
+        """ The Client is owned by the caller, so it is not closed. """
+        pass
+
+
+class FuturesExecutor(object):
+    """
+    Runs tiles on a :py:class:`concurrent.futures.Executor`, such as a
+    ProcessPoolExecutor or a ThreadPoolExecutor. Only the inputs of each
+    tile are pickled for a process pool, and nothing is copied for a
+    thread pool.
+
+    Parameters
+    ----------
+    pool: concurrent.futures.Executor
+        The pool to run the tiles on.
+    owns_pool: bool
+        True to shut down the pool in :py:meth:`shutdown`.
+    """
+
+    def __init__(self, pool, owns_pool=False):
+        self.pool = pool
+        self.owns_pool = owns_pool
+
+    def scatter(self, data):
+        """ The inputs are sent with each task, so they are kept here. """
+        return data
+
+    def submit(self, func, *args):
+        """
+        Runs func(*args) in the pool and returns a future. The futures in
+        args are waited for here, since the pool cannot chain tasks, so
+        the error of a failed future in args is raised here.
+        """
+        return self.pool.submit(func, *_resolve_futures(args))
+
+    def gather(self, futures, errors='raise'):
+        """
+        Waits for the futures and returns their results. With
+        errors='return', the exception of a failed future is returned in
+        place of its result.
+        """
+        results = []
+        for future in futures:
+            if(errors == 'return' and future.exception() is not None):
+                results.append(future.exception())
+            else:
+                results.append(future.result())
+        return results
+
+    def is_lost(self, error):
+        """
+        Whether error means that the task was lost, such as when a process
+        of the pool died, rather than that the task failed.
+        """
+        return isinstance(error, (_BrokenExecutor,
+                                  concurrent.futures.CancelledError))
+
+    def shutdown(self):
+        """ Shuts down the pool if it was made by this executor. """
+        if self.owns_pool:
+            self.pool.shutdown()
+
+
+class SerialExecutor(FuturesExecutor):
+    """
+    Runs each tile in the calling process when it is submitted. This is
+    useful for debugging and for machines where one retrieval already
+    uses all of the cores.
+    """
+
+    def __init__(self):
+        FuturesExecutor.__init__(self, None)
+
+    def submit(self, func, *args):
+        """ Runs func(*args) now and returns a finished future. """
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(func(*_resolve_futures(args)))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+
+EXECUTORS = ['dask', 'process', 'thread', 'serial']
+
+
+def get_executor(executor=None, client=None, num_workers=None, retries=0):
+    """
+    Makes the executor that runs the tiles of a nested retrieval.
+
+    Parameters
+    ----------
+    executor: str or None
+        'dask' to use client, 'process' for a ProcessPoolExecutor,
+        'thread' for a ThreadPoolExecutor or 'serial' to run the tiles
+        one after the other in this process. None uses 'dask' if client
+        is given and 'process' otherwise.
+    client: dask distributed Client, concurrent.futures.Executor or None
+        The Client to use for 'dask'. A concurrent.futures.Executor is
+        used as is when executor is None.
+    num_workers: int or None
+        The number of workers of the pool for 'process' and 'thread'.
+        None uses the default of concurrent.futures.
+    retries: int
+        The number of times dask reruns a failed task. The local pools do
+        not rerun tasks.
+
+    Returns
+    -------
+    executor: DaskExecutor, FuturesExecutor or SerialExecutor
+        The executor. Call its shutdown method when done.
+    """
+    if executor is None:
+        if isinstance(client, concurrent.futures.Executor):
+            return FuturesExecutor(client)
+        executor = 'process' if client is None else 'dask'
+
+    if executor not in EXECUTORS:
+        raise ValueError('executor must be one of ' + ', '.join(EXECUTORS) +
+                         '!')
+
+    if executor == 'dask':
+        if client is None:
+            raise ValueError('A dask distributed Client is needed for the ' +
+                             'dask executor!')
+        return DaskExecutor(client, retries=retries)
+    elif executor == 'process':
+        return FuturesExecutor(concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_workers), owns_pool=True)
+    elif executor == 'thread':
+        return FuturesExecutor(concurrent.futures.ThreadPoolExecutor(
+            max_workers=num_workers), owns_pool=True)
+    return SerialExecutor()
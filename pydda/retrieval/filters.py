@@ -0,0 +1,140 @@
+"""
+Low pass filters that are applied to the retrieved wind field between
+the optimization passes of :py:func:`pydda.retrieval.get_dd_wind_field`.
+All of the filters are separable, so they are applied one axis at a time
+with buffers that are reused between the axes.
+"""
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from scipy.ndimage import convolve1d, gaussian_filter1d
+from scipy.signal import savgol_coeffs
+
+
+def _savgol_operators(window, order):
+    # The interior coefficients and the operators that fit a polynomial to
+    # the first and last window of points, like savgol_filter(mode='interp')
+    half = window // 2
+    t = np.arange(window, dtype=np.float64)
+    vander = np.vander(t, order + 1, increasing=True)
+    projection = np.dot(vander, np.linalg.pinv(vander))
+    return (savgol_coeffs(window, order), projection[:half],
+            projection[window - half:])
+
+
+def _savgol_axis(x, out, axis, window, order):
+    window = min(window, x.shape[axis])
+    if window % 2 == 0:
+        window = window - 1
+    if window <= order:
+        out[...] = x
+        return out
+
+    coeffs, left, right = _savgol_operators(window, order)
+    convolve1d(x, coeffs, axis=axis, output=out, mode='constant')
+    x_view = np.moveaxis(x, axis, -1)
+    out_view = np.moveaxis(out, axis, -1)
+    out_view[..., :left.shape[0]] = np.dot(x_view[..., :window], left.T)
+    out_view[..., -right.shape[0]:] = np.dot(x_view[..., -window:], right.T)
+    return out
+
+
+def _gaussian_axis(x, out, axis, sigma):
+    gaussian_filter1d(x, sigma, axis=axis, output=out, mode='nearest')
+    return out
+
+
+def _filter_component(x, out, tmp, axis_filter):
+    # Alternate between the output and scratch buffers so that the
+    # result of the last axis ends up in out.
+    axis_filter(x, out, 0)
+    axis_filter(out, tmp, 1)
+    axis_filter(tmp, out, 2)
+    return out
+
+
+def _spectral_filter(winds, window):
+    # Remove all wavelengths shorter than window grid points from each
+    # component. This assumes that the wind field is periodic.
+    shape = winds.shape[1:]
+    spectrum = np.fft.rfftn(winds, axes=(1, 2, 3))
+    k0 = np.fft.fftfreq(shape[0])
+    k1 = np.fft.fftfreq(shape[1])
+    k2 = np.fft.rfftfreq(shape[2])
+    k = np.sqrt(k0[:, np.newaxis, np.newaxis]**2 +
+                k1[np.newaxis, :, np.newaxis]**2 +
+                k2[np.newaxis, np.newaxis, :]**2)
+    spectrum[:, k > 1.0/window] = 0
+    return np.fft.irfftn(spectrum, s=shape, axes=(1, 2, 3))
+
+
+def low_pass_filter(winds, filter_type='savgol', window=9, order=3,
+                    sigma=None, num_threads=1):
+    """
+    Applies a separable low pass filter along all three spatial axes of
+    each component of the wind field.
+
+    Parameters
+    ----------
+    winds: 4D float array
+        The wind field with shape (3, nz, ny, nx). winds[0] is u, winds[1]
+        is v and winds[2] is w.
+    filter_type: str
+        The filter to use. 'savgol' is a Savitzky-Golay filter, which fits
+        a polynomial of degree order to window points and is the same as
+        scipy.signal.savgol_filter with mode='interp'. 'gaussian' is a
+        Gaussian filter, and 'spectral' removes all wavelengths shorter
+        than window grid points using an FFT. The Gaussian and spectral
+        filters are cheaper than the Savitzky-Golay filter.
+    window: int
+        The window size in grid points. For the Savitzky-Golay filter, it
+        is reduced to the largest odd number that fits in each axis.
+    order: int
+        The order of the polynomial of the Savitzky-Golay filter.
+    sigma: float or None
+        The standard deviation of the Gaussian filter in grid points. None
+        will use window/6, so that +/- 3 standard deviations span the
+        window.
+    num_threads: int
+        The number of threads to filter the components of the wind field
+        on. The SciPy filters release the GIL, so the components are
+        filtered in parallel.
+
+    Returns
+    -------
+    filtered_winds: 4D float array
+        The filtered wind field, with the same shape as winds.
+    """
+    winds = np.asarray(winds, dtype=np.float64)
+    if filter_type == 'spectral':
+        return _spectral_filter(winds, window)
+    elif filter_type == 'savgol':
+        def axis_filter(x, out, axis):
+            return _savgol_axis(x, out, axis, window, order)
+    elif filter_type == 'gaussian':
+        if sigma is None:
+            sigma = window/6.0
+
+        def axis_filter(x, out, axis):
+            return _gaussian_axis(x, out, axis, sigma)
+    else:
+        raise ValueError(('Unknown filter type ' + str(filter_type) +
+                          '! Valid options are savgol, gaussian and ' +
+                          'spectral.'))
+
+    filtered_winds = np.empty(winds.shape)
+    if num_threads > 1:
+        with ThreadPoolExecutor(max_workers=min(num_threads, 3)) as pool:
+            futures = [pool.submit(_filter_component, winds[i],
+                                   filtered_winds[i],
+                                   np.empty(winds.shape[1:]), axis_filter)
+                       for i in range(winds.shape[0])]
+            for future in futures:
+                future.result()
+    else:
+        tmp = np.empty(winds.shape[1:])
+        for i in range(winds.shape[0]):
+            _filter_component(winds[i], filtered_winds[i], tmp, axis_filter)
+
+    return filtered_winds
@@ -0,0 +1,186 @@
+"""
+Caching of the radar viewing geometry on disk. The azimuths, elevations
+and beam crossing angles only depend on the location of each radar and
+on the grid specification, so for fixed radar sites and analysis grids
+they only need to be calculated once. The cached arrays and their masks
+are stored as .npy files and are loaded as memory maps.
+"""
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from .angles import add_azimuth_as_field, add_elevation_as_field
+from .angles import _add_field_to_object
+from .angles import _unbroadcast
+
+
+def _hash_arrays(hasher, arrays):
+    for arr in arrays:
+        hasher.update(np.ascontiguousarray(
+            np.ma.getdata(arr), dtype=np.float64).tobytes())
+
+
+def _grid_key(grid):
+    # The key covers the grid specification: origin, x/y/z and projection
+    hasher = hashlib.sha1()
+    _hash_arrays(hasher, [grid.origin_latitude['data'],
+                          grid.origin_longitude['data'],
+                          grid.origin_altitude['data'],
+                          grid.x['data'], grid.y['data'], grid.z['data']])
+    hasher.update(repr(sorted(grid.get_projparams().items())).encode())
+    return hasher
+
+
+def _radar_key(grid):
+    hasher = _grid_key(grid)
+    _hash_arrays(hasher, [grid.radar_latitude['data'],
+                          grid.radar_longitude['data'],
+                          grid.radar_altitude['data']])
+    return hasher.hexdigest()
+
+
+def _pair_key(grid1, grid2):
+    hasher = _grid_key(grid1)
+    _hash_arrays(hasher, [grid1.radar_latitude['data'],
+                          grid1.radar_longitude['data'],
+                          grid2.radar_latitude['data'],
+                          grid2.radar_longitude['data']])
+    return hasher.hexdigest()
+
+
+def _save_array(file_name, array):
+    # Write to a temporary file first so that concurrent processes never
+    # read a partially written file.
+    cache_dir = os.path.dirname(file_name)
+    fd, temp_name = tempfile.mkstemp(dir=cache_dir, suffix='.npy')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        os.replace(temp_name, file_name)
+    except BaseException:
+        os.remove(temp_name)
+        raise
+
+
+def _load_array(file_name, shape):
+    # The data and the mask are both memory maps, so the files are only
+    # read where the field is used. Fields that do not depend on height are
+    # stored as a single level and broadcast over the vertical levels.
+    # Plain ndarray views of the memory maps can be copied with the grid.
+    array = np.asarray(np.load(file_name, mmap_mode='r'))
+    mask = np.asarray(np.load(_mask_file(file_name), mmap_mode='r'))
+    if array.ndim == 2:
+        array = np.broadcast_to(array, shape)
+        mask = np.broadcast_to(mask, shape)
+    return np.ma.MaskedArray(array, mask=mask, copy=False)
+
+
+def _save_field(file_name, field):
+    # The mask is saved next to the data, so it does not have to be
+    # calculated from the data when the field is loaded
+    field = _unbroadcast(field)
+    _save_array(_mask_file(file_name), np.ma.getmaskarray(field))
+    _save_array(file_name, np.ma.filled(field, np.nan))
+
+
+def _mask_file(file_name):
+    return file_name[:-len('.npy')] + '_mask.npy'
+
+
+def _is_cached(file_name):
+    # The data is saved last, so a cached field has both files
+    return os.path.isfile(file_name) and os.path.isfile(_mask_file(file_name))
+
+
+def add_cached_geometry_as_fields(grid, cache_dir, dz_name='DT',
+                                  az_name='AZ', el_name='EL'):
+    """
+    Adds the azimuth and elevation fields to a Py-ART Grid, reading them
+    from the geometry cache if they have already been calculated for this
+    radar location and grid specification. Otherwise, they are calculated
+    with :py:func:`add_azimuth_as_field` and
+    :py:func:`add_elevation_as_field` and saved to the cache.
+
+    Parameters
+    ----------
+    grid: Py-ART Grid object
+        Input Grid object for modification.
+    cache_dir: str
+        The directory to store the cached geometry in. It will be created
+        if it does not exist.
+    dz_name: str
+        Name of the reflectivity field in the Grid.
+    az_name: str
+        Name of the azimuth field to add to the Grid.
+    el_name: str
+        Name of the elevation field to add to the Grid.
+
+    Returns
+    -------
+    grid: Py-ART Grid object
+        Output Grid object with azimuth and elevation fields added.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    key = _radar_key(grid)
+    shape = (grid.nz, grid.ny, grid.nx)
+    az_file = os.path.join(cache_dir, key + '_az.npy')
+    el_file = os.path.join(cache_dir, key + '_el.npy')
+
+    if _is_cached(az_file):
+        _add_field_to_object(grid, _load_array(az_file, shape),
+                             dz_name=dz_name, field_name=az_name)
+    else:
+        add_azimuth_as_field(grid, dz_name=dz_name, az_name=az_name)
+        _save_field(az_file, grid.fields[az_name]['data'])
+
+    if _is_cached(el_file):
+        _add_field_to_object(grid, _load_array(el_file, shape),
+                             dz_name=dz_name, field_name=el_name)
+    else:
+        add_elevation_as_field(grid, dz_name=dz_name, el_name=el_name)
+        _save_field(el_file, grid.fields[el_name]['data'])
+    return grid
+
+
+def get_cached_bca(grid1, grid2, cache_dir):
+    """
+    Gets the beam crossing angle between the radars of two Py-ART Grids,
+    reading it from the geometry cache if it has already been calculated
+    for this radar pair and grid specification.
+
+    Parameters
+    ----------
+    grid1: Py-ART Grid object
+        The Grid of the first radar.
+    grid2: Py-ART Grid object
+        The Grid of the second radar. It must have the same grid
+        specification as grid1.
+    cache_dir: str
+        The directory to store the cached geometry in. It will be created
+        if it does not exist.
+
+    Returns
+    -------
+    bca: 2D float array
+        The beam crossing angle between the two radars in radians.
+    """
+    # Avoid a circular import
+    from .wind_retrieve import get_bca
+
+    os.makedirs(cache_dir, exist_ok=True)
+    bca_file = os.path.join(cache_dir, _pair_key(grid1, grid2) + '_bca.npy')
+    if os.path.isfile(bca_file):
+        return np.load(bca_file, mmap_mode='r')
+
+    bca = get_bca(grid1.radar_longitude['data'],
+                  grid1.radar_latitude['data'],
+                  grid2.radar_longitude['data'],
+                  grid2.radar_latitude['data'],
+                  grid1.point_x['data'][0],
+                  grid1.point_y['data'][0],
+                  grid1.get_projparams())
+    _save_array(bca_file, np.asarray(bca))
+    return bca
@@ -0,0 +1,111 @@
+"""
+Interpolation between regular grids. Both the source and the destination
+grids are rectilinear, so the interpolation is done one axis at a time
+with 1D interpolation weights that are calculated once per axis. This is
+much cheaper than interpolating on a scattered point cloud.
+"""
+
+import numpy as np
+
+from scipy.interpolate import make_interp_spline
+from scipy.ndimage import convolve1d
+
+
+def _linear_axis(field, src, dst, axis):
+    # Linearly interpolate along one axis, holding the edge values
+    # constant outside of the source coordinates
+    index = np.clip(np.searchsorted(src, dst) - 1, 0, len(src) - 2)
+    weight = np.clip((dst - src[index])/(src[index + 1] - src[index]), 0, 1)
+    shape = [1]*field.ndim
+    shape[axis] = len(dst)
+    weight = weight.reshape(shape)
+    return ((1 - weight)*np.take(field, index, axis=axis) +
+            weight*np.take(field, index + 1, axis=axis))
+
+
+def _nearest_axis(field, src, dst, axis):
+    index = np.clip(np.searchsorted(src, dst), 1, len(src) - 1)
+    index = index - (dst - src[index - 1] < src[index] - dst)
+    return np.take(field, index, axis=axis)
+
+
+def _cubic_axis(field, src, dst, axis):
+    spline = make_interp_spline(src, field, k=min(3, len(src) - 1),
+                                axis=axis)
+    return spline(np.clip(dst, src[0], src[-1]))
+
+
+_AXIS_INTERPOLATORS = {'linear': _linear_axis,
+                       'nearest': _nearest_axis,
+                       'cubic': _cubic_axis}
+
+
+def regrid_separable(field, src_coords, dst_coords, method='linear'):
+    """
+    Interpolates a field from one regular grid to another. The field is
+    interpolated along each axis in turn, so the cost is linear in the
+    number of destination points. Points outside of the source grid take
+    the value at the nearest edge.
+
+    Parameters
+    ----------
+    field: nD float array
+        The field to interpolate. The leading dimensions that do not have
+        coordinates (for example, the wind components) are not
+        interpolated.
+    src_coords: list of 1D float arrays
+        The increasing coordinates of the last len(src_coords) axes of
+        field.
+    dst_coords: list of 1D float arrays
+        The coordinates to interpolate to for each axis in src_coords.
+    method: str
+        'linear' for (tri)linear interpolation, 'cubic' for cubic spline
+        interpolation or 'nearest' for nearest neighbor interpolation.
+
+    Returns
+    -------
+    new_field: nD float array
+        The field on the destination grid.
+    """
+    if method not in _AXIS_INTERPOLATORS:
+        raise ValueError('method must be one of linear, cubic or nearest!')
+
+    interpolate = _AXIS_INTERPOLATORS[method]
+    first_axis = field.ndim - len(src_coords)
+    for i in range(len(src_coords)):
+        axis = first_axis + i
+        src = np.asarray(src_coords[i], dtype=np.float64)
+        dst = np.asarray(dst_coords[i], dtype=np.float64)
+        if(len(src) == len(dst) and np.allclose(src, dst)):
+            continue
+        if(len(src) == 1):
+            field = np.repeat(field, len(dst), axis=axis)
+            continue
+        field = interpolate(field, src, dst, axis)
+    return field
+
+
+def restrict_full_weighting(field, axes=(-2, -1)):
+    """
+    Restricts a field to a grid with every other point along each of the
+    given axes. Each coarse point is the full weighting (1/4, 1/2, 1/4)
+    average of the fine points around it along each axis.
+
+    Parameters
+    ----------
+    field: nD float array
+        The field to restrict.
+    axes: tuple of ints
+        The axes to coarsen.
+
+    Returns
+    -------
+    coarse_field: nD float array
+        The restricted field.
+    """
+    index = [slice(None)]*field.ndim
+    for axis in axes:
+        field = convolve1d(field, [0.25, 0.5, 0.25], axis=axis,
+                           mode='nearest')
+        index[axis] = slice(None, None, 2)
+    return field[tuple(index)]
@@ -1,152 +1,359 @@
 import numpy as np
 import pyart
-import os
+import time
 import gc
-import glob
-
-from distributed import Client, wait
-from scipy.interpolate import griddata
-from copy import deepcopy
-from datetime import datetime
-from .wind_retrieve import get_dd_wind_field
 
+from inspect import signature
 
-# Reduces the resolution of a PyART grid
-def _reduce_pyart_grid_res(Grid, skip_factor):
-    Grid2 = deepcopy(Grid)
+from .wind_retrieve import get_dd_wind_field
+from .result import WindRetrievalResult
+from .interpolation import regrid_separable
+from .profiling import RetrievalProfile
+from .executors import get_executor
+
+
+# The names of the fields that get_dd_wind_field reads from the Grids
+def _get_retrieval_fields(grid, kwargs):
+    vel_name = kwargs.get('vel_name', None)
+    if vel_name is None:
+        vel_name = pyart.config.get_field_name('corrected_velocity')
+    refl_field = kwargs.get('refl_field', None)
+    if refl_field is None:
+        refl_field = pyart.config.get_field_name('reflectivity')
+    fields = [vel_name, refl_field]
+    if kwargs.get('hydro_field', None) is not None:
+        fields.append(kwargs['hydro_field'])
+    if kwargs.get('model_fields', None) is not None:
+        for the_field in kwargs['model_fields']:
+            fields.extend(['U_' + the_field, 'V_' + the_field,
+                           'W_' + the_field])
+    return [field_name for field_name in fields
+            if field_name in grid.fields.keys()]
+
+
+# Makes a Py-ART Grid of the given fields over a horizontal slice of a
+# Grid. The fields are views of the fields of the Grid.
+def _slice_pyart_grid(Grid, y_slice, x_slice, fields):
     field_dict = {}
-    for field_name in Grid2.fields.keys():
-        field_dict[field_name] = Grid2.fields[field_name].copy()
-        field_dict[field_name]["data"] = Grid2.fields[field_name]["data"][
-            :, ::skip_factor, ::skip_factor]
-
-    x = Grid2.x
-    x["data"] = x["data"][::skip_factor]
-    y = Grid2.y
-    y["data"] = y["data"][::skip_factor]
-    z = Grid2.z
-    z["data"] = z["data"]
-    metadata = Grid2.metadata
-    origin_latitude = Grid2.origin_latitude
-    origin_longitude = Grid2.origin_longitude
-    origin_altitude = Grid2.origin_altitude
-    projection = Grid2.projection
-    radar_latitude = Grid2.radar_latitude
-    radar_longitude = Grid2.radar_longitude
-    radar_altitude = Grid2.radar_altitude
-    radar_time = Grid2.radar_time
-    radar_name = Grid2.radar_name
-    gtime = Grid2.time
-    new_grid = pyart.core.Grid(
-        gtime, field_dict, metadata, origin_latitude, origin_longitude,
-        origin_altitude, x, y, z, projection, radar_latitude, radar_longitude,
-        radar_altitude, radar_time, radar_name)
-    del Grid2
-    return new_grid
-
-
-# Splits a Py-ART Grid
-def _split_pyart_grid(Grid, split_factor, axis=1):
-    grid_splits = []
-    split_field = {}
-    Grid2 = deepcopy(Grid)
-    for field_name in Grid2.fields.keys():
-        if isinstance(Grid2.fields[field_name]["data"], np.ma.MaskedArray):
-            no_mask = Grid2.fields[field_name]["data"].filled(np.nan).copy()
-        else:
-            no_mask = Grid2.fields[field_name]["data"].copy()
-        split_field[field_name] = np.array_split(
-            no_mask, split_factor, axis=axis)
-        if isinstance(Grid2.fields[field_name]["data"], np.ma.MaskedArray):
-            split_field[field_name] = [np.ma.masked_where(
-                np.isnan(arr), arr) for arr in split_field[field_name]]
-    x = Grid2.x
-    y = Grid2.y
-    z = Grid2.z
-    x_split = np.array_split(x["data"], split_factor)
-    y_split = np.array_split(y["data"], split_factor)
-    z_split = np.array_split(z["data"], split_factor)
-    gtime = Grid2.time
-    metadata = Grid2.metadata
-    origin_latitude = Grid2.origin_latitude
-    origin_longitude = Grid2.origin_longitude
-    origin_altitude = Grid2.origin_altitude
-    projection = Grid2.projection
-    radar_latitude = Grid2.radar_latitude
-    radar_longitude = Grid2.radar_longitude
-    radar_altitude = Grid2.radar_altitude
-    radar_time = Grid2.radar_time
-    radar_name = Grid2.radar_name
-    for i in range(split_factor):
-        grid_dic = {}
-
-        for field_name in Grid2.fields.keys():
-            grid_dic[field_name] = Grid2.fields[field_name].copy()
-            grid_dic[field_name]["data"] = split_field[field_name][i]
-        x_dic = x.copy()
-        y_dic = y.copy()
-        z_dic = z.copy()
+    for field_name in fields:
+        field_dict[field_name] = Grid.fields[field_name].copy()
+        field_dict[field_name]["data"] = Grid.fields[field_name]["data"][
+            :, y_slice, x_slice]
+    x = Grid.x.copy()
+    x["data"] = Grid.x["data"][x_slice]
+    y = Grid.y.copy()
+    y["data"] = Grid.y["data"][y_slice]
+    z = Grid.z.copy()
+    return pyart.core.Grid(
+        Grid.time, field_dict, Grid.metadata, Grid.origin_latitude,
+        Grid.origin_longitude, Grid.origin_altitude, x, y, z,
+        Grid.projection, Grid.radar_latitude, Grid.radar_longitude,
+        Grid.radar_altitude, Grid.radar_time, Grid.radar_name)
+
+
+# Reduces the resolution of a PyART grid. The fields are strided views of
+# the fields of the Grid.
+def _reduce_pyart_grid_res(Grid, skip_factor, fields=None):
+    if fields is None:
+        fields = list(Grid.fields.keys())
+    return _slice_pyart_grid(Grid, slice(None, None, skip_factor),
+                             slice(None, None, skip_factor), fields)
+
+
+# Extends the core [core_start, core_stop) of a tile along an axis of n
+# points by halo points on either side, except at the edges of the domain.
+# Returns the tile slice and the blending weights along the axis, which
+# fall off linearly across the halo.
+def _get_halo_slice(n, core_start, core_stop, halo):
+    start = max(core_start - halo, 0)
+    stop = min(core_stop + halo, n)
+    index = np.arange(start, stop)
+    ramp = np.ones(stop - start)
+    lower = index < core_start
+    ramp[lower] = (index[lower] - start + 1.0)/(core_start - start + 1.0)
+    upper = index >= core_stop
+    ramp[upper] = (stop - index[upper])/(stop - core_stop + 1.0)
+    return slice(start, stop), ramp
+
+
+# Splits the (y, x) domain into num_splits**2 nearly equal cores
+def _get_uniform_cores(shape, num_splits):
+    bounds = []
+    for n in shape:
+        sizes = [len(part) for part in
+                 np.array_split(np.arange(n), num_splits)]
+        stops = np.cumsum(sizes)
+        bounds.append([(int(stop - size), int(stop))
+                       for size, stop in zip(sizes, stops)])
+    return [(y0, y1, x0, x1) for x0, x1 in bounds[1]
+            for y0, y1 in bounds[0]]
+
+
+# Splits the (y, x) domain into num_tiles cores with nearly equal work by
+# recursive bisection. The core with the most work is cut in two along
+# its longer axis where the work is halved, until there are num_tiles
+# cores or no core is at least 2*min_size points long.
+def _get_balanced_cores(work, num_tiles, min_size):
+    cores = [(0, work.shape[0], 0, work.shape[1])]
+    while len(cores) < num_tiles:
+        splittable = [core for core in cores if
+                      max(core[1] - core[0], core[3] - core[2]) >=
+                      2*min_size]
+        if len(splittable) == 0:
+            break
+        core = max(splittable, key=lambda c: work[c[0]:c[1], c[2]:c[3]].sum())
+        y0, y1, x0, x1 = core
+        axis = 1 if(y1 - y0) >= (x1 - x0) else 0
+        profile = np.cumsum(work[y0:y1, x0:x1].sum(axis=axis))
+        cut = np.searchsorted(profile, profile[-1]/2.0) + 1
+        cut = int(np.clip(cut, min_size, len(profile) - min_size))
+        cores.remove(core)
         if(axis == 1):
-            y_dic["data"] = y_split[i]
-        elif(axis == 2):
-            x_dic["data"] = x_split[i]
-        elif(axis == 0):
-            z_dic["data"] = z_split[i]
-
-        new_grid = pyart.core.Grid(
-            gtime, grid_dic, metadata, origin_latitude, origin_longitude,
-            origin_altitude, x_dic, y_dic, z_dic, projection, radar_latitude,
-            radar_longitude, radar_altitude, radar_time, radar_name)
-        grid_splits.append(new_grid)
-
-    return grid_splits
-
-
-# Concatenates Py-ART Grids
-def _concatenate_pyart_grids(grid_list, axis=1):
-    new_grid = deepcopy(grid_list[0])
-    for field_name in new_grid.fields.keys():
-        new_grid.fields[field_name]["data"] = np.ma.concatenate(
-            [x.fields[field_name]["data"] for x in grid_list], axis=axis)
-    if(axis == 2):
-        new_grid.x["data"] = np.ma.concatenate(
-            [x.x["data"] for x in grid_list])
-        new_grid.nx = np.sum([x.nx for x in grid_list])
-    elif(axis == 1):
-        new_grid.y["data"] = np.ma.concatenate(
-            [x.y["data"] for x in grid_list])
-        new_grid.ny = np.sum([x.ny for x in grid_list])
-    elif(axis == 0):
-        new_grid.z["data"] = np.ma.concatenate(
-            [x.z["data"] for x in grid_list])
-        new_grid.nz = np.sum([x.nz for x in grid_list])
-    return new_grid
+            cores.extend([(y0, y0 + cut, x0, x1), (y0 + cut, y1, x0, x1)])
+        else:
+            cores.extend([(y0, y1, x0, x0 + cut), (y0, y1, x0 + cut, x1)])
+    return cores
+
+
+# Blends the fields of overlapping tiles with the blending weights of
+# each tile over the (y, x) region of a domain of the given shape. A point
+# is masked when most of the weight is from tiles where it is masked.
+def _blend_tiles(fields, tile_slices, tile_weights, shape, region=None):
+    if region is None:
+        region = (slice(0, shape[1]), slice(0, shape[2]))
+    region_y, region_x = region
+    out_shape = (shape[0], region_y.stop - region_y.start,
+                 region_x.stop - region_x.start)
+    total = np.zeros(out_shape)
+    masked = np.zeros(out_shape)
+    weight_sum = np.zeros(out_shape[1:])
+    for field, (y_slice, x_slice), weight in zip(
+            fields, tile_slices, tile_weights):
+        y0 = max(y_slice.start, region_y.start)
+        y1 = min(y_slice.stop, region_y.stop)
+        x0 = max(x_slice.start, region_x.start)
+        x1 = min(x_slice.stop, region_x.stop)
+        if(y0 >= y1 or x0 >= x1):
+            continue
+        src = (slice(y0 - y_slice.start, y1 - y_slice.start),
+               slice(x0 - x_slice.start, x1 - x_slice.start))
+        dst = (slice(y0 - region_y.start, y1 - region_y.start),
+               slice(x0 - region_x.start, x1 - region_x.start))
+        the_weight = weight[src]
+        total[(slice(None),) + dst] += (
+            the_weight*np.ma.getdata(field)[(slice(None),) + src])
+        masked[(slice(None),) + dst] += (
+            the_weight*np.ma.getmaskarray(field)[(slice(None),) + src])
+        weight_sum[dst] += the_weight
+    total /= weight_sum
+    masked /= weight_sum
+    return np.ma.masked_where(masked > 0.5, total)
+
+
+# The mean absolute difference of the winds of overlapping tiles over
+# their overlaps. This is 0 when the tiles agree and there are no seams.
+def _get_tile_mismatch(results, tile_slices):
+    differences = []
+    for i, (y_a, x_a) in enumerate(tile_slices):
+        for j in range(i + 1, len(tile_slices)):
+            y_b, x_b = tile_slices[j]
+            y0 = max(y_a.start, y_b.start)
+            y1 = min(y_a.stop, y_b.stop)
+            x0 = max(x_a.start, x_b.start)
+            x1 = min(x_a.stop, x_b.stop)
+            if(y0 >= y1 or x0 >= x1):
+                continue
+            for name in ['u', 'v', 'w']:
+                a = np.ma.getdata(getattr(results[i], name))[
+                    :, y0 - y_a.start:y1 - y_a.start,
+                    x0 - x_a.start:x1 - x_a.start]
+                b = np.ma.getdata(getattr(results[j], name))[
+                    :, y0 - y_b.start:y1 - y_b.start,
+                    x0 - x_b.start:x1 - x_b.start]
+                differences.append(np.abs(a - b).mean())
+    if(len(differences) == 0):
+        return 0.0
+    return float(np.mean(differences))
+
+
+# Makes the first guess of a tile from the tiles of the previous level
+# that overlap it. The tiles are blended over the region of the previous
+# level around the tile and regridded to the points of the tile.
+def _get_tile_init(results, tile_slices, tile_weights, shape, region,
+                   src_coords, dst_coords, method):
+    winds = np.stack([np.ma.getdata(_blend_tiles(
+        [getattr(result, name) for result in results], tile_slices,
+        tile_weights, shape, region)) for name in ['u', 'v', 'w']])
+    return list(regrid_separable(winds, src_coords, dst_coords, method))
+
+
+# The cores, halo-extended slices, blending weights and work of the tiles
+# of one level, and whether each tile has observations
+def _decompose_level(level_grids, vel_name, shape, cores, halo,
+                     has_model):
+    num_obs = sum([np.sum(~np.ma.getmaskarray(G.fields[vel_name]['data']),
+                          axis=0) for G in level_grids])
+    work = num_obs + shape[0]
+    if callable(cores):
+        cores = cores(work)
+    tile_slices = []
+    tile_weights = []
+    tile_work = []
+    has_obs = []
+    for y0, y1, x0, x1 in cores:
+        y_slice, y_ramp = _get_halo_slice(shape[1], y0, y1, halo)
+        x_slice, x_ramp = _get_halo_slice(shape[2], x0, x1, halo)
+        tile_slices.append((y_slice, x_slice))
+        tile_weights.append(np.outer(y_ramp, x_ramp))
+        tile_work.append(float(work[y_slice, x_slice].sum()))
+        has_obs.append(num_obs[y_slice, x_slice].sum() > 0 or has_model)
+    return {'cores': cores, 'tile_slices': tile_slices,
+            'tile_weights': tile_weights, 'tile_work': tile_work,
+            'has_obs': has_obs}
+
+
+# True for the points of a tile outside of its core. During a Schwarz
+# sweep, these keep the solution of the neighbors of the tile from the
+# previous sweep as its boundary condition.
+def _get_halo_mask(core, tile_slice):
+    y0, y1, x0, x1 = core
+    y_slice, x_slice = tile_slice
+    mask = np.ones((y_slice.stop - y_slice.start,
+                    x_slice.stop - x_slice.start), dtype=bool)
+    mask[y0 - y_slice.start:y1 - y_slice.start,
+         x0 - x_slice.start:x1 - x_slice.start] = False
+    return mask
+
+
+# The region of a level with coordinates src_y and src_x that is needed to
+# interpolate to the points dst_y and dst_x
+def _get_source_region(src_y, src_x, dst_y, dst_x, margin=2):
+    region = []
+    for src, dst in [(src_y, dst_y), (src_x, dst_x)]:
+        start = max(np.searchsorted(src, dst[0], side='right') - 1 - margin,
+                    0)
+        stop = min(np.searchsorted(src, dst[-1], side='left') + 1 + margin,
+                   len(src))
+        region.append(slice(int(start), int(stop)))
+    return tuple(region)
+
+
+# The result of a tile without observations, which keeps its first guess
+# and is masked the same way as a retrieval with no coverage. The first
+# guess is kept under the mask, so that it can start the next level.
+def _fill_tile(tile_init, kwargs):
+    u, v, w = [np.ma.array(wind) for wind in tile_init]
+    if kwargs.get('mask_outside_opt', False):
+        u = np.ma.array(u, mask=True)
+        v = np.ma.array(v, mask=True)
+    if(kwargs.get('mask_outside_opt', False) or
+       kwargs.get('mask_w_outside_opt', True)):
+        w = np.ma.array(w, mask=True)
+    return WindRetrievalResult(u, v, w, np.zeros(u.shape), None,
+                               diagnostics={'skipped': True})
+
+
+# Runs the retrieval on one tile on a worker. Only the arrays of the
+# result are sent back, not the Grids of the tile. A retrieval that runs
+# out of memory or fails with an OSError, such as a lost connection, is
+# retried up to max_retries times, waiting backoff seconds before the first
+# retry and twice as long before each next one. After a MemoryError, the
+# observations are packed into bit masks to use less memory. Other errors,
+# such as a bad argument, fail the same way on every attempt, so they are
+# raised. If every attempt fails, the tile keeps its first guess and is
+# flagged as failed, unless allow_failure is False.
+_RETRY_ERRORS = (MemoryError, OSError)
+
+
+def _retrieve_tile(tile_grids, tile_init, kwargs, max_retries=0,
+                   backoff=1.0, allow_failure=True):
+    u_init, v_init, w_init = tile_init
+    tile_kwargs = dict(kwargs)
+    errors = []
+    for attempt in range(max_retries + 1):
+        try:
+            result = get_dd_wind_field(tile_grids, u_init, v_init, w_init,
+                                       **tile_kwargs)
+        except _RETRY_ERRORS as exc:
+            errors.append(repr(exc))
+            if(attempt == max_retries and not allow_failure):
+                raise
+            if isinstance(exc, MemoryError):
+                tile_kwargs['compress_observations'] = 'bits'
+                tile_kwargs['chunks'] = None
+                gc.collect()
+        else:
+            result.grids = None
+            result.diagnostics['attempts'] = attempt + 1
+            return result
+        if(attempt < max_retries):
+            time.sleep(backoff*2**attempt)
+
+    return WindRetrievalResult(
+        np.ma.array(u_init), np.ma.array(v_init), np.ma.array(w_init),
+        np.zeros(np.shape(u_init)), None,
+        diagnostics={'failed': True, 'attempts': max_retries + 1,
+                     'errors': errors})
+
+
+# Only the profile of a tile is sent back to profile the nested retrieval
+def _get_tile_profile(result):
+    return getattr(result, 'profile', None)
 
 
 # Procedure: 1. Do first pass of retrieval on reduced resolution grid
 # 2. Then, we use the reduced resolution retrieval as an input to the
-# high resolution retrieval in each region
-# Finally, we check for continuity at the boundaries
-def get_dd_wind_field_nested(grid_list, u_init, v_init, w_init, client,
-                             reduction_factor=2, num_splits=2, **kwargs):
+# higher resolution retrieval in each region, down to the analysis grid
+# Finally, we blend the overlapping regions at the boundaries
+def get_dd_wind_field_nested(grid_list, u_init, v_init, w_init, client=None,
+                             reduction_factor=2, num_splits=2, profile=False,
+                             halo=4, schwarz_iterations=0,
+                             regrid_method='linear', executor=None,
+                             num_workers=None, tiling='uniform',
+                             num_tiles=None, reduction_factors=None,
+                             max_retries=2, retry_backoff=1.0, **kwargs):
     """
     This function performs a wind retrieval using a nested domain.
     This is useful for grids that are larger than about 500 by 500
     by 40 points, since the use of larger grids on a single machine
     will exceed memory limitations.
 
-    This procedure relies on a dask distributed cluster to be set up.
     The retrieval is first performed at a resolution that is coarser
     than the analysis grid by reduction_factor. This provides the
-    initial state for the nested loop.
+    initial state for the nested loop. With reduction_factors, this is
+    instead a cascade of resolutions (for example 8, 4, 2 and 1), where
+    the retrieval at each resolution is the initial state of the next.
+    The first resolution is retrieved on the entire grid, and the others
+    are split into sub-domains. The whole cascade is submitted at once,
+    and each sub-domain waits only for the sub-domains of the previous
+    resolution that it overlaps, so the resolutions pipeline across the
+    workers.
 
     The domain is split into num_splits**2 sub-domains for the nested
-    retrieval step, and each nested retrieval is mapped onto a distributed
-    worker for parallel processing. If NumPy and SciPy are already set up to
-    use parallel numerical analysis libraries, it is recommended that a single
-    machine be dedicated to each nest rather than a single core
+    retrieval step, and each nested retrieval is mapped onto a worker of a
+    dask distributed cluster or of a local process or thread pool for
+    parallel processing (see executor). If NumPy and SciPy are already set
+    up to use parallel numerical analysis libraries, it is recommended that
+    a single machine be dedicated to each nest rather than a single core
     for best performance.
 
+    Each sub-domain overlaps its neighbors by halo grid points on each
+    side. The wind fields of the sub-domains are blended in the overlaps
+    with weights that fall off linearly across the halo, so there are no
+    seams at the edges of the sub-domains. With schwarz_iterations > 0,
+    the sub-domains are solved again starting from the blended wind field
+    (additive Schwarz sweeps). In each sweep, the halo of each sub-domain
+    is held at the solution of its neighbors from the previous sweep as a
+    boundary condition (see fixed_points in get_dd_wind_field), and only
+    its core is retrieved. The mean difference between overlapping
+    sub-domains is stored in the tile_mismatch diagnostic, and shrinks as
+    the sweeps converge.
+
+    The sub-domains are sent to the workers from memory, and only the
+    fields that the retrieval reads are sent, so nothing is written to
+    disk. Each worker only sends back the
+    retrieved wind field of its sub-domain.
+
     Parameters
     ==========
     grid_list: list
@@ -160,136 +367,324 @@ def get_dd_wind_field_nested(grid_list, u_init, v_init, w_init, client,
     w_init: 3D NumPy array
        The initial guess of the vertical wind field. This has to be in the same
        shape as the analysis grid.
-    client: dask distributed Client
+    client: dask distributed Client, concurrent.futures.Executor or None
        The distributed Client that is linked to a distributed cluster. The
        :cluster must be running before get_dd_wind_field_nested is called.
        The retrieval on each nest will be mapped onto each worker. Since
        the optimization loop already takes advantage of parallelism, it's
-       best to allow at least 16 cores per one worker.
+       best to allow at least 16 cores per one worker. A
+       concurrent.futures.Executor can be given instead of a Client, and
+       None runs the nests with executor.
     reduction_factor: int
        How much to reduce the factor of the analysis grid by when doing the
        initial retrieval on the entire grid.
+    reduction_factors: list of ints or None
+       The reduction factors of the cascade from the coarsest to the
+       finest. A final factor of 1 is added if it is not given. None uses
+       [reduction_factor, 1]. The number of sub-domains at each factor is
+       scaled by the number of grid points, so that num_splits**2 (or
+       num_tiles) is the number of sub-domains at the analysis resolution.
     num_splits: int
        The number of splits to make through each axis when doing the nesting.
+    halo: int
+       The number of grid points by which each sub-domain extends into its
+       neighbors. 0 gives disjoint sub-domains that are concatenated.
+    schwarz_iterations: int
+       The number of times to solve the sub-domains again from the blended
+       wind field at the analysis resolution, with their halos held at the
+       solution of their neighbors.
+    regrid_method: str
+       The interpolation to use to regrid each resolution to the next.
+       This is 'linear', 'cubic' or 'nearest'. See
+       :py:func:`pydda.retrieval.regrid_separable`.
+    executor: str or None
+       Where to run the nests. 'dask' uses client, 'process' uses a local
+       ProcessPoolExecutor, 'thread' uses a local ThreadPoolExecutor and
+       'serial' runs the nests one after the other in this process. None
+       uses 'dask' when client is given and 'process' otherwise. dask is
+       only imported for 'dask'.
+    num_workers: int or None
+       The number of workers of the local pool for 'process' and 'thread'.
+       None uses one worker per core.
+    tiling: str
+       'uniform' splits the domain into num_splits**2 equal sub-domains.
+       'balanced' splits it into num_tiles sub-domains with about the same
+       amount of work by recursive bisection. The work of each column is
+       its number of grid points plus its number of radial velocity
+       observations. Either way, the sub-domains are run from the most to
+       the least work, and sub-domains without observations keep the
+       retrieval of the previous resolution instead of being retrieved
+       (unless model_fields is given).
+    num_tiles: int or None
+       The number of sub-domains for 'balanced' tiling. None uses
+       num_splits**2.
+    max_retries: int
+       The number of times to retry a sub-domain whose retrieval runs out
+       of memory or fails with an OSError. After a MemoryError, the retry
+       packs the observations into bit masks (see compress_observations in
+       get_dd_wind_field). On dask, the tasks of a lost worker are also
+       rerun up to this many times. A sub-domain that still fails keeps
+       the retrieval of the previous resolution, and is flagged in the
+       nested_qc field. Other errors, and any failure of the first
+       resolution, are raised. A sub-domain of the analysis resolution
+       whose task is lost, such as when its worker dies, is filled from
+       the first resolution. On dask, this also covers the sub-domains
+       that depend on a lost task of an earlier resolution. With a local
+       pool, a lost task of an earlier resolution is raised when the
+       next resolution is submitted.
+    retry_backoff: float
+       The number of seconds to wait before the first retry of a
+       sub-domain. This doubles with each retry.
+    profile: bool
+       Set to True to time each stage of the nested retrieval (splitting,
+       tile retrievals, which include the regridding between resolutions,
+       and blending) and sample
+       the peak resident set size of the client process at the end of each
+       stage. The sub-domains are profiled as well. Their stages are added
+       up over all of the sub-domains as 'tile_' and the name of the stage
+       (for example tile_optimizer), with the largest peak resident set
+       size of their workers. These run in parallel, so they can add up to
+       more than the total time. The profile is stored as a JSON string in
+       the 'pydda_profile' metadata of each output Grid.
 
     **kwargs: dict
         This function will take the same keyword arguments as
         get_dd_wind_field, as these arguments are passed into each call of
         get_dd_wind_field. See get_dd_wind_field for more information on the
+        keyword arguments. If return_result is True, a
+        :py:class:`WindRetrievalResult` is returned. Its diagnostics hold
+        the diagnostics of the coarse pass and of each sub-domain, the
+        sub-domains of each resolution, the tile_mismatch and the
+        nested_qc flags.
+
+    Returns
+    =======
+    new_grid_list: list or WindRetrievalResult
+        A list of Py-ART grids containing the derived wind fields, or a
+        :py:class:`WindRetrievalResult` if return_result is True. The
+        other fields of these Grids are shared with grid_list, not copied.
+        The nested_qc field of these Grids is 0 where the wind field was
+        retrieved at the analysis resolution, 1 where the sub-domain had no
+        observations and 2 where its retrieval failed. Both 1 and 2 keep
+        the retrieval of the previous resolution.
     """
-    # First, we do retrieval on whole grid with fraction of resolution
-    grid_lo_res_list = [_reduce_pyart_grid_res(G, reduction_factor)
-                        for G in grid_list]
-
-    first_pass = get_dd_wind_field(
-        grid_lo_res_list, u_init[::, ::reduction_factor, ::reduction_factor],
-        v_init[::, ::reduction_factor, ::reduction_factor],
-        w_init[::, ::reduction_factor, ::reduction_factor], **kwargs)
-
-    # Take the first pass field and regrid to analysis field
-    reduced_x = first_pass[0].point_x["data"].flatten()
-    reduced_y = first_pass[0].point_y["data"].flatten()
-    reduced_z = first_pass[0].point_z["data"].flatten()
-    x = grid_list[0].point_x["data"].flatten()
-    y = grid_list[0].point_y["data"].flatten()
-    z = grid_list[0].point_z["data"].flatten()
-    u_init_new = griddata((reduced_z, reduced_y, reduced_x),
-                          first_pass[0].fields["u"]["data"].flatten(),
-                          (z, y, x), method='nearest')
-    v_init_new = griddata((reduced_z, reduced_y, reduced_x),
-                          first_pass[0].fields["v"]["data"].flatten(),
-                          (z, y, x), method='nearest')
-    w_init_new = griddata((reduced_z, reduced_y, reduced_x),
-                          first_pass[0].fields["w"]["data"].flatten(),
-                          (z, y, x), method='nearest')
-    u_init_new = np.reshape(u_init_new, u_init.shape)
-    v_init_new = np.reshape(v_init_new, v_init.shape)
-    w_init_new = np.reshape(w_init_new, w_init.shape)
-
-    # Finally, split the analysis into num_splits**2 pieces and save
-    # as temporary files
-    tempfile_name_base = datetime.now().strftime('%y%m%d.%H%M%S')
-    tiny_grids = []
-    k = 0
-    for G in grid_list:
-        cur_list = []
-        split_grids_x = _split_pyart_grid(G, num_splits, axis=2)
-        i = 0
-        for sgrid in split_grids_x:
-            g_list = _split_pyart_grid(sgrid, num_splits)
-            grid_fns = []
-            j = 0
-            for g in g_list:
-                fn = (tempfile_name_base + str(k) + '.' +
-                      str(i) + '.' + str(j) + '.nc')
-                pyart.io.write_grid((tempfile_name_base + str(k) +
-                                     '.' + str(i) + '.' + str(j) + '.nc'), g)
-                j = j + 1
-                grid_fns.append(fn)
-            cur_list.append(grid_fns)
-            i = i + 1
-        del split_grids_x, g_list
-
-        k = k + 1
-        tiny_grids.append(cur_list)
-
-    # Temporarily save the tiny grids and free up memory...we want to
-    # load these when we are running it on the cluster
-
-    u_init_split_x = np.array_split(u_init_new, num_splits, axis=2)
-    u_init_split = [np.array_split(ux, num_splits, axis=1)
-                    for ux in u_init_split_x]
-    w_init_split_x = np.array_split(w_init_new, num_splits, axis=2)
-    w_init_split = [np.array_split(wx, num_splits, axis=1)
-                    for wx in w_init_split_x]
-    v_init_split_x = np.array_split(v_init_new, num_splits, axis=2)
-    v_init_split = [np.array_split(vx, num_splits, axis=1)
-                    for vx in v_init_split_x]
-
-    # Clear out unneeded variables (do not need lo-res grids in memory anymore)
-    del u_init_split_x, w_init_split_x, v_init_split_x
-    del first_pass, reduced_x, reduced_y, reduced_z, x, y, z, grid_lo_res_list
-    gc.collect()
-
-    # Serial just for testing, need to use dask in future
-    tiny_retrieval = []
-
-    def do_tiny_retrieval(i, j):
-        tgrids = [pyart.io.read_grid(tiny_grids[k][i][j])
-                  for k in range(len(grid_list))]
-        new_grids = get_dd_wind_field(
-            tgrids, u_init_split[i][j], v_init_split[i][j],
-            w_init_split[i][j], **kwargs)
-        del tgrids
-        gc.collect()
-        return new_grids
-
-    futures_array = []
-    for i in range(num_splits):
-        for j in range(num_splits):
-            futures_array.append(client.submit(do_tiny_retrieval, i, j))
-
-    print("Waiting for nested grid to be retrieved...")
-    wait(futures_array)
-    tiny_retrieval2 = client.gather(futures_array)
-    tiny_retrieval = []
-
-    for i in range(num_splits):
-        new_grid_list = []
-
-        for j in range(len(grid_list)):
-            new_grid_list.append(_concatenate_pyart_grids(
-                [tiny_retrieval2[k+i*num_splits][j]
-                 for k in range(0, num_splits)], axis=1))
-        tiny_retrieval.append(new_grid_list)
-
-    new_grid_list = []
-    for i in range(len(grid_list)):
-        new_grid_list.append(_concatenate_pyart_grids(
-            [tiny_retrieval[k][i] for k in range(num_splits)], axis=2))
-
-    tempfile_list = glob.glob(tempfile_name_base + "*")
-    for fn in tempfile_list:
-        os.remove(fn)
+    timer = RetrievalProfile()
+    return_result = kwargs.pop('return_result', False)
+    # Bad keyword arguments would fail every tile, so they are checked here
+    signature(get_dd_wind_field).bind(grid_list, u_init, v_init, w_init,
+                                      **kwargs)
+    fields = _get_retrieval_fields(grid_list[0], kwargs)
+    if tiling not in ['uniform', 'balanced']:
+        raise ValueError('tiling must be uniform or balanced!')
+    if num_tiles is None:
+        num_tiles = num_splits**2
+    if reduction_factors is None:
+        reduction_factors = [reduction_factor, 1]
+    reduction_factors = [int(factor) for factor in reduction_factors]
+    if reduction_factors[-1] != 1:
+        reduction_factors.append(1)
+    if(min(reduction_factors) < 1 or
+       np.any(np.diff(reduction_factors) > 0)):
+        raise ValueError('reduction_factors must decrease to 1!')
+
+    # The first resolution is retrieved on the entire grid
+    def get_cores(level, factor, shape):
+        if(level == 0):
+            return [(0, shape[1], 0, shape[2])]
+        if(tiling == 'uniform'):
+            return _get_uniform_cores(
+                shape[1:], max(int(round(num_splits/float(factor))), 1))
+        level_tiles = max(int(round(num_tiles/float(factor**2))), 1)
+        return lambda work: _get_balanced_cores(work, level_tiles,
+                                                max(halo, 5))
+
+    # The analysis resolution is repeated for each Schwarz sweep. The
+    # first field is the radial velocity.
+    levels = reduction_factors + [1]*schwarz_iterations
+    has_model = kwargs.get('model_fields', None) is not None
+    tile_kwargs = dict(kwargs)
+    tile_kwargs['return_result'] = True
+    tile_kwargs['profile'] = profile
+    pool = get_executor(executor, client, num_workers, retries=max_retries)
+    decompositions = {}
+    level_diagnostics = []
+    level_results = []
+    prev = None
+    try:
+        for level, factor in enumerate(levels):
+            # Split each resolution into overlapping pieces once. Only the
+            # fields that the retrieval needs are kept in each piece, and
+            # they are sent to the workers directly from memory.
+            timer.start_stage('split')
+            key = (factor, level == 0)
+            if key not in decompositions:
+                if(factor == 1):
+                    level_grids = grid_list
+                else:
+                    level_grids = [_reduce_pyart_grid_res(G, factor, fields)
+                                   for G in grid_list]
+                y = level_grids[0].y['data']
+                x = level_grids[0].x['data']
+                shape = (u_init.shape[0], len(y), len(x))
+                info = _decompose_level(
+                    level_grids, fields[0], shape,
+                    get_cores(level, factor, shape),
+                    halo if level > 0 else 0, has_model)
+                info.update({'shape': shape, 'y': y, 'x': x,
+                             'order': np.argsort(info['tile_work'])[::-1]})
+                with_obs = [i for i in info['order'] if info['has_obs'][i]]
+                info['tile_grids'] = dict(zip(with_obs, pool.scatter(
+                    [[_slice_pyart_grid(G, info['tile_slices'][i][0],
+                                        info['tile_slices'][i][1], fields)
+                      for G in level_grids] for i in with_obs])))
+                decompositions[key] = info
+                del level_grids
+                gc.collect()
+            info = decompositions[key]
+            print('Nesting level ' + str(level) + ' (reduction factor ' +
+                  str(factor) + '): ' + str(sum(info['has_obs'])) + ' of ' +
+                  str(len(info['cores'])) +
+                  ' sub-domains have observations')
+
+            # Submit the tiles with the most work first. Each tile starts
+            # from the tiles of the previous level that it overlaps.
+            timer.start_stage('tile_retrievals')
+            results = [None]*len(info['cores'])
+            for i in info['order']:
+                y_slice, x_slice = info['tile_slices'][i]
+                if prev is None:
+                    tile_init = [wind[:, ::factor, ::factor][
+                        :, y_slice, x_slice]
+                        for wind in [u_init, v_init, w_init]]
+                else:
+                    region = _get_source_region(
+                        prev['y'], prev['x'], info['y'][y_slice],
+                        info['x'][x_slice])
+                    overlap = [
+                        j for j, (ys, xs) in enumerate(prev['tile_slices'])
+                        if(ys.start < region[0].stop and
+                           region[0].start < ys.stop and
+                           xs.start < region[1].stop and
+                           region[1].start < xs.stop)]
+                    tile_init = pool.submit(
+                        _get_tile_init, [prev_results[j] for j in overlap],
+                        [prev['tile_slices'][j] for j in overlap],
+                        [prev['tile_weights'][j] for j in overlap],
+                        prev['shape'], region,
+                        [prev['y'][region[0]], prev['x'][region[1]]],
+                        [info['y'][y_slice], info['x'][x_slice]],
+                        regrid_method)
+                if info['has_obs'][i]:
+                    # A Schwarz sweep holds the halo of each tile at the
+                    # solution of its neighbors from the previous sweep
+                    the_kwargs = tile_kwargs
+                    if(level >= len(reduction_factors)):
+                        the_kwargs = dict(tile_kwargs,
+                                          fixed_points=_get_halo_mask(
+                                              info['cores'][i],
+                                              info['tile_slices'][i]))
+                    results[i] = pool.submit(
+                        _retrieve_tile, info['tile_grids'][i], tile_init,
+                        the_kwargs, max_retries, retry_backoff, level > 0)
+                else:
+                    results[i] = pool.submit(_fill_tile, tile_init,
+                                             tile_kwargs)
+            if(level == 0):
+                first_pass = results[0]
+                first_info = info
+            level_diagnostics.append({'reduction_factor': factor,
+                                      'tile_cores': info['cores'],
+                                      'tile_work': info['tile_work']})
+            if profile:
+                level_results.append(results)
+            prev = info
+            prev_results = results
+
+        print("Waiting for nested grid to be retrieved...")
+        tile_results = pool.gather(prev_results, errors='return')
+        first_pass = pool.gather([first_pass])[0]
+        tile_profiles = [_get_tile_profile(r) for r in tile_results]
+        for results in level_results[:-1]:
+            tile_profiles.extend(pool.gather(
+                [pool.submit(_get_tile_profile, r) for r in results],
+                errors='return'))
+    except BaseException:
+        pool.shutdown()
+        raise
+    del decompositions, results, prev_results, level_results
+    pool.shutdown()
+
+    # The stages of the tiles are added up over all of the tiles
+    for tile_profile in tile_profiles:
+        if isinstance(tile_profile, dict):
+            for stage, elapsed in tile_profile['stage_times'].items():
+                timer.add_stage('tile_' + stage, elapsed,
+                                tile_profile['peak_rss_mb'].get(stage))
+
+    # A tile of the last level that was lost along with its retries, such
+    # as when its worker died, is filled from the coarse pass. On dask, the
+    # tiles after a lost tile of an earlier level are lost with it. Errors
+    # of the retrieval itself are raised. Each tile flags its core in the
+    # QC field.
+    qc = np.zeros(u_init.shape, dtype=np.int8)
+    for i, (y0, y1, x0, x1) in enumerate(prev['cores']):
+        y_slice, x_slice = prev['tile_slices'][i]
+        if isinstance(tile_results[i], BaseException):
+            if not pool.is_lost(tile_results[i]):
+                raise tile_results[i]
+            print('Sub-domain ' + str(i) + ' failed with ' +
+                  repr(tile_results[i]) + ', using the coarse pass')
+            region = _get_source_region(
+                first_info['y'], first_info['x'], prev['y'][y_slice],
+                prev['x'][x_slice])
+            tile_init = _get_tile_init(
+                [first_pass], first_info['tile_slices'],
+                first_info['tile_weights'], first_info['shape'], region,
+                [first_info['y'][region[0]], first_info['x'][region[1]]],
+                [prev['y'][y_slice], prev['x'][x_slice]], regrid_method)
+            tile_results[i] = WindRetrievalResult(
+                *[np.ma.array(wind) for wind in tile_init],
+                coverage=np.zeros(tile_init[0].shape), grids=None,
+                diagnostics={'failed': True,
+                             'errors': [repr(tile_results[i])]})
+        if tile_results[i].diagnostics.get('failed', False):
+            qc[:, y0:y1, x0:x1] = 2
+        elif tile_results[i].diagnostics.get('skipped', False):
+            qc[:, y0:y1, x0:x1] = 1
+
+    timer.start_stage('blend')
+    winds = [_blend_tiles([getattr(r, name) for r in tile_results],
+                          prev['tile_slices'], prev['tile_weights'],
+                          u_init.shape) for name in ['u', 'v', 'w']]
+    coverage = np.ma.getdata(_blend_tiles(
+        [r.coverage for r in tile_results], prev['tile_slices'],
+        prev['tile_weights'], u_init.shape))
+    diagnostics = {'coarse_pass': first_pass.diagnostics,
+                   'tiles': [r.diagnostics for r in tile_results],
+                   'tile_cores': prev['cores'],
+                   'tile_work': prev['tile_work'],
+                   'levels': level_diagnostics,
+                   'schwarz_iterations': schwarz_iterations,
+                   'tile_mismatch': _get_tile_mismatch(
+                       tile_results, prev['tile_slices']),
+                   'nested_qc': qc}
+    result = WindRetrievalResult(winds[0], winds[1], winds[2], coverage,
+                                 grid_list, diagnostics=diagnostics,
+                                 field_metadata=first_pass.field_metadata)
+    if return_result:
+        if profile:
+            result.profile = timer.as_dict()
+        return result
+
+    new_grid_list = result.to_pyart_grids(copy='shallow')
+    qc_field = {'data': qc, 'long_name': 'nested retrieval quality flag',
+                'units': '1', 'flag_values': [0, 1, 2],
+                'flag_meanings': 'retrieved no_observations failed'}
+    for grid in new_grid_list:
+        grid.add_field('nested_qc', qc_field, replace_existing=True)
+    if profile:
+        profile_json = timer.to_json()
+        for grid in new_grid_list:
+            grid.metadata['pydda_profile'] = profile_json
 
     return new_grid_list
@@ -0,0 +1,116 @@
+"""
+Stage timers and memory sampling for the wind retrieval, so that slow
+retrievals can be diagnosed from their output without a profiler.
+"""
+
+import json
+import sys
+import time
+
+# The resource module is not available on Windows
+try:
+    import resource
+    RESOURCE_AVAILABLE = True
+except ImportError:
+    RESOURCE_AVAILABLE = False
+
+
+def get_peak_rss():
+    """
+    Gets the peak resident set size of the current process.
+
+    Returns
+    -------
+    peak_rss: float or None
+        The peak resident set size in MB. This is None if it cannot be
+        determined on this platform.
+    """
+    if not RESOURCE_AVAILABLE:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports this in kB, macOS in bytes
+    if sys.platform == 'darwin':
+        return peak_rss/1024.0**2
+    return peak_rss/1024.0
+
+
+class RetrievalProfile(object):
+    """
+    Records the wall time spent in each stage of a retrieval and the peak
+    resident set size at the end of each stage. Stages that are entered
+    more than once accumulate their time.
+
+    Attributes
+    ----------
+    stage_times: dict
+        The time spent in each stage in seconds.
+    peak_rss: dict
+        The peak resident set size of the process in MB at the end of each
+        stage.
+    """
+
+    def __init__(self):
+        self.stage_times = {}
+        self.peak_rss = {}
+        self._stage = None
+        self._stage_start = None
+        self._start = time.time()
+
+    def start_stage(self, name):
+        """
+        Ends the current stage, if any, and starts timing a new stage.
+
+        Parameters
+        ----------
+        name: str
+            The name of the stage.
+        """
+        self.end_stage()
+        self._stage = name
+        self._stage_start = time.time()
+
+    def end_stage(self):
+        """ Ends the current stage. """
+        if self._stage is None:
+            return
+
+        elapsed = time.time() - self._stage_start
+        self.stage_times[self._stage] = (
+            self.stage_times.get(self._stage, 0.0) + elapsed)
+        self.peak_rss[self._stage] = get_peak_rss()
+        self._stage = None
+
+    def add_stage(self, name, elapsed, peak_rss=None):
+        """
+        Adds time that was measured elsewhere, such as on a worker, to a
+        stage.
+
+        Parameters
+        ----------
+        name: str
+            The name of the stage.
+        elapsed: float
+            The time to add in seconds.
+        peak_rss: float or None
+            The peak resident set size in MB that was measured with the
+            time. The stage keeps the largest one that is added.
+        """
+        self.stage_times[name] = self.stage_times.get(name, 0.0) + elapsed
+        if peak_rss is not None:
+            self.peak_rss[name] = max(self.peak_rss.get(name) or 0.0,
+                                      peak_rss)
+
+    def as_dict(self):
+        """
+        Returns the profile as a dict with the keys stage_times, peak_rss_mb
+        and total_time.
+        """
+        self.end_stage()
+        return {'stage_times': dict(self.stage_times),
+                'peak_rss_mb': dict(self.peak_rss),
+                'total_time': time.time() - self._start}
+
+    def to_json(self):
+        """ Returns the profile as a JSON string. """
+        return json.dumps(self.as_dict())
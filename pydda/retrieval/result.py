@@ -0,0 +1,125 @@
+"""
+A lightweight container for the output of a wind retrieval.
+"""
+
+import copy as _copy
+from copy import deepcopy
+
+
+class WindRetrievalResult(object):
+    """
+    This class holds the retrieved wind field along with the information
+    needed to attach it to Py-ART Grids. Unlike the list of Grids that
+    :py:func:`pydda.retrieval.get_dd_wind_field` returns by default, this
+    does not copy any of the input Grids. The Grids are only copied when
+    :py:meth:`to_pyart_grids` is called.
+
+    Attributes
+    ----------
+    u: 3D masked array
+        The retrieved zonal wind.
+    v: 3D masked array
+        The retrieved meridional wind.
+    w: 3D masked array
+        The retrieved vertical wind.
+    coverage: 3D float array
+        The sum of the radar and model weights at each grid point. Points
+        where this is less than 1 are not constrained by any observation.
+    diagnostics: dict
+        Convergence diagnostics of the optimization loop.
+    grids: list of Py-ART Grids
+        References to the input Grids of the retrieval. These are not
+        copied and provide the grid geometry.
+    field_metadata: dict
+        The metadata (everything but the data) to use for the u, v and w
+        fields.
+    profile: dict or None
+        The stage timings and peak memory use of the retrieval if it was
+        run with profile=True, otherwise None.
+    """
+
+    def __init__(self, u, v, w, coverage, grids, diagnostics=None,
+                 field_metadata=None):
+        self.u = u
+        self.v = v
+        self.w = w
+        self.coverage = coverage
+        self.grids = grids
+        if diagnostics is None:
+            diagnostics = {}
+        self.diagnostics = diagnostics
+        if field_metadata is None:
+            field_metadata = {}
+        self.field_metadata = field_metadata
+        self.profile = None
+
+    @property
+    def grid(self):
+        """ The Py-ART Grid containing the grid geometry. """
+        return self.grids[0]
+
+    def get_wind_fields(self):
+        """
+        Makes the Py-ART field dictionaries of the retrieved wind field.
+
+        Returns
+        -------
+        u_field, v_field, w_field: dicts
+            The field dictionaries for u, v and w.
+        """
+        u_field = deepcopy(self.field_metadata)
+        u_field['data'] = self.u
+        u_field['standard_name'] = 'u_wind'
+        u_field['long_name'] = 'meridional component of wind velocity'
+        v_field = deepcopy(self.field_metadata)
+        v_field['data'] = self.v
+        v_field['standard_name'] = 'v_wind'
+        v_field['long_name'] = 'zonal component of wind velocity'
+        w_field = deepcopy(self.field_metadata)
+        w_field['data'] = self.w
+        w_field['standard_name'] = 'w_wind'
+        w_field['long_name'] = 'vertical component of wind velocity'
+        return u_field, v_field, w_field
+
+    def to_pyart_grids(self, grids=None, copy=True):
+        """
+        Attaches the retrieved wind field to Py-ART Grids as the u, v and
+        w fields.
+
+        Parameters
+        ----------
+        grids: list of Py-ART Grids or None
+            The Grids to attach the wind field to. These must have the same
+            grid specification as the retrieval. Set to None to use the
+            input Grids of the retrieval.
+        copy: bool or str
+            If True, the wind field is added to deep copies of the Grids,
+            which is what :py:func:`get_dd_wind_field` returns by default.
+            If False, the wind field is added to the Grids in place.
+            'shallow' adds the wind field to new Grids that share the other
+            fields and the coordinates of the Grids by reference, so only
+            the field and metadata dictionaries are copied.
+
+        Returns
+        -------
+        new_grid_list: list
+            A list of Py-ART Grids containing the derived wind fields.
+        """
+        if grids is None:
+            grids = self.grids
+
+        u_field, v_field, w_field = self.get_wind_fields()
+        new_grid_list = []
+        for grid in grids:
+            if(copy == 'shallow'):
+                grid = _copy.copy(grid)
+                grid.fields = dict(grid.fields)
+                grid.metadata = dict(grid.metadata)
+            elif copy:
+                grid = deepcopy(grid)
+            grid.add_field('u', u_field, replace_existing=True)
+            grid.add_field('v', v_field, replace_existing=True)
+            grid.add_field('w', w_field, replace_existing=True)
+            new_grid_list.append(grid)
+
+        return new_grid_list
@@ -0,0 +1,197 @@
+"""
+Per-iteration telemetry for the wind retrieval. After every iteration of
+the optimizer, :py:func:`pydda.retrieval.get_dd_wind_field` passes a
+record to each of the callbacks given in its callback keyword. A record
+is a dict with these keys:
+
+    stage: str
+        'first_pass' before the low pass filter is applied and 'filter'
+        after it is applied. When multigrid_levels > 1, the iterations on
+        the coarse grids have the stage 'multigrid_<level>', where level 1
+        is the grid that is coarsened once.
+    iteration: int
+        The number of optimizer iterations so far in this stage.
+    cost: float
+        The value of the cost function.
+    terms: dict
+        The value of each term of the cost function. See
+        :py:func:`pydda.cost_functions.calculate_cost_terms`.
+    grad_norm: float
+        The infinity norm of the gradient of the cost function.
+    w_max: float
+        The maximum absolute vertical velocity.
+    num_evaluations: int
+        The number of cost function evaluations so far.
+    elapsed_time: float
+        The time since the start of the optimization in seconds.
+
+Any callable that takes the record can be used as a callback. The classes
+in this module are ready made sinks for the records.
+"""
+
+import json
+import logging
+import time
+
+import numpy as np
+
+
+class MemorySink(object):
+    """
+    Keeps all of the telemetry records in memory.
+
+    Attributes
+    ----------
+    records: list of dicts
+        The telemetry records in the order they were received.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+
+class LoggingSink(object):
+    """
+    Writes each telemetry record to a logger.
+
+    Parameters
+    ----------
+    logger: logging.Logger or None
+        The logger to write to. None will use the pydda.retrieval logger.
+    level: int
+        The logging level of the messages.
+    """
+
+    def __init__(self, logger=None, level=logging.INFO):
+        if logger is None:
+            logger = logging.getLogger('pydda.retrieval')
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, record):
+        self.logger.log(
+            self.level, '%s iteration %d: J = %.4f, |grad J| = %.4f, '
+            'max |w| = %.4f, %d evaluations, %.1f s', record['stage'],
+            record['iteration'], record['cost'], record['grad_norm'],
+            record['w_max'], record['num_evaluations'],
+            record['elapsed_time'])
+
+
+class JSONLinesSink(object):
+    """
+    Writes each telemetry record as one line of JSON.
+
+    Parameters
+    ----------
+    file: str or file-like object
+        The file to write to. If this is a str, the file is opened in
+        append mode and every record is flushed when written.
+    """
+
+    def __init__(self, file):
+        self.file = file
+
+    def __call__(self, record):
+        line = json.dumps(record) + '\n'
+        if isinstance(self.file, str):
+            with open(self.file, 'a') as f:
+                f.write(line)
+        else:
+            self.file.write(line)
+
+
+class PrintSink(object):
+    """
+    Prints the value of each cost function term every few iterations.
+    This is used by get_dd_wind_field when output_cost_functions is True.
+
+    Parameters
+    ----------
+    every: int
+        The number of iterations between the printouts.
+    """
+
+    def __init__(self, every=10):
+        self.every = every
+
+    def __call__(self, record):
+        if record['iteration'] % self.every != 0:
+            return
+
+        terms = record['terms']
+        print(('| Jvel    | Jmass   | Jsmooth |   Jbg   | Jvort   | Jmodel ' +
+               '| Max w  '))
+        print(('|' + "{:9.4f}".format(terms['Jvel']) + '|' +
+               "{:9.4f}".format(terms['Jmass']) + '|' +
+               "{:9.4f}".format(terms['Jsmooth']) + '|' +
+               "{:9.4f}".format(terms['Jbackground']) + '|' +
+               "{:9.4f}".format(terms['Jvorticity']) + '|' +
+               "{:9.4f}".format(terms['Jmod']) + '|' +
+               "{:9.4f}".format(record['w_max'])))
+        print('Norm of gradient: ' + str(record['grad_norm']))
+
+
+class TelemetryRecorder(object):
+    """
+    Collects the values of the cost function terms from each evaluation
+    of the cost function and sends a record to the callbacks after each
+    iteration of the optimizer. The record uses the last evaluation made
+    by the optimizer, which is normally the one at the accepted point, so
+    the recorder never evaluates the cost function itself.
+
+    Parameters
+    ----------
+    callbacks: list of callables
+        The callbacks to pass each record to.
+    """
+
+    def __init__(self, callbacks):
+        self.callbacks = callbacks
+        self.stage = 'first_pass'
+        self.iteration = 0
+        self.num_evaluations = 0
+        self.start_time = time.time()
+        self._last_record = None
+
+    def set_stage(self, stage):
+        """ Starts counting the iterations of a new stage. """
+        self.stage = stage
+        self.iteration = 0
+
+    def record_evaluation(self, x, cost, terms, grad, winds):
+        """
+        Stores the result of an evaluation of the cost function.
+
+        Parameters
+        ----------
+        x: 1D float array
+            The state vector of the optimizer.
+        cost: float
+            The value of the cost function.
+        terms: dict
+            The value of each term of the cost function.
+        grad: 1D float array
+            The gradient of the cost function with respect to x.
+        winds: 1D float array
+            The full flattened (u, v, w) wind field.
+        """
+        self.num_evaluations += 1
+        self._last_record = {
+            'cost': float(cost),
+            'terms': dict([(key, float(value))
+                           for key, value in terms.items()]),
+            'grad_norm': float(np.linalg.norm(grad, np.inf)),
+            'w_max': float(np.abs(winds[2*(len(winds)//3):]).max())}
+
+    def __call__(self, xk):
+        """ The per-iteration callback for the optimizer. """
+        self.iteration += 1
+        record = {'stage': self.stage, 'iteration': self.iteration}
+        record.update(self._last_record)
+        record['num_evaluations'] = self.num_evaluations
+        record['elapsed_time'] = time.time() - self.start_time
+        for callback in self.callbacks:
+            callback(record)
@@ -11,13 +11,19 @@ import cartopy.crs as ccrs
 import math
 
 from .. import cost_functions
-from ..cost_functions import J_function, grad_J
-from scipy.optimize import fmin_l_bfgs_b
+from ..cost_functions import J_and_grad_J, hessp
+from scipy.optimize import fmin_l_bfgs_b, minimize
 from scipy.interpolate import interp1d
-from scipy.signal import savgol_filter
+from scipy.ndimage import binary_dilation, generate_binary_structure
 from matplotlib import pyplot as plt
 from copy import deepcopy
-from .angles import add_azimuth_as_field, add_elevation_as_field
+from .angles import add_azimuth_as_field, add_elevation_as_field, _deg2rad
+from .geometry_cache import add_cached_geometry_as_fields, get_cached_bca
+from .result import WindRetrievalResult
+from .filters import low_pass_filter
+from .telemetry import TelemetryRecorder, PrintSink
+from .profiling import RetrievalProfile
+from .interpolation import regrid_separable, restrict_full_weighting
 
 
 def get_dd_wind_field(Grids, u_init, v_init, w_init, vel_name=None,
@@ -28,9 +34,15 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, vel_name=None,
                       mask_outside_opt=False, weights_obs=None,
                       weights_model=None, weights_bg=None,
                       max_iterations=200, mask_w_outside_opt=True,
-                      filter_window=9, filter_order=4, min_bca=30.0,
+                      filter_window=9, filter_order=3, min_bca=30.0,
                       max_bca=150.0, upper_bc=True, model_fields=None,
-                      output_cost_functions=True):
+                      output_cost_functions=True, active_set_radius=None,
+                      geometry_cache_dir=None, return_result=False,
+                      filter_type='savgol', filter_threads=1, callback=None,
+                      profile=False, solver='lbfgs', multigrid_levels=1,
+                      fall_speed='biggerstaff', hydro_field=None,
+                      compress_observations=False, chunks=None,
+                      fixed_points=None):
     """
     This function takes in a list of Py-ART Grid objects and derives a
     wind field. Every Py-ART Grid in Grids must have the same grid
@@ -149,16 +161,117 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, vel_name=None,
         into model_fields.
     output_cost_functions: bool
         Set to True to output the value of each cost function every
-        10 iterations.
+        10 iterations. The values are taken from the evaluations that
+        the optimizer already does.
+    active_set_radius: int or None
+        If this is an integer, only the grid points that are within this
+        many grid cells of a radar observation or custom constraint are
+        optimized. All other grid points keep the value of the initial guess.
+        This shrinks the state vector of the optimizer. Set to None to
+        optimize every grid point.
+    geometry_cache_dir: str or None
+        Directory of the geometry cache. If this is set, the azimuths,
+        elevations and beam crossing angles of each radar are stored in this
+        directory and reused by retrievals with the same radar locations
+        and grid specification. Set to None to always calculate them.
+    return_result: bool
+        Set to True to return a :py:class:`WindRetrievalResult` instead of
+        copies of every Grid in Grids. This avoids copying the input grids,
+        and the wind field can be attached to them later with
+        :py:meth:`WindRetrievalResult.to_pyart_grids`.
+    filter_type: str
+        The low pass filter to use when filt_iterations > 0. 'savgol' is a
+        Savitzky-Golay filter with filter_window and filter_order.
+        'gaussian' and 'spectral' are cheaper alternatives. See
+        :py:func:`pydda.retrieval.low_pass_filter` for more information.
+    filter_threads: int
+        The number of threads to run the low pass filter on.
+    callback: callable, list of callables or None
+        Each callback is called with a telemetry record after every
+        iteration of the optimizer. The record contains the value of each
+        cost function term, the norm of the gradient, the maximum vertical
+        velocity, the number of evaluations and the elapsed time. See
+        :py:mod:`pydda.retrieval.telemetry` for the contents of the record
+        and for ready made sinks for logging, JSON lines files, and keeping
+        the records in memory.
+    profile: bool
+        Set to True to time each stage of the retrieval (fall speed,
+        geometry, weights, optimizer, filter and output) and sample the peak
+        resident set size at the end of each stage. The profile is stored
+        as a JSON string in the 'pydda_profile' metadata of each output
+        Grid, and as a dict in the profile attribute of the
+        :py:class:`WindRetrievalResult`.
+    solver: str
+        The optimizer to use. 'lbfgs' is L-BFGS-B with the wind speeds
+        bounded by 100 m/s. 'newton-cg', 'trust-ncg' and 'trust-krylov' are
+        Newton-Krylov methods that use the Hessian-vector product from
+        :py:func:`pydda.cost_functions.hessp`. These need far fewer
+        iterations on smooth problems, but do not bound the wind speeds.
+        'trust-krylov' stores its Krylov basis, so it is only practical
+        for small grids. The iterations are still done in blocks of 10
+        until the maximum vertical velocity converges.
+    multigrid_levels: int
+        The number of grids to solve on. When this is more than 1, the
+        observations and constraints are coarsened by a factor of 2 in x
+        and y for each extra level. The retrieval is then solved from the
+        coarsest grid to the finest, with each solution interpolated to the
+        next finer grid as its initial guess. The large scale part of the
+        wind field then converges on the cheap coarse grids.
+    fall_speed: str or 2-tuple
+        The fall speed parameterization to use. This is either the name of
+        a parameterization ('biggerstaff', 'rain', 'snow', 'graupel' or
+        'hail') or a tuple of the relations to use below and above the
+        freezing level. See
+        :py:func:`pydda.cost_functions.calculate_fall_speed`.
+    hydro_field: str or None
+        The name of a hydrometeor classification field in each Grid. If
+        this is given, the fall speed relation at each point is chosen by
+        its hydrometeor class.
+    compress_observations: bool or str
+        True to store the observations in a
+        :py:class:`pydda.cost_functions.PackedObservations` during the
+        optimization. The validity of each observation is then kept as a
+        uint8 weight and the geometry in float32 instead of the float64
+        weights and masked arrays. 'bits' packs the validity into bit masks
+        instead. The observations that they are packed from are then freed,
+        and the fall speeds are not cached on the Grids. This reduces the
+        memory use of retrievals with many radars at the cost of float32
+        round off in the radial velocity term.
+    chunks: int, 2-tuple of ints or None
+        The number of points along y and x in each chunk to evaluate the
+        cost function and its gradient chunk by chunk with dask. The
+        observations are then kept on the dask workers, such as those of an
+        active distributed Client, and a single L-BFGS runs here on the
+        full grid, so the result is the same as without chunks. This cannot
+        be used with compress_observations, the vertical vorticity
+        constraint or solvers other than lbfgs. See
+        :py:class:`pydda.cost_functions.ChunkedCostFunction`.
+    fixed_points: bool array or None
+        True for each grid point that is not optimized and keeps the value
+        of the initial guess, such as a boundary condition. This has to
+        broadcast to the shape of the analysis grid, so a (y, x) array
+        fixes whole columns. It can be combined with active_set_radius.
+        Set to None to let every grid point vary.
 
     Returns
     =======
-    new_grid_list: list
+    new_grid_list: list or WindRetrievalResult
         A list of Py-ART grids containing the derived wind fields. These fields
-        are displayable by the visualization module.
+        are displayable by the visualization module. If return_result is
+        True, this is a :py:class:`WindRetrievalResult` instead.
     """
 
-    num_evaluations = 0
+    if(solver not in ['lbfgs', 'trust-krylov', 'trust-ncg', 'newton-cg']):
+        raise ValueError(('solver must be one of lbfgs, trust-krylov, ' +
+                          'trust-ncg or newton-cg!'))
+    if(compress_observations not in [False, True, 'bits']):
+        raise ValueError('compress_observations must be False, True or bits!')
+    if(chunks is not None and
+       (compress_observations is not False or solver != 'lbfgs')):
+        raise ValueError('chunks can only be used with the lbfgs solver ' +
+                         'and without compress_observations!')
+
+    timer = RetrievalProfile()
 
     # We have to have a prescribed storm motion for vorticity constraint
     if(Ut is None or Vt is None):
@@ -240,65 +353,65 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, vel_name=None,
             raise ValueError(
                  'Cmod must be zero if model fields are not specified!')
 
-    bca = np.zeros(
-        (len(Grids), len(Grids), u_init.shape[1], u_init.shape[2]))
-    M = np.zeros(len(Grids))
-    sum_Vr = np.zeros(len(Grids))
+    # The fall speeds are not cached when the observations are packed, so
+    # that they can be freed once they are packed
+    timer.start_stage('fall_speed')
+    for i in range(len(Grids)):
+        wts.append(cost_functions.calculate_fall_speed(
+            Grids[i], refl_field=refl_field, frz=frz,
+            use_cache=(compress_observations is False),
+            parameterization=fall_speed, hydro_field=hydro_field))
 
+    timer.start_stage('geometry')
     for i in range(len(Grids)):
-        wts.append(cost_functions.calculate_fall_speed(Grids[i],
-                                                       refl_field=refl_field))
-        add_azimuth_as_field(Grids[i], dz_name=refl_field)
-        add_elevation_as_field(Grids[i], dz_name=refl_field)
+        if(geometry_cache_dir is None):
+            add_azimuth_as_field(Grids[i], dz_name=refl_field)
+            add_elevation_as_field(Grids[i], dz_name=refl_field)
+        else:
+            add_cached_geometry_as_fields(Grids[i], geometry_cache_dir,
+                                          dz_name=refl_field)
         vrs.append(Grids[i].fields[vel_name]['data'])
-        azs.append(Grids[i].fields['AZ']['data']*np.pi/180)
-        els.append(Grids[i].fields['EL']['data']*np.pi/180)
+        azs.append(_deg2rad(Grids[i].fields['AZ']['data']))
+        els.append(_deg2rad(Grids[i].fields['EL']['data']))
 
     if(len(Grids) > 1):
-        for i in range(len(Grids)):
-            for j in range(i+1, len(Grids)):
-                print(("Calculating weights for radars " + str(i) +
-                       " and " + str(j)))
-                bca[i, j] = get_bca(Grids[i].radar_longitude['data'],
+        # Only the unique radar pairs (i < j) are needed
+        pairs = [(i, j) for i in range(len(Grids))
+                 for j in range(i+1, len(Grids))]
+        print(("Calculating weights for " + str(len(pairs)) +
+               " radar pairs"))
+        if(geometry_cache_dir is None):
+            bca = np.stack([get_bca(Grids[i].radar_longitude['data'],
                                     Grids[i].radar_latitude['data'],
                                     Grids[j].radar_longitude['data'],
                                     Grids[j].radar_latitude['data'],
                                     Grids[i].point_x['data'][0],
                                     Grids[i].point_y['data'][0],
                                     Grids[i].get_projparams())
-
-                for k in range(vrs[i].shape[0]):
-                    if(weights_obs is None):
-                        cur_array = weights[i, k]
-                        cur_array[np.logical_and(
-                            ~vrs[i][k].mask,
-                            np.logical_and(
-                                bca[i, j] >= math.radians(min_bca),
-                                bca[i, j] <= math.radians(max_bca)))] += 1
-                        weights[i, k] = cur_array
-                    else:
-                        weights[i, k] = weights_obs[i][k, :, :]
-
-                    if(weights_obs is None):
-                        cur_array = weights[j, k]
-                        cur_array[np.logical_and(
-                            ~vrs[j][k].mask,
-                            np.logical_and(
-                                bca[i, j] >= math.radians(min_bca),
-                                bca[i, j] <= math.radians(max_bca)))] += 1
-                        weights[j, k] = cur_array
-                    else:
-                        weights[j, k] = weights_obs[j][k, :, :]
-
-                    if(weights_bg is None):
-                        cur_array = bg_weights[k]
-                        cur_array[np.logical_or(
-                            bca[i, j] >= math.radians(min_bca),
-                            bca[i, j] <= math.radians(max_bca))] = 1
-                        cur_array[vrs[i][k].mask] = 0
-                        bg_weights[i] = cur_array
-                    else:
-                        bg_weights[i] = weights_bg[i]
+                            for i, j in pairs])
+        else:
+            bca = np.stack([get_cached_bca(Grids[i], Grids[j],
+                                           geometry_cache_dir)
+                            for i, j in pairs])
+        timer.start_stage('weights')
+        masks = np.stack([np.ma.getmaskarray(vr) for vr in vrs])
+
+        if(weights_obs is None):
+            weights = _get_pair_weights(bca, pairs, masks, min_bca, max_bca)
+        else:
+            weights = np.stack([np.asarray(weights_obs[i], dtype=float)
+                                for i in range(len(Grids))])
+
+        if(weights_bg is None):
+            with np.errstate(invalid='ignore'):
+                in_any_lobe = np.logical_or(bca >= math.radians(min_bca),
+                                            bca <= math.radians(max_bca))
+            for p, (i, j) in enumerate(pairs):
+                bg_weights[:, in_any_lobe[p]] = 1
+                bg_weights[masks[i]] = 0
+        else:
+            bg_weights = np.asarray(weights_bg, dtype=float)
+        del bca, masks
 
         print("Calculating weights for models...")
         coverage_grade = weights.sum(axis=0)
@@ -314,7 +427,9 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, vel_name=None,
             else:
                 for i in range(len(model_fields)):
                     mod_weights[i] = weights_model[i]
+        del coverage_grade
     else:
+        timer.start_stage('weights')
         weights[0] = np.where(~vrs[0].mask, 1, 0)
         bg_weights = np.where(~vrs[0].mask, 0, 1)
 
@@ -322,13 +437,36 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, vel_name=None,
     sum_Vr = np.sum(np.square(vrs*weights))
     rmsVr = np.sum(sum_Vr)/np.sum(weights)
 
-    del bca
     grid_shape = u_init.shape
     # Parse names of velocity field
 
     winds = winds.flatten()
     ndims = len(winds)
 
+    timer.start_stage('optimizer')
+
+    # Only optimize the points near a constraint if an active set is used
+    if(active_set_radius is not None):
+        constrained = np.sum(weights, axis=0) > 0
+        if(model_fields is not None and Cmod > 0):
+            constrained = np.logical_or(
+                constrained, np.sum(mod_weights, axis=0) > 0)
+        active_index = get_active_set(constrained, active_set_radius)
+    else:
+        active_index = None
+    if(fixed_points is not None):
+        n_points = ndims//3
+        free = np.flatnonzero(~np.broadcast_to(
+            np.asarray(fixed_points, dtype=bool), grid_shape).ravel())
+        free = np.concatenate([free, free + n_points, free + 2*n_points])
+        if(active_index is None):
+            active_index = free
+        else:
+            active_index = np.intersect1d(active_index, free)
+    if(active_index is not None):
+        print('Active set contains ' + str(len(active_index)) + ' of ' +
+              str(ndims) + ' state variables')
+
     print(("Starting solver "))
     dx = np.diff(Grids[0].x['data'], axis=0)[0]
     dy = np.diff(Grids[0].y['data'], axis=0)[0]
@@ -340,15 +478,11 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, vel_name=None,
     the_time = time.time()
     bt = time.time()
 
-    # First pass - no filter
-    wcurr = w_init
-    wprev = 100*np.ones(w_init.shape)
-    wprevmax = 99
-    wcurrmax = w_init.max()
-    iterations = 0
-    warnflag = 99999
-    coeff_max = np.max([Co, Cb, Cm, Cx, Cy, Cz, Cb])
-    bounds = [(-x, x) for x in 100*np.ones(winds.shape)]
+    filter_iterations = 0
+    if(active_index is None):
+        bounds = [(-x, x) for x in 100*np.ones(winds.shape)]
+    else:
+        bounds = [(-x, x) for x in 100*np.ones(active_index.shape)]
 
     u_model = []
     v_model = []
@@ -362,85 +496,85 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, vel_name=None,
             v_model.append(Grids[0].fields[v_field]["data"])
             w_model.append(Grids[0].fields[w_field]["data"])
 
-    while(iterations < max_iterations and
-          (abs(wprevmax-wcurrmax) > 0.02)):
-        wprevmax = wcurrmax
-        winds = fmin_l_bfgs_b(J_function, winds, args=(vrs, azs, els,
-                                                       wts, u_back, v_back,
-                                                       u_model, v_model,
-                                                       w_model,
-                                                       Co, Cm, Cx, Cy, Cz, Cb,
-                                                       Cv, Cmod, Ut, Vt,
-                                                       grid_shape,
-                                                       dx, dy, dz, z, rmsVr,
-                                                       weights, bg_weights,
-                                                       mod_weights,
-                                                       upper_bc,
-                                                       False),
-                              maxiter=10, pgtol=1e-3, bounds=bounds,
-                              fprime=grad_J, disp=0, iprint=-1)
-        if(output_cost_functions is True):
-            J_function(winds[0], vrs, azs, els, wts, u_back, v_back,
-                       u_model, v_model, w_model,
-                       Co, Cm, Cx, Cy, Cz, Cb, Cv, Cmod, Ut, Vt,
-                       grid_shape, dx, dy, dz, z, rmsVr,
-                       weights, bg_weights, mod_weights,
-                       upper_bc, True)
-            grad_J(winds[0], vrs, azs, els, wts, u_back, v_back,
-                   u_model, v_model, w_model,
-                   Co, Cm, Cx, Cy, Cz, Cb, Cv, Cmod, Ut, Vt,
-                   grid_shape, dx, dy, dz, z, rmsVr,
-                   weights, bg_weights, mod_weights,
-                   upper_bc, True)
-        warnflag = winds[2]['warnflag']
-        winds = np.reshape(winds[0], (3, grid_shape[0], grid_shape[1],
-                                      grid_shape[2]))
-        iterations = iterations+10
-        print('Iterations before filter: ' + str(iterations))
-        wcurrmax = winds[2].max()
-        winds = np.stack([winds[0], winds[1], winds[2]])
-        winds = winds.flatten()
+    args = (vrs, azs, els, wts, u_back, v_back, u_model, v_model, w_model,
+            Co, Cm, Cx, Cy, Cz, Cb, Cv, Cmod, Ut, Vt, grid_shape,
+            dx, dy, dz, z, rmsVr, weights, bg_weights, mod_weights,
+            upper_bc)
+
+    if(callback is None):
+        callbacks = []
+    elif callable(callback):
+        callbacks = [callback]
+    else:
+        callbacks = list(callback)
+    if(output_cost_functions is True):
+        callbacks.append(PrintSink(every=10))
+    if(len(callbacks) > 0):
+        recorder = TelemetryRecorder(callbacks)
+    else:
+        recorder = None
+
+    coarse_iterations = []
+    if(multigrid_levels > 1):
+        timer.start_stage('multigrid')
+        first_guess, coarse_iterations = _solve_multigrid(
+            winds, args, Grids[0].y['data'], Grids[0].x['data'],
+            multigrid_levels, recorder, solver, max_iterations,
+            compress_observations)
+        if(active_index is None):
+            winds = first_guess.flatten()
+        else:
+            winds[active_index] = first_guess.flatten()[active_index]
+        if(recorder is not None):
+            recorder.set_stage('first_pass')
+        timer.start_stage('optimizer')
+
+    if(compress_observations is not False):
+        # Only the packed observations are kept for the optimization, so
+        # the lists and the weights that they were packed from are freed
+        args = _pack_args(args, compress_observations)
+        del vrs, azs, els, wts
+        weights = None
+        print('Packed observations use ' +
+              "{:2.1f}".format(args[0].nbytes/1e6) + ' MB')
+
+    if(chunks is not None):
+        args = _chunk_args(args, chunks)
+        print('Evaluating the cost function in ' +
+              str(len(args[0].static_blocks)) + ' chunks')
+
+    # First pass - no filter
+    winds, stats = _solve(winds, args, bounds, active_index, recorder,
+                          solver, max_iterations)
+    iterations = stats['iterations']
+    num_evaluations = stats['num_evaluations']
+    warnflag = stats['warnflag']
 
     if(filt_iterations > 0):
         print('Applying low pass filter to wind field...')
-        winds = np.reshape(winds, (3, grid_shape[0], grid_shape[1],
-                                   grid_shape[2]))
-        winds[0] = savgol_filter(winds[0], 9, 3, axis=0)
-        winds[0] = savgol_filter(winds[0], 9, 3, axis=1)
-        winds[0] = savgol_filter(winds[0], 9, 3, axis=2)
-        winds[1] = savgol_filter(winds[1], 9, 3, axis=0)
-        winds[1] = savgol_filter(winds[1], 9, 3, axis=1)
-        winds[1] = savgol_filter(winds[1], 9, 3, axis=2)
-        winds[2] = savgol_filter(winds[2], 9, 3, axis=0)
-        winds[2] = savgol_filter(winds[2], 9, 3, axis=1)
-        winds[2] = savgol_filter(winds[2], 9, 3, axis=2)
-        winds = np.stack([winds[0], winds[1], winds[2]])
-        winds = winds.flatten()
-        iterations = 0
-        while(iterations < filt_iterations):
-            winds = fmin_l_bfgs_b(
-                J_function, winds, args=(vrs, azs, els,
-                                         wts, u_back, v_back,
-                                         u_model, v_model, w_model,
-                                         Co, Cm, Cx, Cy, Cz, Cb,
-                                         Cv, Cmod, Ut, Vt,
-                                         grid_shape,
-                                         dx, dy, dz, z, rmsVr,
-                                         weights, bg_weights,
-                                         mod_weights,
-                                         upper_bc,
-                                         False),
-                maxiter=10, pgtol=1e-3, bounds=bounds,
-                fprime=grad_J, disp=0, iprint=-1)
-
-            warnflag = winds[2]['warnflag']
-            winds = np.reshape(winds[0], (3, grid_shape[0], grid_shape[1],
-                                          grid_shape[2]))
-            iterations = iterations+1
-            print('Iterations after filter: ' + str(iterations))
-            winds = np.stack([winds[0], winds[1], winds[2]])
-            winds = winds.flatten()
+        timer.start_stage('filter')
+        filtered = np.reshape(winds, (3, grid_shape[0], grid_shape[1],
+                                      grid_shape[2]))
+        filtered = low_pass_filter(filtered, filter_type=filter_type,
+                                   window=filter_window, order=filter_order,
+                                   num_threads=filter_threads)
+        # The points outside of the active set keep their initial guess
+        if(active_index is None):
+            winds = filtered.flatten()
+        else:
+            winds[active_index] = filtered.flatten()[active_index]
+        timer.start_stage('optimizer')
+        if(recorder is not None):
+            recorder.set_stage('filter')
+        while(filter_iterations < filt_iterations):
+            winds, info = _minimize(winds, args, bounds, 10,
+                                    active_index, recorder, solver)
+            num_evaluations += info['funcalls']
+            warnflag = info['warnflag']
+            filter_iterations = filter_iterations+1
+            print('Iterations after filter: ' + str(filter_iterations))
     print("Done! Time = " + "{:2.1f}".format(time.time() - bt))
+    timer.start_stage('output')
 
     # First pass - no filter
     the_winds = np.reshape(winds, (3, grid_shape[0], grid_shape[1],
@@ -448,7 +582,11 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, vel_name=None,
     u = the_winds[0]
     v = the_winds[1]
     w = the_winds[2]
-    where_mask = np.sum(weights, axis=0) + np.sum(mod_weights, axis=0)
+    if(compress_observations is not False):
+        obs_coverage = args[0].get_coverage()
+    else:
+        obs_coverage = np.sum(weights, axis=0)
+    where_mask = obs_coverage + np.sum(mod_weights, axis=0)
     
     u = np.ma.array(u)
     w = np.ma.array(w)
@@ -462,34 +600,31 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, vel_name=None,
     if(mask_w_outside_opt is True):
         w = np.ma.masked_where(where_mask < 1, w)
 
-    u_field = deepcopy(Grids[0].fields[vel_name])
-    u_field['data'] = u
-    u_field['standard_name'] = 'u_wind'
-    u_field['long_name'] = 'meridional component of wind velocity'
-    u_field['min_bca'] = min_bca
-    u_field['max_bca'] = max_bca
-    v_field = deepcopy(Grids[0].fields[vel_name])
-    v_field['data'] = v
-    v_field['standard_name'] = 'v_wind'
-    v_field['long_name'] = 'zonal component of wind velocity'
-    v_field['min_bca'] = min_bca
-    v_field['max_bca'] = max_bca
-    w_field = deepcopy(Grids[0].fields[vel_name])
-    w_field['data'] = w
-    w_field['standard_name'] = 'w_wind'
-    w_field['long_name'] = 'vertical component of wind velocity'
-    w_field['min_bca'] = min_bca
-    w_field['max_bca'] = max_bca
-
-    new_grid_list = []
-
-    for grid in Grids:
-        temp_grid = deepcopy(grid)
-        temp_grid.add_field('u', u_field, replace_existing=True)
-        temp_grid.add_field('v', v_field, replace_existing=True)
-        temp_grid.add_field('w', w_field, replace_existing=True)
-        new_grid_list.append(temp_grid)
-
+    field_metadata = dict([(key, deepcopy(value)) for key, value in
+                           Grids[0].fields[vel_name].items()
+                           if key != 'data'])
+    field_metadata['min_bca'] = min_bca
+    field_metadata['max_bca'] = max_bca
+    diagnostics = {'iterations': iterations,
+                   'filter_iterations': filter_iterations,
+                   'num_evaluations': num_evaluations,
+                   'warnflag': warnflag,
+                   'w_max_change': stats['w_max_change'],
+                   'coarse_iterations': coarse_iterations,
+                   'elapsed_time': time.time() - bt}
+    result = WindRetrievalResult(u, v, w, where_mask, Grids,
+                                 diagnostics=diagnostics,
+                                 field_metadata=field_metadata)
+    if(return_result is True):
+        if(profile is True):
+            result.profile = timer.as_dict()
+        return result
+
+    new_grid_list = result.to_pyart_grids()
+    if(profile is True):
+        profile_json = timer.to_json()
+        for grid in new_grid_list:
+            grid.metadata['pydda_profile'] = profile_json
     return new_grid_list
 
 
@@ -534,3 +669,251 @@ def get_bca(rad1_lon, rad1_lat, rad2_lon, rad2_lat, x, y, projparams):
     theta_1 = np.arccos(x/a)
     theta_2 = np.arccos((x-rad2[1])/b)
     return np.arccos((a*a+b*b-c*c)/(2*a*b))
+
+
+def get_active_set(constrained, radius):
+    """
+    This function gets the indices of the state vector that are optimized
+    when the retrieval is restricted to an active set of grid points near
+    the constraints.
+
+    Parameters
+    ==========
+    constrained: 3D bool array
+        True for each grid point that has an observation or a custom
+        constraint.
+    radius: int
+        The number of grid cells around each constrained point to include
+        in the active set.
+
+    Returns
+    =======
+    active_index: 1D int array
+        The indices into the flattened (u, v, w) state vector of the
+        variables in the active set.
+    """
+    if(radius > 0):
+        structure = generate_binary_structure(3, 3)
+        active = binary_dilation(constrained, structure=structure,
+                                 iterations=int(radius))
+    else:
+        active = np.asarray(constrained, dtype=bool)
+
+    active = np.flatnonzero(active.ravel())
+    n_points = constrained.size
+    return np.concatenate(
+        [active, active + n_points, active + 2*n_points])
+
+
+def _J_and_grad(x, winds, active_index, recorder, *args):
+    # Insert the active set into the full state vector. The frozen points
+    # keep the value that they had in winds.
+    if(active_index is None):
+        winds = x
+    else:
+        winds[active_index] = x
+
+    terms = {}
+    J, grad = J_and_grad_J(winds, *args, terms=terms)
+    if(active_index is not None):
+        grad = grad[active_index]
+    if(recorder is not None):
+        recorder.record_evaluation(x, J, terms, grad, winds)
+    return J, grad
+
+
+def _solve(winds, args, bounds, active_index, recorder, solver,
+           max_iterations):
+    # Run blocks of 10 iterations until the maximum vertical velocity
+    # changes by less than 0.02 m/s or max_iterations is reached
+    grid_shape = args[19]
+    wprevmax = 99
+    wcurrmax = np.reshape(winds, (3,) + tuple(grid_shape))[2].max()
+    iterations = 0
+    num_evaluations = 0
+    warnflag = 99999
+    while(iterations < max_iterations and
+          (abs(wprevmax-wcurrmax) > 0.02)):
+        wprevmax = wcurrmax
+        winds, info = _minimize(winds, args, bounds, 10, active_index,
+                                recorder, solver)
+        num_evaluations += info['funcalls']
+        warnflag = info['warnflag']
+        iterations = iterations+10
+        print('Iterations before filter: ' + str(iterations))
+        wcurrmax = np.reshape(winds, (3,) + tuple(grid_shape))[2].max()
+
+    stats = {'iterations': iterations,
+             'num_evaluations': num_evaluations,
+             'warnflag': warnflag,
+             'w_max_change': abs(wprevmax - wcurrmax)}
+    return winds, stats
+
+
+def _coarsen_args(args):
+    # Coarsen the arguments of the cost function by a factor of 2 in x and
+    # y. The observations are full weighting averages of the valid fine
+    # observations, and the geometry and the other constraints are taken
+    # at the coarse points.
+    (vrs, azs, els, wts, u_back, v_back, u_model, v_model, w_model,
+     Co, Cm, Cx, Cy, Cz, Cb, Cv, Cmod, Ut, Vt, grid_shape,
+     dx, dy, dz, z, rmsVr, weights, bg_weights, mod_weights,
+     upper_bc) = args
+
+    coarse_vrs = []
+    coarse_wts = []
+    coarse_weights = []
+    for i in range(len(vrs)):
+        valid = np.logical_not(np.logical_or.reduce(
+            [np.ma.getmaskarray(vrs[i]), np.ma.getmaskarray(wts[i]),
+             np.ma.getmaskarray(azs[i]), np.ma.getmaskarray(els[i])]))
+        valid = valid*np.asarray(weights[i], dtype=float)
+        valid_sum = restrict_full_weighting(valid)
+        has_data = valid_sum >= 0.5
+        with np.errstate(invalid='ignore', divide='ignore'):
+            vr = restrict_full_weighting(
+                valid*np.ma.filled(vrs[i], 0))/valid_sum
+            wt = restrict_full_weighting(
+                valid*np.ma.filled(wts[i], 0))/valid_sum
+        coarse_vrs.append(np.ma.masked_where(~has_data, vr))
+        coarse_wts.append(np.ma.masked_where(~has_data, wt))
+        coarse_weights.append(has_data.astype(float))
+
+    coarse_shape = coarse_weights[0].shape
+    return (coarse_vrs, [az[:, ::2, ::2] for az in azs],
+            [el[:, ::2, ::2] for el in els], coarse_wts, u_back, v_back,
+            [u[:, ::2, ::2] for u in u_model],
+            [v[:, ::2, ::2] for v in v_model],
+            [w[:, ::2, ::2] for w in w_model],
+            Co, Cm, Cx, Cy, Cz, Cb, Cv, Cmod, Ut, Vt, coarse_shape,
+            2*dx, 2*dy, dz, z[:, ::2, ::2], rmsVr, np.stack(coarse_weights),
+            bg_weights[:, ::2, ::2], mod_weights[:, :, ::2, ::2], upper_bc)
+
+
+def _pack_args(args, compress):
+    # Replace the observations and their weights in the arguments of the
+    # cost function with PackedObservations
+    packed = cost_functions.PackedObservations(
+        args[0], args[1], args[2], args[3], args[25],
+        bit_masks=(compress == 'bits'))
+    return (packed, None, None, None) + args[4:25] + (None,) + args[26:]
+
+
+def _chunk_args(args, chunks):
+    # Replace the radial velocities in the arguments of the cost function
+    # with a ChunkedCostFunction that evaluates it with dask
+    return ((cost_functions.ChunkedCostFunction(args, chunks),) +
+            tuple(args[1:]))
+
+
+def _solve_multigrid(winds, args, y, x, levels, recorder, solver,
+                     max_iterations, compress=False):
+    # Solve the retrieval on coarsened copies of the problem from the
+    # coarsest to the finest and return the first guess for the full grid
+    # along with the number of iterations on each coarse grid
+    pyramid = [(args, y, x)]
+    for level in range(1, levels):
+        level_args, level_y, level_x = pyramid[-1]
+        if(min(len(level_y), len(level_x)) < 10):
+            print('Grid is too small for more than ' + str(level) +
+                  ' multigrid levels')
+            break
+        pyramid.append((_coarsen_args(level_args), level_y[::2],
+                        level_x[::2]))
+
+    step = 2**(len(pyramid) - 1)
+    winds = np.reshape(winds, (3,) + tuple(args[19]))
+    level_winds = winds[:, :, ::step, ::step]
+    iterations = []
+    for level in range(len(pyramid) - 1, 0, -1):
+        level_args, level_y, level_x = pyramid[level]
+        level_shape = tuple(level_args[19])
+        print('Solving on multigrid level ' + str(level) + ' with shape ' +
+              str(level_shape))
+        if(recorder is not None):
+            recorder.set_stage('multigrid_' + str(level))
+        bounds = [(-100, 100)]*(3*int(np.prod(level_shape)))
+        if(compress is not False):
+            level_args = _pack_args(level_args, compress)
+        level_winds, stats = _solve(
+            level_winds.flatten(), level_args, bounds, None, recorder,
+            solver, max_iterations)
+        iterations.append(stats['iterations'])
+        level_winds = regrid_separable(
+            np.reshape(level_winds, (3,) + level_shape),
+            [level_y, level_x], pyramid[level - 1][1:])
+    return level_winds, iterations
+
+
+def _hessp(x, p, winds, active_index, recorder, *args):
+    # Hessian-vector product of the cost function restricted to the
+    # active set
+    if(active_index is None):
+        return hessp(x, p, *args)
+
+    winds = winds.copy()
+    winds[active_index] = x
+    p_full = np.zeros(winds.shape)
+    p_full[active_index] = p
+    return hessp(winds, p_full, *args)[active_index]
+
+
+def _minimize(winds, args, bounds, maxiter, active_index=None,
+              recorder=None, solver='lbfgs'):
+    # Run maxiter iterations of the given solver and return the full state
+    # vector along with a dict with the number of function calls and the
+    # warning flag of the solver
+    if(solver == 'lbfgs'):
+        return _minimize_lbfgs(winds, args, bounds, maxiter, active_index,
+                               recorder)
+
+    if(active_index is None):
+        x0 = winds
+    else:
+        winds = winds.copy()
+        x0 = winds[active_index]
+    opt_args = (winds, active_index, recorder) + args
+
+    result = minimize(_J_and_grad, x0, args=opt_args, method=solver,
+                      jac=True, hessp=_hessp, callback=recorder,
+                      options={'maxiter': maxiter})
+    info = {'funcalls': result.nfev, 'warnflag': result.status}
+    if(active_index is None):
+        return result.x, info
+
+    winds[active_index] = result.x
+    return winds, info
+
+
+def _minimize_lbfgs(winds, args, bounds, maxiter, active_index=None,
+                    recorder=None):
+    # Run maxiter iterations of L-BFGS-B and return the full state vector
+    # along with the information dictionary from fmin_l_bfgs_b
+    if(active_index is None):
+        x0 = winds
+    else:
+        winds = winds.copy()
+        x0 = winds[active_index]
+    opt_args = (winds, active_index, recorder) + args
+
+    x, f, info = fmin_l_bfgs_b(_J_and_grad, x0, args=opt_args,
+                               maxiter=maxiter, pgtol=1e-3, bounds=bounds,
+                               disp=0, iprint=-1, callback=recorder)
+    if(active_index is None):
+        return x, info
+
+    winds[active_index] = x
+    return winds, info
+
+
+def _get_pair_weights(bca, pairs, masks, min_bca, max_bca):
+    # Each radar gets one point of weight for every radar pair whose beam
+    # crossing angle is within (min_bca, max_bca) and where it has data.
+    with np.errstate(invalid='ignore'):
+        in_lobe = np.logical_and(bca >= math.radians(min_bca),
+                                 bca <= math.radians(max_bca))
+    pairs = np.asarray(pairs)
+    pair_count = np.zeros((masks.shape[0],) + bca.shape[1:])
+    np.add.at(pair_count, pairs[:, 0], in_lobe)
+    np.add.at(pair_count, pairs[:, 1], in_lobe)
+    return np.logical_not(masks)*pair_count[:, np.newaxis]
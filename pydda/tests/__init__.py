@@ -17,3 +17,6 @@ This module contains links to test files for PyDDA.
 from .sample_files import EXAMPLE_RADAR0, EXAMPLE_RADAR1
 from .sample_files import SOUNDING_PATH
 from .procedures import make_test_divergence_field
+from .procedures import make_synthetic_radar_grids
+from .procedures import make_synthetic_retrieval
+from .procedures import get_radial_velocity_inputs
@@ -1,6 +1,15 @@
+import os
+import tempfile
+
 import numpy as np
 import pyart
 
+from ..cost_functions import calculate_fall_speed
+from ..retrieval.angles import add_azimuth_as_field, add_elevation_as_field
+from ..retrieval.angles import gc_bear_array, gc_dist
+from ..retrieval.angles import rsl_get_slantr_and_elev
+
+
 def make_test_divergence_field(Grid, wind_vel, z_ground, z_top, radius,
                                back_u, back_v, x_center, y_center):
     """
@@ -53,3 +62,337 @@ def make_test_divergence_field(Grid, wind_vel, z_ground, z_top, radius,
     w = np.ma.array(w)
     return u, v, w
 
+
+def make_synthetic_radar_grids(grid_shape, grid_limits=None, num_radars=2,
+                               radar_distance=None, wind_func=None,
+                               refl_func=None, max_range=None,
+                               min_elevation=0.5, max_elevation=60.0,
+                               min_refl=0.0, noise_std=0.0,
+                               vel_field='velocity',
+                               refl_field='reflectivity', lazy=False,
+                               memmap_dir=None, dtype=np.float32, seed=0):
+    """
+    This function makes a synthetic scene of a convective cell observed by
+    several virtual radars. The winds and the reflectivity are analytic and
+    the radial velocities are simulated from the winds and the fall speed
+    with the same geometry that is used by the retrieval. This is useful
+    for scaling tests of the retrieval where no real data are available.
+
+    The fields are computed one vertical level at a time so that large
+    grids (such as 60 x 1000 x 1000) can be made with memory mapped
+    fields without making full size temporaries.
+
+    Parameters
+    ----------
+    grid_shape: 3-tuple of ints
+        The number of points in the (z, y, x) coordinates.
+    grid_limits: 3-tuple of 2-tuples or None
+        The minimum and maximum (z, y, x) coordinates in meters. None will
+        use a grid spacing of 1 km in the horizontal and 500 m in the
+        vertical that is centered on the origin.
+    num_radars: int
+        The number of virtual radars.
+    radar_distance: float or None
+        The radars are evenly spaced on a circle of this radius in meters
+        around the center of the grid. None will use 30% of the smallest
+        horizontal extent of the grid.
+    wind_func: function or None
+        A function that takes 2D x, y arrays and a height z in meters and
+        returns the u, v and w 2D arrays at that height. None will use a
+        rotating updraft with low level convergence, upper level divergence
+        and a sheared background wind.
+    refl_func: function or None
+        A function that takes 2D x, y arrays and a height z in meters and
+        returns the 2D reflectivity in dBZ at that height. None will use
+        a Gaussian cell centered on the updraft.
+    max_range: float or None
+        The maximum range of the radars in meters. None will not limit
+        the range.
+    min_elevation: float
+        The minimum elevation angle in degrees. Points below the lowest
+        beam are masked.
+    max_elevation: float
+        The maximum elevation angle in degrees. Points in the cone of
+        silence above the highest beam are masked.
+    min_refl: float
+        Points with a reflectivity below this value in dBZ have no echo
+        and are masked.
+    noise_std: float
+        The standard deviation of the Gaussian noise added to the radial
+        velocities in m/s.
+    vel_field: str
+        The name of the radial velocity field.
+    refl_field: str
+        The name of the reflectivity field.
+    lazy: bool
+        If True, the fields are only computed when their 'data' are first
+        accessed.
+    memmap_dir: str or None
+        If this is a directory, the fields are stored in memory mapped
+        files with unique names in this directory, so several scenes can
+        use the same directory. None will store them in memory.
+    dtype: numpy dtype
+        The data type of the fields.
+    seed: int
+        The seed of the random number generator for the noise.
+
+    Returns
+    -------
+    grids: list of Py-ART Grids
+        One Grid with the radial velocity and reflectivity for each radar.
+    truth: dict
+        The true 'u', 'v' and 'w' fields. When lazy is True this is a
+        Py-ART LazyLoadDict.
+    """
+    nz, ny, nx = grid_shape
+    if grid_limits is None:
+        grid_limits = ((0.0, 500.0*(nz - 1)),
+                       (-500.0*(ny - 1), 500.0*(ny - 1)),
+                       (-500.0*(nx - 1), 500.0*(nx - 1)))
+    (z0, z1), (y0, y1), (x0, x1) = grid_limits
+    x_center = (x0 + x1)/2
+    y_center = (y0 + y1)/2
+    width = min(x1 - x0, y1 - y0)
+    if radar_distance is None:
+        radar_distance = 0.3*width
+
+    default_wind_func, default_refl_func = _make_default_scene(
+        x_center, y_center, width, max(z1, 1.0))
+    if wind_func is None:
+        wind_func = default_wind_func
+    if refl_func is None:
+        refl_func = default_refl_func
+
+    grids = []
+    for i in range(num_radars):
+        grid = pyart.testing.make_empty_grid(grid_shape, grid_limits)
+        angle = 2*np.pi*i/num_radars
+        lon, lat = pyart.core.cartesian_to_geographic_aeqd(
+            x_center + radar_distance*np.sin(angle),
+            y_center + radar_distance*np.cos(angle),
+            grid.origin_longitude['data'][0],
+            grid.origin_latitude['data'][0])
+        grid.radar_latitude['data'] = np.atleast_1d(lat)
+        grid.radar_longitude['data'] = np.atleast_1d(lon)
+        grid.radar_altitude['data'] = np.array([0.0])
+        grid.radar_name['data'] = np.array(['Synthetic%d' % i])
+        grids.append(grid)
+
+    def allocate(name, dtype=dtype):
+        if memmap_dir is None:
+            return np.empty(grid_shape, dtype=dtype)
+        # Each scene gets its own files, so scenes can share memmap_dir
+        fd, file_name = tempfile.mkstemp(prefix=name + '_', suffix='.dat',
+                                         dir=memmap_dir)
+        os.close(fd)
+        return np.memmap(file_name, dtype=dtype, mode='w+',
+                         shape=grid_shape)
+
+    scene = {}
+
+    def get_scene():
+        # The winds and reflectivity are the same for all radars, so they
+        # are only computed once.
+        if not scene:
+            scene.update(_compute_scene_fields(
+                grids[0], wind_func, refl_func, min_refl, allocate))
+        return scene
+
+    def get_fall_speed():
+        if 'wt' not in scene:
+            scene['wt'] = np.ma.abs(calculate_fall_speed(
+                grids[0], refl_field=refl_field))
+        return scene['wt']
+
+    def get_vel(i):
+        def load():
+            rng = np.random.RandomState(seed + i)
+            return _simulate_radial_velocity(
+                grids[i], get_scene(), get_fall_speed(), rng, noise_std,
+                max_range, min_elevation, max_elevation,
+                allocate('%s_%d' % (vel_field, i)),
+                allocate('%s_%d_mask' % (vel_field, i), dtype=bool))
+        return load
+
+    def get_truth(key):
+        return lambda: get_scene()[key]
+
+    for i, grid in enumerate(grids):
+        grid.fields[refl_field] = _make_field_dict(
+            lambda: get_scene()['refl'], lazy, 'equivalent_reflectivity_'
+            'factor', 'Reflectivity', 'dBZ')
+        grid.fields[vel_field] = _make_field_dict(
+            get_vel(i), lazy, 'radial_velocity_of_scatterers_away_from_'
+            'instrument', 'Radial velocity', 'm/s')
+
+    if lazy:
+        truth = pyart.lazydict.LazyLoadDict({})
+        for key in ['u', 'v', 'w']:
+            truth.set_lazy(key, get_truth(key))
+    else:
+        truth = dict([(key, get_scene()[key]) for key in ['u', 'v', 'w']])
+    return grids, truth
+
+
+def make_synthetic_retrieval(grid_shape, **kwargs):
+    """
+    This function makes a synthetic scene with
+    :py:func:`make_synthetic_radar_grids` along with a first guess of no
+    wind, which is what a test retrieval on the scene starts from.
+
+    Parameters
+    ----------
+    grid_shape: 3-tuple of ints
+        The number of points in the (z, y, x) coordinates.
+    **kwargs: dict
+        The keyword arguments of make_synthetic_radar_grids.
+
+    Returns
+    -------
+    grids: list of Py-ART Grids
+        One Grid with the radial velocity and reflectivity for each radar.
+    truth: dict
+        The true 'u', 'v' and 'w' fields.
+    init: 3-tuple of 3D arrays
+        The first guess of u, v and w, which are all zero.
+    """
+    grids, truth = make_synthetic_radar_grids(grid_shape, **kwargs)
+    init = tuple(np.zeros(grid_shape) for i in range(3))
+    return grids, truth, init
+
+
+def get_radial_velocity_inputs(grids, vel_field='velocity',
+                               refl_field='reflectivity'):
+    """
+    This function adds the azimuth and elevation fields to each Grid and
+    gets the inputs of the radial velocity cost function from the Grids,
+    such as those of :py:func:`make_synthetic_radar_grids`.
+
+    Parameters
+    ----------
+    grids: list of Py-ART Grids
+        One Grid for each radar.
+    vel_field: str
+        The name of the radial velocity field.
+    refl_field: str
+        The name of the reflectivity field.
+
+    Returns
+    -------
+    vrs: list of 3D arrays
+        The radial velocities of each radar.
+    azs: list of 3D arrays
+        The azimuths of each radar in radians.
+    els: list of 3D arrays
+        The elevations of each radar in radians.
+    wts: list of 3D arrays
+        The fall speeds in each Grid.
+    """
+    vrs = []
+    azs = []
+    els = []
+    wts = []
+    for grid in grids:
+        add_azimuth_as_field(grid, dz_name=refl_field)
+        add_elevation_as_field(grid, dz_name=refl_field)
+        vrs.append(grid.fields[vel_field]['data'])
+        azs.append(np.deg2rad(grid.fields['AZ']['data']))
+        els.append(np.deg2rad(grid.fields['EL']['data']))
+        wts.append(calculate_fall_speed(grid, refl_field=refl_field))
+    return vrs, azs, els, wts
+
+
+def _make_default_scene(x_center, y_center, width, z_top):
+    """
+    Makes the functions for the winds and reflectivity of a rotating
+    updraft with low level convergence and upper level divergence in a
+    sheared environment.
+    """
+    radius = width/10.0
+
+    def wind_func(x, y, z):
+        xr = (x - x_center)/radius
+        yr = (y - y_center)/radius
+        gauss = np.exp(-(np.square(xr) + np.square(yr)))
+        phi = np.pi*z/z_top
+        u = 5.0 + 10.0*z/z_top + (-10.0*np.cos(phi)*xr - 15.0*yr)*gauss
+        v = (-10.0*np.cos(phi)*yr + 15.0*xr)*gauss
+        w = 20.0*np.sin(phi)*gauss
+        return u, v, w
+
+    def refl_func(x, y, z):
+        rsq = (np.square(x - x_center) + np.square(y - y_center))/(
+            9*radius**2)
+        return -10.0 + 65.0*np.exp(-rsq)*(1 - 0.5*z/z_top)
+
+    return wind_func, refl_func
+
+
+def _compute_scene_fields(grid, wind_func, refl_func, min_refl, allocate):
+    """
+    Computes the winds and reflectivity of the scene one level at a time.
+    """
+    x, y = np.meshgrid(grid.x['data'], grid.y['data'])
+    fields = {}
+    for key in ['u', 'v', 'w', 'refl']:
+        fields[key] = allocate(key)
+    refl_mask = allocate('refl_mask', dtype=bool)
+    for k, z in enumerate(grid.z['data']):
+        fields['u'][k], fields['v'][k], fields['w'][k] = wind_func(x, y, z)
+        fields['refl'][k] = refl_func(x, y, z)
+        refl_mask[k] = fields['refl'][k] < min_refl
+
+    fields['refl'] = np.ma.MaskedArray(
+        fields['refl'], mask=refl_mask, copy=False)
+    return fields
+
+
+def _simulate_radial_velocity(grid, scene, fall_speed, rng, noise_std,
+                              max_range, min_elevation, max_elevation, vel,
+                              mask):
+    """
+    Simulates the radial velocities seen by the radar of a Grid one level
+    at a time. This uses the same geometry as the retrieval.
+    """
+    lon, lat = grid.get_point_longitude_latitude(level=0)
+    radar_lat = grid.radar_latitude['data'][0]
+    radar_lon = grid.radar_longitude['data'][0]
+    az = np.deg2rad(gc_bear_array(radar_lat, radar_lon, lat, lon))
+    with np.errstate(invalid='ignore'):
+        gr = gc_dist(radar_lat, radar_lon, lat, lon)
+    heights = grid.z['data'] - grid.radar_altitude['data'][0]
+    refl_mask = np.ma.getmaskarray(scene['refl'])
+    wt_mask = np.ma.getmaskarray(fall_speed)
+    wt = np.ma.getdata(fall_speed)
+    for k in range(grid.nz):
+        with np.errstate(invalid='ignore'):
+            slantr, el = rsl_get_slantr_and_elev(gr, heights[k]/1000.0)
+            mask[k] = np.logical_or.reduce(
+                [~np.isfinite(el), el < min_elevation, el > max_elevation,
+                 refl_mask[k], wt_mask[k]])
+            if max_range is not None:
+                mask[k] = np.logical_or(mask[k], slantr*1000.0 > max_range)
+        el = np.deg2rad(np.where(np.isfinite(el), el, 0.0))
+        vel[k] = (np.cos(el)*np.sin(az)*scene['u'][k] +
+                  np.cos(el)*np.cos(az)*scene['v'][k] +
+                  np.sin(el)*(scene['w'][k] - wt[k]))
+        if noise_std > 0:
+            vel[k] += noise_std*rng.standard_normal(vel[k].shape)
+
+    return np.ma.MaskedArray(vel, mask=mask, copy=False)
+
+
+def _make_field_dict(load, lazy, standard_name, long_name, units):
+    """
+    Makes a Py-ART field dictionary whose data are given by load.
+    """
+    field_dict = {'standard_name': standard_name,
+                  'long_name': long_name,
+                  'units': units,
+                  '_FillValue': -9999.0}
+    if lazy:
+        field_dict = pyart.lazydict.LazyLoadDict(field_dict)
+        field_dict.set_lazy('data', load)
+    else:
+        field_dict['data'] = load()
+    return field_dict
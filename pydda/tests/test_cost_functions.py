@@ -49,6 +49,66 @@ def test_calculate_fall_speed():
     assert fall_speed[1, 1, 1] < -3
 
 
+def test_fall_speed_regimes():
+    """ Are the regime boundaries covered and is the fall speed cached? """
+    grid_shape = (2, 1, 4)
+    grid_limits = ((0, 10000), (0, 0), (-1000, 1000))
+    grid = pyart.testing.make_empty_grid(grid_shape, grid_limits)
+    ref_field = np.ma.array([[[30, 49, 55, 60]], [[30, 33, 49, 60]]],
+                            dtype=float)
+    grid.add_field('reflectivity', {'data': ref_field})
+    fall_speed = pydda.cost_functions.calculate_fall_speed(
+        grid, refl_field='reflectivity')
+    assert np.all(fall_speed < 0)
+    np.testing.assert_allclose(fall_speed[0, 0, 3],
+                               -3.95*10**(60*0.0148)*1.2**0.4)
+    np.testing.assert_allclose(
+        fall_speed[1, 0, 2], -3.95*10**(49*0.0148)*(1.2/np.exp(-1))**0.4)
+    assert pydda.cost_functions.calculate_fall_speed(
+        grid, refl_field='reflectivity') is fall_speed
+    assert pydda.cost_functions.calculate_fall_speed(
+        grid, refl_field='reflectivity', frz=20000.0) is not fall_speed
+
+
+def test_fall_speed_parameterizations():
+    """ Do the fall speed relations follow their power laws? """
+    grid_shape = (2, 1, 4)
+    grid_limits = ((0, 10000), (0, 0), (-1000, 1000))
+    grid = pyart.testing.make_empty_grid(grid_shape, grid_limits)
+    ref_field = np.ma.array([[[10, 20.5, 35.25, 50]], [[10, 20.5, 35.25, 50]]])
+    hydro_field = np.array([[[0, 5, 1, 9]], [[0, 5, 1, 9]]])
+    grid.add_field('reflectivity', {'data': ref_field})
+    grid.add_field('hydro', {'data': hydro_field})
+    rho_factor = (1.2/np.exp(-np.array([0, 1.0])))**0.4
+    rho_factor = rho_factor[:, np.newaxis, np.newaxis]
+
+    rain = pydda.cost_functions.calculate_fall_speed(
+        grid, refl_field='reflectivity', parameterization='rain')
+    np.testing.assert_allclose(
+        rain, -2.6*10**(0.0107*ref_field)*rho_factor, rtol=1e-6)
+    snow = pydda.cost_functions.calculate_fall_speed(
+        grid, refl_field='reflectivity', parameterization='snow')
+    np.testing.assert_allclose(
+        snow, -0.817*10**(0.0063*ref_field)*rho_factor, rtol=1e-6)
+
+    # Unclassified points use the parameterization
+    hydro = pydda.cost_functions.calculate_fall_speed(
+        grid, refl_field='reflectivity', parameterization='snow',
+        hydro_field='hydro')
+    np.testing.assert_allclose(hydro[:, 0, 0], snow[:, 0, 0])
+    np.testing.assert_allclose(hydro[:, 0, 1], rain[:, 0, 1])
+    np.testing.assert_allclose(hydro[:, 0, 2], snow[:, 0, 2])
+    np.testing.assert_allclose(
+        hydro[:, 0, 3], -3.95*10**(0.0148*50)*rho_factor[:, 0, 0],
+        rtol=1e-6)
+
+    relation = pydda.cost_functions.FallSpeedRelation([-1.0], [0.0])
+    constant = pydda.cost_functions.calculate_fall_speed(
+        grid, refl_field='reflectivity',
+        parameterization=(relation, relation))
+    np.testing.assert_allclose(constant, -np.ones(grid_shape)*rho_factor)
+
+
 def test_calculate_mass_continuity():
     """ In a constant wind field, div * V = 0, so we should get zero for mass
     continuity cost function and gradient"""
@@ -179,3 +239,141 @@ def test_model_cost():
     cost2 = pydda.cost_functions.calculate_model_cost(
         u, v, w, weights, u - 1, v - 1, w)
     assert cost2 > cost1
+
+
+def test_hessp():
+    """ Does hessp match finite differences of the cost functions? """
+    grids, truth = pydda.tests.make_synthetic_radar_grids(
+        (6, 15, 15), num_radars=2)
+    vrs, azs, els, wts = pydda.tests.get_radial_velocity_inputs(grids)
+
+    grid_shape = (6, 15, 15)
+    weights = np.ones((2,) + grid_shape)
+    model_weights = np.ones((1,) + grid_shape)
+    z = grids[0].point_z['data']
+    args = (vrs, azs, els, wts, np.ones(6), np.ones(6), [truth['u']],
+            [truth['v']], [truth['w']], 1.0, 1500.0, 1e-3, 1e-3, 1e-3,
+            0.1, 0.0, 0.1, 0.0, 0.0, grid_shape, 1000.0, 1000.0, 500.0, z,
+            1.0, weights, np.ones(grid_shape), model_weights, True)
+    rng = np.random.RandomState(0)
+    winds = rng.standard_normal(3*6*15*15)
+    p = rng.standard_normal(3*6*15*15)
+
+    # Only the interior vertical velocities are free
+    free = np.ones((3,) + grid_shape)
+    free[2, 0] = 0
+    free[2, -1] = 0
+    p = p*free.ravel()
+    hess_p = pydda.cost_functions.hessp(winds, p, *args)
+    grad_diff = (pydda.cost_functions.grad_J(winds + p, *args) -
+                 pydda.cost_functions.grad_J(winds - p, *args))/2
+    np.testing.assert_allclose(hess_p, grad_diff*free.ravel(),
+                               atol=1e-8*np.abs(grad_diff).max())
+
+    # The vorticity term is not quadratic, so its finite difference needs
+    # a small step. Cv is large enough for it to matter with 1 km spacing.
+    args = args[:15] + (1e9, 0.1, 2.0, 3.0) + args[19:]
+    step = 1e-4
+    hess_p = pydda.cost_functions.hessp(winds, p, *args)
+    grad_diff = (pydda.cost_functions.grad_J(winds + step*p, *args) -
+                 pydda.cost_functions.grad_J(winds - step*p, *args))/(2*step)
+    vorticity_args = (1000.0, 1000.0, 500.0, 2.0, 3.0)
+    vorticity_hess_p = pydda.cost_functions.calculate_vertical_vorticity_hessp(
+        *np.reshape(winds, (3,) + grid_shape),
+        *np.reshape(p, (3,) + grid_shape), *vorticity_args, coeff=1e9)
+    assert np.abs(vorticity_hess_p).max() > 0.1*np.abs(hess_p).max()
+
+    # The gradient and the Hessian of the vorticity term should match
+    # finite differences of its cost function
+    def vorticity_cost(x):
+        return pydda.cost_functions.calculate_vertical_vorticity_cost(
+            *np.reshape(x, (3,) + grid_shape), *vorticity_args, coeff=1e9)
+
+    vorticity_grad = \
+        pydda.cost_functions.calculate_vertical_vorticity_gradient(
+            *np.reshape(winds, (3,) + grid_shape), *vorticity_args,
+            coeff=1e9)
+    cost_diff = (vorticity_cost(winds + step*p) -
+                 vorticity_cost(winds - step*p))/(2*step)
+    np.testing.assert_allclose(np.dot(vorticity_grad, p), cost_diff,
+                               rtol=1e-6)
+    step = 1e-3
+    cost_diff2 = (vorticity_cost(winds + step*p) - 2*vorticity_cost(winds) +
+                  vorticity_cost(winds - step*p))/step**2
+    np.testing.assert_allclose(np.dot(vorticity_hess_p, p), cost_diff2,
+                               rtol=1e-5)
+    np.testing.assert_allclose(hess_p*free.ravel(), grad_diff*free.ravel(),
+                               atol=1e-6*np.abs(grad_diff).max())
+
+
+def test_packed_observations():
+    """ Do the packed observations give the same radial velocity term? """
+    grids, truth = pydda.tests.make_synthetic_radar_grids(
+        (6, 15, 15), num_radars=3, max_range=12000.0)
+    vrs, azs, els, wts = pydda.tests.get_radial_velocity_inputs(grids)
+
+    weights = np.ones((3, 6, 15, 15))
+    weights[0, :, :5] = 0
+    rng = np.random.RandomState(0)
+    u, v, w = rng.standard_normal((3, 6, 15, 15))
+    cost = pydda.cost_functions.calculate_radial_vel_cost_function(
+        vrs, azs, els, u, v, w, wts, 2.0, weights.copy())
+    grad = pydda.cost_functions.calculate_grad_radial_vel(
+        vrs, els, azs, u, v, w, wts, weights.copy(), 2.0)
+    hess_p = pydda.cost_functions.calculate_radial_vel_hessp(
+        vrs, els, azs, u, v, w, wts, weights.copy(), 2.0)
+    for bit_masks in [False, True]:
+        packed = pydda.cost_functions.PackedObservations(
+            vrs, azs, els, wts, weights, bit_masks=bit_masks)
+        assert packed.get_coverage().max() == 3
+        assert packed.get_coverage().min() < 3
+        np.testing.assert_allclose(
+            pydda.cost_functions.calculate_radial_vel_cost_function(
+                packed, None, None, u, v, w, None, 2.0, None), cost,
+            rtol=1e-5)
+        np.testing.assert_allclose(
+            pydda.cost_functions.calculate_grad_radial_vel(
+                packed, None, None, u, v, w, None, None, 2.0), grad,
+            atol=1e-5*np.abs(grad).max())
+        np.testing.assert_allclose(
+            pydda.cost_functions.calculate_radial_vel_hessp(
+                packed, None, None, u, v, w, None, None, 2.0), hess_p,
+            atol=1e-5*np.abs(hess_p).max())
+
+
+def test_chunked_cost_function():
+    """ Does the chunked cost function match the cost function? """
+    grid_shape = (6, 15, 17)
+    grids, truth = pydda.tests.make_synthetic_radar_grids(
+        grid_shape, num_radars=2, max_range=12000.0)
+    vrs, azs, els, wts = pydda.tests.get_radial_velocity_inputs(grids)
+
+    rng = np.random.RandomState(0)
+    weights = np.ones((2,) + grid_shape)
+    bg_weights = rng.uniform(size=grid_shape)
+    mod_weights = rng.uniform(size=(1,) + grid_shape)
+    u_model = [truth['u'] + rng.standard_normal(grid_shape)]
+    v_model = [truth['v'] + rng.standard_normal(grid_shape)]
+    w_model = [np.zeros(grid_shape)]
+    args = (vrs, azs, els, wts, np.linspace(0, 5, 6), np.zeros(6),
+            u_model, v_model, w_model, 1.0, 1500.0, 1e-3, 1e-3, 1e-3, 0.1,
+            0.0, 1.0, None, None, grid_shape, 1000.0, 1000.0, 500.0,
+            grids[0].point_z['data'], 10.0, weights, bg_weights, mod_weights,
+            True)
+    winds = 5*rng.standard_normal((3,) + grid_shape).flatten()
+    terms = {}
+    J, grad = pydda.cost_functions.J_and_grad_J(winds, *args, terms=terms)
+    np.testing.assert_allclose(
+        J, pydda.cost_functions.J_function(winds, *args), rtol=1e-12)
+    np.testing.assert_allclose(
+        grad, pydda.cost_functions.grad_J(winds, *args), rtol=1e-10,
+        atol=1e-12)
+    chunked = pydda.cost_functions.ChunkedCostFunction(args, (6, 5))
+    chunked_terms = {}
+    chunked_J, chunked_grad = pydda.cost_functions.J_and_grad_J(
+        winds, chunked, *args[1:], terms=chunked_terms)
+    np.testing.assert_allclose(chunked_J, J, rtol=1e-10)
+    np.testing.assert_allclose(chunked_grad, grad, rtol=1e-10, atol=1e-12)
+    for name in terms.keys():
+        np.testing.assert_allclose(chunked_terms[name], terms[name],
+                                   rtol=1e-10)
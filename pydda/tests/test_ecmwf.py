@@ -3,7 +3,7 @@ import pyart
 import numpy as np
 
 from netCDF4 import Dataset
-from scipy.interpolate import interp1d
+from scipy.interpolate import interp1d, RegularGridInterpolator
 from datetime import datetime
 
 
@@ -39,7 +39,7 @@ def test_add_era_interim_field():
     u = u[nonans].flatten()
 
     # Interpolate era data onto u as a function of z
-    u_interp = interp1d(z, u, kind='nearest')
+    u_interp = interp1d(z, u, kind='linear')
 
     u_new_gridded = u_interp(
         np.asarray(Grid0.point_z["data"]+Grid0.radar_altitude["data"]))
@@ -63,3 +63,62 @@ def test_era_initialization():
         v_init, Grid0.fields["V_erainterim"]["data"], atol=1e-2)
     np.testing.assert_allclose(
         w_init, Grid0.fields["W_erainterim"]["data"], atol=1e-2)
+
+
+def test_era_interpolation():
+    Grid0 = pyart.testing.make_empty_grid(
+        (20, 21, 21), ((0, 15000), (-40000, 40000), (-40000, 40000)))
+    Grid0.origin_latitude['data'][:] = -12.5
+    Grid0.origin_longitude['data'][:] = 130.8
+    Grid0.init_point_longitude_latitude()
+    era_dataset = Dataset(pydda.tests.sample_files.ERA_PATH)
+    z = era_dataset.variables["z"][0]
+    u = era_dataset.variables["u"][0]
+    v = era_dataset.variables["v"][0]
+    lat = era_dataset.variables["latitude"][:]
+    lon = era_dataset.variables["longitude"][:]
+    u_new, v_new = pydda.constraints.model_data._interpolate_era_to_grid(
+        Grid0, z, [u, v], lat, lon)
+
+    # Interpolate each column in height, and then bilinearly in the
+    # horizontal
+    columns = np.zeros((len(Grid0.z["data"]),) + z.shape[1:])
+    for j in range(z.shape[1]):
+        for i in range(z.shape[2]):
+            order = np.argsort(z[:, j, i])
+            columns[:, j, i] = np.interp(
+                Grid0.z["data"], z[order, j, i], u[order, j, i])
+    u_interp = RegularGridInterpolator(
+        (lat[::-1], lon), np.transpose(columns[:, ::-1], (1, 2, 0)))
+    points = np.stack([
+        np.clip(Grid0.point_latitude["data"][0], lat.min(), lat.max()),
+        np.clip(Grid0.point_longitude["data"][0], lon.min(), lon.max())],
+        axis=-1)
+    np.testing.assert_allclose(
+        u_new, np.transpose(u_interp(points), (2, 0, 1)), atol=1e-6)
+    assert u_new.shape == v_new.shape == Grid0.point_z["data"].shape
+
+
+def test_era_interpolation_empty_columns():
+    """ Columns without valid data should be filled from the nearest one """
+    Grid0 = pyart.testing.make_empty_grid(
+        (20, 21, 21), ((0, 15000), (-40000, 40000), (-40000, 40000)))
+    Grid0.origin_latitude['data'][:] = -12.5
+    Grid0.origin_longitude['data'][:] = 130.8
+    Grid0.init_point_longitude_latitude()
+    era_dataset = Dataset(pydda.tests.sample_files.ERA_PATH)
+    z = np.ma.masked_invalid(era_dataset.variables["z"][0])
+    u = era_dataset.variables["u"][0]
+    lat = era_dataset.variables["latitude"][:]
+    lon = era_dataset.variables["longitude"][:]
+    z[:, 0] = np.ma.masked
+    u_new, = pydda.constraints.model_data._interpolate_era_to_grid(
+        Grid0, z, [u], lat, lon)
+    assert np.all(np.isfinite(u_new))
+
+    # The first row of columns is empty, so it takes the second row
+    z[:, 0] = z[:, 1]
+    u[:, 0] = u[:, 1]
+    u_filled, = pydda.constraints.model_data._interpolate_era_to_grid(
+        Grid0, z, [u], lat, lon)
+    np.testing.assert_allclose(u_new, u_filled)
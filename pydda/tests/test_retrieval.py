@@ -8,6 +8,9 @@ Created on Thu Jul 26 11:35:43 2018
 
 import pydda
 import pyart
+import pytest
+import tracemalloc
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
 
 from distributed import Client, LocalCluster
@@ -135,6 +138,137 @@ def test_smoothing():
     assert new_v2.std() < new_v.std()
 
 
+def test_retrieval_result():
+    """ The compact result should hold the same wind field as the grids """
+    Grid = pyart.testing.make_empty_grid(
+            (20, 40, 40), ((0, 10000), (-20000, 20000), (-20000, 20000)))
+    odata3 = np.ma.ones((20, 40, 40))
+    Grid.add_field('one_field', {'data': odata3, '_FillValue': -9999.0})
+
+    u = np.random.random((20, 40, 40))
+    v = np.random.random((20, 40, 40))
+    w = np.zeros((20, 40, 40))
+    kwargs = dict(Co=0.0, Cx=1e-4, Cy=1e-4, Cm=0.0, Cmod=0.0,
+                  mask_outside_opt=False, filt_iterations=0,
+                  vel_name='one_field', refl_field='one_field')
+    new_grids = pydda.retrieval.get_dd_wind_field([Grid], u, v, w, **kwargs)
+    result = pydda.retrieval.get_dd_wind_field(
+        [Grid], u, v, w, return_result=True, **kwargs)
+
+    assert isinstance(result, pydda.retrieval.WindRetrievalResult)
+    assert result.grid is Grid
+    assert 'u' not in Grid.fields
+    assert result.diagnostics['iterations'] > 0
+    np.testing.assert_array_equal(result.u, new_grids[0].fields['u']['data'])
+
+    result_grids = result.to_pyart_grids()
+    assert result_grids[0] is not Grid
+    assert result_grids[0].fields['v']['max_bca'] == 150.0
+    np.testing.assert_array_equal(result_grids[0].fields['v']['data'],
+                                  new_grids[0].fields['v']['data'])
+
+    # A shallow copy only adds the wind field to a new Grid
+    shallow_grids = result.to_pyart_grids(copy='shallow')
+    assert shallow_grids[0] is not Grid
+    assert 'u' not in Grid.fields
+    assert (shallow_grids[0].fields['one_field']['data'] is
+            Grid.fields['one_field']['data'])
+    shallow_grids[0].metadata['pydda_profile'] = '{}'
+    assert 'pydda_profile' not in Grid.metadata
+
+
+def test_telemetry_callback():
+    """ The callback should get one record per optimizer iteration """
+    Grid = pyart.testing.make_empty_grid(
+            (20, 40, 40), ((0, 10000), (-20000, 20000), (-20000, 20000)))
+    odata3 = np.ma.ones((20, 40, 40))
+    Grid.add_field('one_field', {'data': odata3, '_FillValue': -9999.0})
+
+    u = np.random.random((20, 40, 40))
+    v = np.random.random((20, 40, 40))
+    w = np.zeros((20, 40, 40))
+    sink = pydda.retrieval.MemorySink()
+    result = pydda.retrieval.get_dd_wind_field(
+        [Grid], u, v, w, Co=0.0, Cx=1e-4, Cy=1e-4, Cm=0.0, Cmod=0.0,
+        mask_outside_opt=False, filt_iterations=1, vel_name='one_field',
+        refl_field='one_field', callback=sink, return_result=True,
+        output_cost_functions=False)
+
+    assert len(sink.records) > 0
+    assert set([r['stage'] for r in sink.records]) <= set(
+        ['first_pass', 'filter'])
+    assert sink.records[-1]['num_evaluations'] <= \
+        result.diagnostics['num_evaluations']
+    for record in sink.records:
+        assert np.isclose(record['cost'], sum(record['terms'].values()))
+    first_pass = [r for r in sink.records if r['stage'] == 'first_pass']
+    assert first_pass[-1]['cost'] < first_pass[0]['cost']
+    assert [r['iteration'] for r in first_pass] == list(
+        range(1, len(first_pass) + 1))
+
+
+def test_telemetry_recorder_evaluations():
+    """ The recorder should not evaluate the cost function itself """
+    sink = pydda.retrieval.MemorySink()
+    recorder = pydda.retrieval.telemetry.TelemetryRecorder([sink])
+    terms = {'Jvel': 1.0, 'Jmass': 2.0}
+    recorder.record_evaluation(
+        np.zeros(6), 3.0, terms, np.ones(6), np.arange(6.0))
+    recorder(np.ones(6))
+    assert recorder.num_evaluations == 1
+    assert sink.records[0]['num_evaluations'] == 1
+    assert sink.records[0]['cost'] == 3.0
+    assert sink.records[0]['w_max'] == 5.0
+
+
+def test_retrieval_profile():
+    """ The profile should be attached to the output grids """
+    import json
+
+    Grid = pyart.testing.make_empty_grid(
+            (20, 40, 40), ((0, 10000), (-20000, 20000), (-20000, 20000)))
+    odata3 = np.ma.ones((20, 40, 40))
+    Grid.add_field('one_field', {'data': odata3, '_FillValue': -9999.0})
+
+    u = np.random.random((20, 40, 40))
+    v = np.random.random((20, 40, 40))
+    w = np.zeros((20, 40, 40))
+    new_grids = pydda.retrieval.get_dd_wind_field(
+        [Grid], u, v, w, Co=0.0, Cx=1e-4, Cy=1e-4, Cm=0.0, Cmod=0.0,
+        mask_outside_opt=False, filt_iterations=1, vel_name='one_field',
+        refl_field='one_field', profile=True)
+
+    profile = json.loads(new_grids[0].metadata['pydda_profile'])
+    for stage in ['fall_speed', 'geometry', 'weights', 'optimizer',
+                  'filter', 'output']:
+        assert profile['stage_times'][stage] >= 0
+    assert profile['total_time'] >= sum(profile['stage_times'].values())
+
+
+def test_low_pass_filter():
+    """ The Savitzky-Golay filter should match SciPy's savgol_filter and
+        all filters should smooth out random noise """
+    from scipy.signal import savgol_filter
+
+    winds = np.random.random((3, 20, 30, 40))
+    expected = winds.copy()
+    for i in range(3):
+        for axis in range(3):
+            expected[i] = savgol_filter(expected[i], 9, 3, axis=axis)
+
+    filtered = pydda.retrieval.low_pass_filter(winds, window=9, order=3)
+    np.testing.assert_allclose(filtered, expected, atol=1e-10)
+    filtered = pydda.retrieval.low_pass_filter(winds, window=9, order=3,
+                                               num_threads=3)
+    np.testing.assert_allclose(filtered, expected, atol=1e-10)
+
+    for filter_type in ['gaussian', 'spectral']:
+        filtered = pydda.retrieval.low_pass_filter(
+            winds, filter_type=filter_type)
+        assert filtered.shape == winds.shape
+        assert filtered.std() < winds.std()
+
+
 def test_model_constraint():
     """ A retrieval with just the model constraint should converge
         to the model constraint. """
@@ -171,3 +305,418 @@ def test_model_constraint():
     np.testing.assert_allclose(new_grids[0].fields["w"]["data"],
                                Grid0.fields["W_fakemodel"]["data"],
                                atol=1e-2)
+
+
+def test_active_set():
+    """ Points far away from the observations should keep their initial
+        value when an active set is used """
+    Grid = pyart.testing.make_empty_grid(
+            (20, 40, 40), ((0, 10000), (-20000, 20000), (-20000, 20000)))
+
+    mask = np.ones((20, 40, 40), dtype=bool)
+    mask[:, 15:25, 15:25] = False
+    odata3 = np.ma.masked_where(mask, np.ones((20, 40, 40)))
+    Grid.add_field('one_field', {'data': odata3, '_FillValue': -9999.0})
+
+    u = np.random.random((20, 40, 40))
+    v = np.random.random((20, 40, 40))
+    w = np.zeros((20, 40, 40))
+    # The low pass filter should not change the points outside either
+    for filt_iterations in [0, 2]:
+        new_grids = pydda.retrieval.get_dd_wind_field(
+            [Grid], u, v, w, Co=0.0, Cx=1e-2, Cy=1e-2, Cm=0.0, Cmod=0.0,
+            mask_outside_opt=False, filt_iterations=filt_iterations,
+            vel_name='one_field', refl_field='one_field',
+            active_set_radius=2)
+        new_u = new_grids[0].fields['u']['data']
+
+        np.testing.assert_array_equal(new_u[:, :13, :], u[:, :13, :])
+        np.testing.assert_array_equal(new_u[:, :, 27:], u[:, :, 27:])
+        assert new_u[:, 15:25, 15:25].std() < u[:, 15:25, 15:25].std()
+
+
+def test_geometry_cache(tmpdir):
+    """ The cached geometry should be the same as the calculated one """
+    Grids = []
+    for lon_offset in [-0.1, 0.1]:
+        Grid = pyart.testing.make_empty_grid(
+            (10, 20, 20), ((0, 10000), (-20000, 20000), (-20000, 20000)))
+        Grid.add_field('one_field', {'data': np.ma.ones((10, 20, 20)),
+                                     '_FillValue': -9999.0})
+        Grid.radar_longitude['data'] = (
+            Grid.radar_longitude['data'] + lon_offset)
+        Grids.append(Grid)
+
+    cache_dir = str(tmpdir.join('geometry'))
+    for i in range(2):
+        pydda.retrieval.add_cached_geometry_as_fields(
+            Grids[0], cache_dir, dz_name='one_field')
+        bca = pydda.retrieval.get_cached_bca(Grids[0], Grids[1], cache_dir)
+    assert len(tmpdir.join('geometry').listdir()) == 5
+
+    # The cached fields and their masks should not be read into memory
+    for field_name in ['AZ', 'EL']:
+        field = Grids[0].fields[field_name]['data']
+        for array in [field.data, field.mask]:
+            while not isinstance(array, np.memmap):
+                array = array.base
+                assert array is not None
+
+    Grid = deepcopy(Grids[0])
+    pydda.retrieval.angles.add_azimuth_as_field(Grid, dz_name='one_field')
+    pydda.retrieval.angles.add_elevation_as_field(Grid, dz_name='one_field')
+    np.testing.assert_allclose(Grids[0].fields['AZ']['data'],
+                               Grid.fields['AZ']['data'])
+    np.testing.assert_allclose(Grids[0].fields['EL']['data'],
+                               Grid.fields['EL']['data'])
+    np.testing.assert_allclose(bca, pydda.retrieval.get_bca(
+        Grids[0].radar_longitude['data'], Grids[0].radar_latitude['data'],
+        Grids[1].radar_longitude['data'], Grids[1].radar_latitude['data'],
+        Grids[0].point_x['data'][0], Grids[0].point_y['data'][0],
+        Grids[0].get_projparams()))
+
+
+def test_synthetic_radar_grids(tmpdir):
+    """ Do the synthetic radial velocities match the true winds? """
+    grids, truth = pydda.tests.make_synthetic_radar_grids(
+        (10, 31, 31), num_radars=3)
+    lazy_grids, lazy_truth = pydda.tests.make_synthetic_radar_grids(
+        (10, 31, 31), num_radars=3, lazy=True, memmap_dir=str(tmpdir))
+    for grid, lazy_grid in zip(grids, lazy_grids):
+        vel = grid.fields['velocity']['data']
+        lazy_vel = lazy_grid.fields['velocity']['data']
+        assert vel.count() > 0
+        assert np.all(vel.mask == lazy_vel.mask)
+        np.testing.assert_allclose(vel.compressed(), lazy_vel.compressed())
+
+    # Another scene in the same directory does not overwrite the first
+    other_grids, other_truth = pydda.tests.make_synthetic_radar_grids(
+        (10, 31, 31), num_radars=3, lazy=True, memmap_dir=str(tmpdir),
+        noise_std=1.0)
+    assert np.any(other_grids[0].fields['velocity']['data'] !=
+                  lazy_grids[0].fields['velocity']['data'])
+    np.testing.assert_allclose(
+        grids[0].fields['velocity']['data'].compressed(),
+        lazy_grids[0].fields['velocity']['data'].compressed())
+
+    vrs, azs, els, wts = pydda.tests.get_radial_velocity_inputs(grids)
+    weights = np.ones((3,) + vrs[0].shape)
+    Jvel = pydda.cost_functions.calculate_radial_vel_cost_function(
+        vrs, azs, els, truth['u'], truth['v'], truth['w'], wts, 1.0,
+        weights)
+    assert Jvel < 1e-3
+
+
+def test_newton_solver():
+    """ Does the Newton-CG solver reach the L-BFGS solution sooner? """
+    grid_shape = (6, 15, 15)
+    results = {}
+    for solver in ['lbfgs', 'newton-cg']:
+        grids, truth, init = pydda.tests.make_synthetic_retrieval(
+            grid_shape, num_radars=3)
+        results[solver] = pydda.retrieval.get_dd_wind_field(
+            grids, *init, vel_name='velocity',
+            refl_field='reflectivity', Co=1.0, Cm=1500.0, Cx=1e-3,
+            Cy=1e-3, Cz=1e-3, filt_iterations=0, return_result=True,
+            output_cost_functions=False, solver=solver)
+
+    assert (results['newton-cg'].diagnostics['iterations'] <
+            results['lbfgs'].diagnostics['iterations'])
+    mask = results['lbfgs'].coverage >= 1
+    u_error = np.abs(results['newton-cg'].u - truth['u'])[mask].mean()
+    lbfgs_u_error = np.abs(results['lbfgs'].u - truth['u'])[mask].mean()
+    assert u_error < lbfgs_u_error + 0.5
+
+
+def test_regrid_separable():
+    """ Is linear interpolation exact for a linear field? """
+    z = np.linspace(0, 10, 5)
+    y = np.linspace(-5, 5, 11)
+    x = np.linspace(-5, 5, 6)
+    field = (2*z[:, np.newaxis, np.newaxis] + 3*y[np.newaxis, :, np.newaxis] -
+             x[np.newaxis, np.newaxis, :])
+    new_y = np.linspace(-5, 5, 21)
+    new_x = np.linspace(-5, 5, 31)
+    new_field = pydda.retrieval.regrid_separable(
+        np.stack([field, -field]), [y, x], [new_y, new_x])
+    expected = (2*z[:, np.newaxis, np.newaxis] +
+                3*new_y[np.newaxis, :, np.newaxis] -
+                new_x[np.newaxis, np.newaxis, :])
+    assert new_field.shape == (2, 5, 21, 31)
+    np.testing.assert_allclose(new_field[0], expected, atol=1e-10)
+    np.testing.assert_allclose(new_field[1], -expected, atol=1e-10)
+
+    cubic_field = pydda.retrieval.regrid_separable(
+        field, [z, y, x], [z, new_y, new_x], method='cubic')
+    np.testing.assert_allclose(cubic_field, expected, atol=1e-10)
+
+
+def test_multigrid():
+    """ Does multigrid need fewer iterations on the fine grid? """
+    grid_shape = (6, 41, 41)
+    grids, truth, init = pydda.tests.make_synthetic_retrieval(
+        grid_shape, num_radars=3)
+    sink = pydda.retrieval.MemorySink()
+    results = []
+    for levels, callback in [(1, None), (3, sink)]:
+        results.append(pydda.retrieval.get_dd_wind_field(
+            grids, *init, vel_name='velocity',
+            refl_field='reflectivity', Co=1.0, Cm=1500.0, Cx=1e-3, Cy=1e-3,
+            Cz=1e-3, filt_iterations=0, return_result=True,
+            output_cost_functions=False, multigrid_levels=levels,
+            callback=callback))
+    single, result = results
+    assert len(result.diagnostics['coarse_iterations']) == 2
+    stages = [record['stage'] for record in sink.records]
+    assert stages[0] == 'multigrid_2'
+    assert 'multigrid_1' in stages
+    assert (result.diagnostics['iterations'] <
+            single.diagnostics['iterations'])
+    mask = result.coverage >= 1
+    assert np.abs(result.u - truth['u'])[mask].mean() < 3
+
+
+def test_compress_observations():
+    """ Do packed observations give the same retrieval? """
+    grid_shape = (6, 31, 31)
+    grids, truth, init = pydda.tests.make_synthetic_retrieval(
+        grid_shape, num_radars=3)
+    results = []
+    for compress in [False, True, 'bits']:
+        results.append(pydda.retrieval.get_dd_wind_field(
+            grids, *init, vel_name='velocity',
+            refl_field='reflectivity', Co=1.0, Cm=1500.0, Cx=1e-3,
+            Cy=1e-3, Cz=1e-3, filt_iterations=0, return_result=True,
+            output_cost_functions=False, multigrid_levels=2,
+            compress_observations=compress))
+    for result in results[1:]:
+        np.testing.assert_array_equal(result.coverage, results[0].coverage)
+        assert np.abs(result.u - results[0].u).max() < 0.1
+        assert np.abs(result.w - results[0].w).max() < 0.1
+
+
+def test_chunked_retrieval():
+    """ Does evaluating the cost function in chunks give the same winds? """
+    grid_shape = (6, 31, 31)
+    grids, truth, init = pydda.tests.make_synthetic_retrieval(
+        grid_shape, num_radars=3)
+    results = []
+    for chunks in [None, (16, 16)]:
+        results.append(pydda.retrieval.get_dd_wind_field(
+            grids, *init, vel_name='velocity',
+            refl_field='reflectivity', Co=1.0, Cm=1500.0, Cx=1e-3,
+            Cy=1e-3, Cz=1e-3, filt_iterations=1, return_result=True,
+            output_cost_functions=True, active_set_radius=3,
+            chunks=chunks))
+    np.testing.assert_array_equal(results[1].coverage, results[0].coverage)
+    assert (results[1].diagnostics['iterations'] ==
+            results[0].diagnostics['iterations'])
+    for name in ['u', 'v', 'w']:
+        np.testing.assert_allclose(getattr(results[1], name),
+                                   getattr(results[0], name), atol=1e-3)
+
+
+def test_compress_observations_memory():
+    """ Packing the observations should lower the peak memory use """
+    grid_shape = (10, 41, 41)
+    peaks = []
+    for compress in [False, True, 'bits']:
+        grids, truth, init = pydda.tests.make_synthetic_retrieval(
+            grid_shape, num_radars=4, dtype=np.float64)
+        tracemalloc.start()
+        pydda.retrieval.get_dd_wind_field(
+            grids, *init, vel_name='velocity',
+            refl_field='reflectivity', Co=1.0, Cm=1500.0, Cz=0.0,
+            filt_iterations=0, max_iterations=10, return_result=True,
+            output_cost_functions=False, compress_observations=compress)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    assert peaks[1] < peaks[0]
+    assert peaks[2] < peaks[0]
+
+
+def test_nested_retrieval_in_memory(tmpdir):
+    """ The nested retrieval should not write to the working directory """
+    grid_shape = (6, 41, 41)
+    grids, truth, init = pydda.tests.make_synthetic_retrieval(
+        grid_shape, num_radars=3)
+    kwargs = dict(vel_name='velocity', refl_field='reflectivity', Co=1.0,
+                  Cm=1500.0, Cx=1e-3, Cy=1e-3, Cz=1e-3, filt_iterations=0)
+    single_grids = pydda.retrieval.get_dd_wind_field(
+        grids, *init, **kwargs)
+    cluster = LocalCluster(n_workers=2, processes=False)
+    client = Client(cluster)
+    with tmpdir.as_cwd():
+        new_grids = pydda.retrieval.get_dd_wind_field_nested(
+            grids, *init, client, **kwargs)
+    client.close()
+    cluster.close()
+    assert len(tmpdir.listdir()) == 0
+    assert new_grids[0].fields['u']['data'].shape == grid_shape
+    assert 'reflectivity' in new_grids[1].fields
+    # The halos remove the seams in w between the tiles
+    for field_name, min_corr in [('u', 0.8), ('v', 0.8), ('w', 0.9)]:
+        assert np.ma.corrcoef(
+            new_grids[0].fields[field_name]['data'].flatten(),
+            single_grids[0].fields[field_name]['data'].flatten())[
+                0, 1] > min_corr
+
+
+def test_nested_executors():
+    """ The nests should give the same result on each executor """
+    grid_shape = (6, 31, 31)
+    grids, truth, init = pydda.tests.make_synthetic_retrieval(
+        grid_shape, num_radars=2)
+    results = []
+    for executor in ['serial', 'thread', 'process']:
+        results.append(pydda.retrieval.get_dd_wind_field_nested(
+            grids, *init, executor=executor, num_workers=2,
+            vel_name='velocity', refl_field='reflectivity', Co=1.0,
+            Cm=1500.0, Cx=1e-3, Cy=1e-3, Cz=1e-3, filt_iterations=0,
+            return_result=True, profile=True))
+    assert len(results[0].diagnostics['tiles']) == 4
+    for result in results[1:]:
+        np.testing.assert_allclose(result.u, results[0].u)
+        np.testing.assert_allclose(result.w, results[0].w)
+
+    # The profiles of the tiles are collected from the workers
+    for result in results:
+        stage_times = result.profile['stage_times']
+        assert stage_times['tile_optimizer'] > 0
+        assert result.profile['peak_rss_mb']['tile_optimizer'] > 0
+
+
+def test_nested_balanced_tiling():
+    """ Tiles without observations should keep the coarse retrieval """
+    grid_shape = (6, 41, 41)
+
+    def refl_func(x, y, z):
+        return 40.0 - ((x - 6000.0)**2 + (y - 6000.0)**2)/1e6
+
+    grids, truth, init = pydda.tests.make_synthetic_retrieval(
+        grid_shape, num_radars=2, refl_func=refl_func)
+    result = pydda.retrieval.get_dd_wind_field_nested(
+        grids, *init, executor='serial', tiling='balanced',
+        num_tiles=6, vel_name='velocity', refl_field='reflectivity', Co=1.0,
+        Cm=1500.0, Cx=1e-3, Cy=1e-3, Cz=1e-3, filt_iterations=0,
+        return_result=True)
+    cores = result.diagnostics['tile_cores']
+    assert len(cores) == 6
+    covered = np.zeros(grid_shape[1:])
+    for y0, y1, x0, x1 in cores:
+        covered[y0:y1, x0:x1] += 1
+    assert np.all(covered == 1)
+    skipped = [tile.get('skipped', False)
+               for tile in result.diagnostics['tiles']]
+    assert any(skipped) and not all(skipped)
+    assert result.coverage.max() >= 1
+    assert np.all(np.isfinite(np.ma.getdata(result.u)))
+
+
+def test_nested_schwarz_iterations():
+    """ The seams between the tiles should shrink with each sweep """
+    grid_shape = (6, 31, 31)
+    grids, truth, init = pydda.tests.make_synthetic_retrieval(
+        grid_shape, num_radars=2)
+    mismatch = []
+    for schwarz_iterations in [0, 1, 3]:
+        result = pydda.retrieval.get_dd_wind_field_nested(
+            grids, *init, executor='serial',
+            schwarz_iterations=schwarz_iterations, vel_name='velocity',
+            refl_field='reflectivity', Co=1.0, Cm=1500.0, Cx=1e-3,
+            Cy=1e-3, Cz=1e-3, filt_iterations=0, return_result=True)
+        mismatch.append(result.diagnostics['tile_mismatch'])
+    # Holding the halos at the neighbors does more than a warm start
+    assert mismatch[1] < 0.5*mismatch[0]
+    assert mismatch[2] < mismatch[1]
+
+
+def test_nested_cascade():
+    """ Each level of the cascade should start the next """
+    grid_shape = (6, 41, 41)
+    grids, truth, init = pydda.tests.make_synthetic_retrieval(
+        grid_shape, num_radars=2)
+    kwargs = dict(vel_name='velocity', refl_field='reflectivity', Co=1.0,
+                  Cm=1500.0, Cx=1e-3, Cy=1e-3, Cz=1e-3, filt_iterations=0,
+                  return_result=True)
+    two_level = pydda.retrieval.get_dd_wind_field_nested(
+        grids, *init, executor='serial', **kwargs)
+    result = pydda.retrieval.get_dd_wind_field_nested(
+        grids, *init, executor='serial', num_splits=4,
+        reduction_factors=[4, 2], **kwargs)
+    levels = result.diagnostics['levels']
+    assert [level['reduction_factor'] for level in levels] == [4, 2, 1]
+    assert [len(level['tile_cores']) for level in levels] == [1, 4, 16]
+    assert result.u.shape == grid_shape
+    assert np.ma.corrcoef(result.u.flatten(),
+                          two_level.u.flatten())[0, 1] > 0.8
+
+
+def test_nested_failed_tiles(monkeypatch):
+    """ Failed tiles should be retried and then filled from the coarse pass """
+    grid_shape = (6, 31, 31)
+    grids, truth, init = pydda.tests.make_synthetic_retrieval(
+        grid_shape, num_radars=2)
+    kwargs = dict(vel_name='velocity', refl_field='reflectivity', Co=1.0,
+                  Cm=1500.0, Cx=1e-3, Cy=1e-3, Cz=1e-3, filt_iterations=0,
+                  executor='serial', retry_backoff=0.0)
+    get_dd_wind_field = pydda.retrieval.nesting.get_dd_wind_field
+
+    # Errors that fail every attempt are raised
+    with pytest.raises(TypeError):
+        pydda.retrieval.get_dd_wind_field_nested(
+            grids, *init, bogus_kwarg=3, **kwargs)
+
+    # Run out of memory unless the observations are packed
+    def out_of_memory(Grids, *args, **kwargs):
+        if kwargs.get('compress_observations', False) != 'bits':
+            raise MemoryError()
+        return get_dd_wind_field(Grids, *args, **kwargs)
+
+    monkeypatch.setattr(pydda.retrieval.nesting, 'get_dd_wind_field',
+                        out_of_memory)
+    new_grids = pydda.retrieval.get_dd_wind_field_nested(
+        grids, *init, **kwargs)
+    assert np.all(new_grids[0].fields['nested_qc']['data'] == 0)
+
+    # Only the coarse pass succeeds
+    dx = np.diff(grids[0].x['data'])[0]
+
+    def fail_tiles(Grids, *args, **kwargs):
+        if np.diff(Grids[0].x['data'])[0] > dx:
+            return get_dd_wind_field(Grids, *args, **kwargs)
+        raise OSError('worker failed')
+
+    monkeypatch.setattr(pydda.retrieval.nesting, 'get_dd_wind_field',
+                        fail_tiles)
+    result = pydda.retrieval.get_dd_wind_field_nested(
+        grids, *init, max_retries=1, return_result=True,
+        **kwargs)
+    assert np.all(result.diagnostics['nested_qc'] == 2)
+    for tile in result.diagnostics['tiles']:
+        assert tile['failed'] and tile['attempts'] == 2
+    assert np.all(np.isfinite(np.ma.getdata(result.u)))
+    assert np.abs(result.u).max() > 0
+
+    # The coarse pass has nothing to fall back on
+    def fail_all(Grids, *args, **kwargs):
+        raise OSError('worker failed')
+
+    monkeypatch.setattr(pydda.retrieval.nesting, 'get_dd_wind_field',
+                        fail_all)
+    with pytest.raises(OSError):
+        pydda.retrieval.get_dd_wind_field_nested(
+            grids, *init, max_retries=1, **kwargs)
+
+    # Tiles lost with their workers are filled from the coarse pass
+    def lose_tiles(Grids, *args, **kwargs):
+        if np.diff(Grids[0].x['data'])[0] > dx:
+            return get_dd_wind_field(Grids, *args, **kwargs)
+        raise BrokenProcessPool()
+
+    monkeypatch.setattr(pydda.retrieval.nesting, 'get_dd_wind_field',
+                        lose_tiles)
+    result = pydda.retrieval.get_dd_wind_field_nested(
+        grids, *init, return_result=True, **kwargs)
+    assert np.all(result.diagnostics['nested_qc'] == 2)
+    assert np.abs(result.u).max() > 0
@@ -66,7 +66,7 @@ def setup_package():
                           'arm_pyart', 'dask', 'distributed',
                           'scipy', 'numpy'],
         packages=find_packages(exclude=['contrib', 'docs', 
-                                       'tests', 'examples']),
+                                       'tests', 'examples', 'benchmarks']),
         project_urls={
             'Bug Reports': 'https://github.com/openradar/PyDDA/issues',
             'Source': 'https://github.com/openradar/PyDDA'},